@@ -0,0 +1,133 @@
+"""
+Parses utterances in bulk, outside of Flask, with the same parsing code as the chat routes.
+
+Utterances are read one per line from a file or stdin and written as JSON lines with the
+intent, the resolved items and quantities, and the modifications. Like the chat route, each
+one is first looked up in the parse cache and tried on the fast path; only the rest run
+through nlp.pipe in batches (optionally in several processes). Input is streamed, so memory stays bounded
+however large the input is. A throughput summary is printed to stderr at the end.
+
+    python batch_parse.py transcripts.txt -o parsed.jsonl --batch-size 256 --processes 4
+    cat transcripts.jsonl | python batch_parse.py --field text > parsed.jsonl
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from collections import Counter
+
+# Most results parsed without spaCy that wait for the next message that needs it
+MAX_WAITING = 10000
+
+
+# Function to read utterances from plain text lines or from a field of JSON lines
+def read_utterances(stream, field=None):
+    for line in stream:
+        line = line.strip()
+        if not line:
+            continue
+        if field:
+            try:
+                line = str(json.loads(line).get(field, '')).strip()
+            except (ValueError, AttributeError):
+                continue
+            if not line:
+                continue
+        yield line
+
+
+# Function to parse a stream of utterances in batches
+def parse_utterances(utterances, batch_size=128, processes=1):
+    """
+    Yields (utterance, parsed) pairs in input order, where parsed is the result of
+    main.parse_message. Messages the parse cache or the fast path answer never reach spaCy;
+    the others are normalized exactly like the chat route before they go through nlp.pipe.
+    """
+    # Import here so --help works without loading the spaCy model
+    from main import MessageAnalysis, nlp, parse_message
+
+    # nlp.pipe only gets the messages that need spaCy. Each carries the results parsed
+    # without spaCy just before it, so everything comes out in input order
+    leftover = []
+
+    def spacy_texts():
+        waiting = []
+        for utterance in utterances:
+            analysis = MessageAnalysis(utterance)
+            parsed = parse_message(analysis, use_spacy=False)
+            if parsed is None:
+                yield analysis.text, (waiting, utterance)
+                waiting = []
+                continue
+            waiting.append((utterance, parsed))
+            # An empty text hands a long run of such results over, so memory stays bounded
+            if len(waiting) >= MAX_WAITING:
+                yield '', (waiting, None)
+                waiting = []
+        leftover.extend(waiting)
+
+    for doc, (waiting, utterance) in nlp.pipe(spacy_texts(), as_tuples=True, batch_size=batch_size,
+                                              n_process=processes):
+        yield from waiting
+        if utterance is not None:
+            yield utterance, parse_message(MessageAnalysis(utterance, doc=doc), fast_path=False)
+    yield from leftover
+
+
+# Function to turn a parse result into one JSON record
+def to_record(utterance, parsed):
+    return {
+        'text': utterance,
+        'intent': parsed['intent'],
+        'rule': parsed['rule'],
+        'items': [{'item': item, 'quantity': quantity} for item, quantity in parsed['items']],
+        'modifications': parsed['modifications'],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('input', nargs='?', default='-', help='file with one utterance per line (default: stdin)')
+    parser.add_argument('-o', '--output', default='-', help='JSONL output file (default: stdout)')
+    parser.add_argument('--field', help='read JSON lines and take the utterance from this field')
+    parser.add_argument('--batch-size', type=int, default=128, help='texts per nlp.pipe batch')
+    parser.add_argument('--processes', type=int, default=1, help='worker processes for nlp.pipe')
+    args = parser.parse_args()
+
+    source = sys.stdin if args.input == '-' else open(args.input, encoding='utf-8')
+    sink = sys.stdout if args.output == '-' else open(args.output, 'w', encoding='utf-8')
+
+    # Parsing completes no orders, so don't open the order log
+    os.environ.setdefault('CHATBOT_ORDER_LOG', '')
+    # Load the model and menu before starting the clock so the summary measures parsing only
+    import main as chatbot  # noqa: F401
+
+    count = 0
+    no_items = 0
+    intents = Counter()
+    start = time.perf_counter()
+    try:
+        utterances = read_utterances(source, args.field)
+        for utterance, parsed in parse_utterances(utterances, args.batch_size, args.processes):
+            sink.write(json.dumps(to_record(utterance, parsed)) + '\n')
+            count += 1
+            intents[parsed['intent']] += 1
+            if parsed['intent'] in ('order', 'remove_items') and not parsed['items']:
+                no_items += 1
+    finally:
+        if source is not sys.stdin:
+            source.close()
+        if sink is not sys.stdout:
+            sink.close()
+
+    elapsed = time.perf_counter() - start
+    rate = count / elapsed if elapsed else 0.0
+    print(f"Parsed {count} utterances in {elapsed:.2f}s ({rate:.1f}/s, batch size {args.batch_size}, "
+          f"{args.processes} process(es))", file=sys.stderr)
+    print(f"Intents: {', '.join(f'{intent}={total}' for intent, total in intents.most_common())}", file=sys.stderr)
+    print(f"Order/removal messages with no menu items found: {no_items}", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
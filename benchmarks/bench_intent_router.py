@@ -0,0 +1,85 @@
+"""
+Compares the compiled intent router against the chained any(phrase in text) checks
+it replaced, as the number of intent phrases grows.
+
+Extra synthetic phrases that never match are added to every intent to show how each
+approach scales. Run from the repository root:
+
+    python benchmarks/bench_intent_router.py
+    python benchmarks/bench_intent_router.py --extra 0 100 1000 --rounds 50
+"""
+import argparse
+import os
+import random
+import string
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from intent_router import IntentRouter  # noqa: E402
+
+UTTERANCES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'utterances.txt')
+
+
+# Function to route a message the way chat() did before the router
+def route_with_chain(rules, default_intent, text):
+    for intent, phrases in rules:
+        if any(phrase in text for phrase in phrases):
+            return intent
+    return default_intent
+
+
+# Function to add phrases that never match to every intent
+def with_extra_phrases(rules, extra, seed=0):
+    rng = random.Random(seed)
+    padded = []
+    for intent, phrases in rules:
+        filler = [''.join(rng.choice(string.ascii_lowercase) for _ in range(12)) + 'q' for _ in range(extra)]
+        padded.append((intent, list(phrases) + filler))
+    return padded
+
+
+# Function to time one routing function over the utterances
+def time_per_message(route, utterances, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for text in utterances:
+            route(text)
+    return (time.perf_counter() - start) / (rounds * len(utterances)) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--extra', nargs='+', type=int, default=[0, 100, 1000],
+                        help='synthetic phrases added to each intent')
+    parser.add_argument('--rounds', type=int, default=20)
+    args = parser.parse_args()
+
+    # Import here so the spaCy model only loads when the benchmark actually runs
+    from main import MessageAnalysis, intent_rules
+
+    with open(UTTERANCES_PATH, encoding='utf-8') as handle:
+        utterances = [MessageAnalysis(line.strip()).plain_text for line in handle if line.strip()]
+
+    print(f"{'phrases':>8} {'chain us/msg':>13} {'router us/msg':>14} {'compile ms':>11}")
+    for extra in args.extra:
+        rules = with_extra_phrases(intent_rules, extra)
+        compile_start = time.perf_counter()
+        router = IntentRouter(rules, default_intent='order')
+        compile_ms = (time.perf_counter() - compile_start) * 1000
+
+        mismatches = [text for text in utterances
+                      if router.route(text).intent != route_with_chain(rules, 'order', text)]
+        if mismatches:
+            raise SystemExit(f"Router and chain disagree on: {mismatches}")
+
+        chain_us = time_per_message(lambda text: route_with_chain(rules, 'order', text), utterances, args.rounds)
+        router_us = time_per_message(router.route, utterances, args.rounds)
+        phrase_count = sum(len(phrases) for _, phrases in rules)
+        print(f"{phrase_count:>8} {chain_us:>13.2f} {router_us:>14.2f} {compile_ms:>11.1f}")
+
+
+if __name__ == '__main__':
+    main()
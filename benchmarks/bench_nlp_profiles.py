@@ -0,0 +1,113 @@
+"""
+Compares per-message spaCy latency and process RSS between NLP pipeline profiles.
+
+Each profile is measured in its own subprocess so the RSS numbers are not mixed up
+with models loaded for other profiles. Run from the repository root:
+
+    python benchmarks/bench_nlp_profiles.py
+    python benchmarks/bench_nlp_profiles.py --profiles full lean --rounds 20 --json
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+UTTERANCES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'utterances.txt')
+
+
+# Function to read the current resident set size of this process in MB
+def current_rss_mb():
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # Outside Linux fall back to the peak RSS, which is close enough right after loading
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+# Function to load the benchmark utterances
+def load_utterances(path=UTTERANCES_PATH):
+    with open(path, encoding='utf-8') as handle:
+        return [line.strip().lower() for line in handle if line.strip()]
+
+
+# Function to measure one profile inside the current process
+def measure_profile(profile, rounds):
+    from nlp_pipeline import load_pipeline
+
+    utterances = load_utterances()
+    rss_before = current_rss_mb()
+    load_start = time.perf_counter()
+    nlp = load_pipeline(profile)
+    load_seconds = time.perf_counter() - load_start
+
+    # Warm up so lazy initialisation is not counted against the first message
+    for text in utterances:
+        nlp(text)
+
+    latencies = []
+    for _ in range(rounds):
+        for text in utterances:
+            start = time.perf_counter()
+            nlp(text)
+            latencies.append((time.perf_counter() - start) * 1000)
+    latencies.sort()
+
+    return {
+        'profile': profile,
+        'components': nlp.pipe_names,
+        'messages': len(latencies),
+        'load_seconds': round(load_seconds, 3),
+        'mean_ms': round(statistics.mean(latencies), 3),
+        'p50_ms': round(latencies[len(latencies) // 2], 3),
+        'p95_ms': round(latencies[int(len(latencies) * 0.95) - 1], 3),
+        'rss_mb': round(current_rss_mb(), 1),
+        'model_rss_mb': round(current_rss_mb() - rss_before, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--profiles', nargs='+', default=['full', 'lean'])
+    parser.add_argument('--rounds', type=int, default=10, help='passes over the utterance set per profile')
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(measure_profile(args.worker, args.rounds)))
+        return
+
+    results = []
+    for profile in args.profiles:
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--worker', profile, '--rounds', str(args.rounds)],
+            check=True, capture_output=True, text=True,
+        ).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"{'profile':<8} {'mean ms':>8} {'p50 ms':>8} {'p95 ms':>8} {'load s':>7} {'RSS MB':>8} {'model MB':>9}  components")
+    for result in results:
+        print(
+            f"{result['profile']:<8} {result['mean_ms']:>8} {result['p50_ms']:>8} {result['p95_ms']:>8} "
+            f"{result['load_seconds']:>7} {result['rss_mb']:>8} {result['model_rss_mb']:>9}  {', '.join(result['components'])}"
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,234 @@
+"""
+Benchmarks every stage of the chat message pipeline on a fixed corpus of conversations.
+
+Stages are measured separately, each on the same messages:
+
+    normalization         MessageAnalysis: lowercasing, numerals, punctuation
+    intent_routing        intent_router.route on the normalized text
+    spacy_inference       nlp() on the normalized text
+    item_resolution       noun chunks and menu item lookup (extract_menu_items)
+    modification_parsing  parse_modifications
+    session_update        handlers applied to the session, chat history and session serialization
+    template_render       rendering the chat page with the conversation so far
+    end_to_end            POST / through the Flask test client, session handling included
+
+Results are printed as a table and can be written as JSON. Save a run as a baseline and
+compare later runs against it; the script exits with status 1 when a stage regresses.
+
+    python benchmarks/bench_pipeline.py --rounds 5 --save-baseline benchmarks/baseline.json
+    python benchmarks/bench_pipeline.py --rounds 5 --baseline benchmarks/baseline.json
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+CORPUS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'conversations.json')
+
+STAGES = ['normalization', 'intent_routing', 'spacy_inference', 'item_resolution', 'modification_parsing',
+          'session_update', 'template_render', 'end_to_end']
+
+
+# Function to load the conversation corpus
+def load_conversations(path=CORPUS_PATH):
+    with open(path, encoding='utf-8') as corpus:
+        return json.load(corpus)
+
+
+# Function to compute a nearest-rank percentile of sorted values
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(pct / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+# Function to summarize latencies (in seconds) for one stage
+def summarize(latencies):
+    values = sorted(latencies)
+    total = sum(values)
+    return {
+        'count': len(values),
+        'mean_ms': round(total / len(values) * 1000, 4) if values else 0.0,
+        'p50_ms': round(percentile(values, 50) * 1000, 4),
+        'p95_ms': round(percentile(values, 95) * 1000, 4),
+        'p99_ms': round(percentile(values, 99) * 1000, 4),
+        'throughput_per_s': round(len(values) / total, 1) if total else 0.0,
+    }
+
+
+# Function to time one call and record it for a stage
+def timed(samples, stage, func, *args):
+    start = time.perf_counter()
+    value = func(*args)
+    samples[stage].append(time.perf_counter() - start)
+    return value
+
+
+# Function to measure the in-process stages over every conversation once
+def measure_stages(chatbot, conversations, samples):
+    from session_store import dump_session
+
+    for conversation in conversations:
+        # One request context per conversation, so the session carries over between turns
+        with chatbot.app.test_request_context('/', method='POST'):
+            chatbot.initialize_messages()
+            for turn in conversation['turns']:
+                if isinstance(turn, dict):
+                    def complete():
+                        chatbot.add_message('bot', chatbot.render_result_html(chatbot.handle_complete_order()))
+                        return dump_session(dict(chatbot.session))
+                    timed(samples, 'session_update', complete)
+                    timed(samples, 'template_render', chatbot.render_chat_page)
+                    continue
+
+                analysis = timed(samples, 'normalization', chatbot.MessageAnalysis, turn)
+                timed(samples, 'intent_routing', chatbot.intent_router.route, analysis.plain_text)
+                doc = timed(samples, 'spacy_inference', chatbot.nlp, analysis.text)
+
+                # Fresh analysis around the same Doc so noun chunks are computed inside the timed stage
+                items = timed(samples, 'item_resolution', chatbot.extract_menu_items,
+                              chatbot.MessageAnalysis(turn, doc=doc))
+                timed(samples, 'modification_parsing', chatbot.parse_modifications,
+                      chatbot.MessageAnalysis(turn, doc=doc), items)
+
+                analysis = chatbot.MessageAnalysis(turn, doc=doc)
+                parsed = chatbot.parse_message(analysis)
+
+                def update():
+                    chatbot.add_message('user', turn)
+                    result = chatbot.apply_parsed_message(analysis, parsed)
+                    chatbot.add_message('bot', chatbot.render_result_html(result))
+                    return dump_session(dict(chatbot.session))
+                timed(samples, 'session_update', update)
+                timed(samples, 'template_render', chatbot.render_chat_page)
+
+
+# Function to measure whole requests through the Flask test client
+def measure_end_to_end(chatbot, conversations, samples):
+    for conversation in conversations:
+        client = chatbot.app.test_client()
+        client.get('/')
+        for turn in conversation['turns']:
+            form = {'complete_order': 'Complete Order'} if isinstance(turn, dict) else {'message': turn}
+            start = time.perf_counter()
+            response = client.post('/', data=form)
+            samples['end_to_end'].append(time.perf_counter() - start)
+            if response.status_code != 200:
+                raise SystemExit(f"POST / failed with {response.status_code} on turn {turn!r}")
+
+
+# Function to run the whole benchmark
+def run_benchmark(rounds, warmup, corpus_path):
+    import main as chatbot
+    from menu_index import model_signature
+
+    conversations = load_conversations(corpus_path)
+    for _ in range(warmup):
+        throwaway = {stage: [] for stage in STAGES}
+        measure_stages(chatbot, conversations, throwaway)
+        measure_end_to_end(chatbot, conversations, throwaway)
+
+    samples = {stage: [] for stage in STAGES}
+    for _ in range(rounds):
+        measure_stages(chatbot, conversations, samples)
+        measure_end_to_end(chatbot, conversations, samples)
+
+    return {
+        'meta': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'model': model_signature(chatbot.nlp),
+            'nlp_profile': os.environ.get('CHATBOT_NLP_PROFILE', 'lean'),
+            'session_backend': os.environ.get('CHATBOT_SESSION_BACKEND'),
+            'rounds': rounds,
+            'conversations': len(conversations),
+            'turns': sum(len(conversation['turns']) for conversation in conversations),
+        },
+        'stages': {stage: summarize(samples[stage]) for stage in STAGES},
+    }
+
+
+# Function to find stages that got slower than the baseline
+def find_regressions(results, baseline, tolerance, min_delta_ms, metrics):
+    regressions = []
+    for stage, current in results['stages'].items():
+        previous = baseline.get('stages', {}).get(stage)
+        if not previous:
+            continue
+        for metric in metrics:
+            limit = previous[metric] * (1 + tolerance)
+            if current[metric] > limit and current[metric] - previous[metric] > min_delta_ms:
+                regressions.append((stage, metric, previous[metric], current[metric]))
+    return regressions
+
+
+# Function to print the results table, with the baseline next to it when there is one
+def print_table(results, baseline=None):
+    header = f"{'stage':<22} {'count':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'ops/s':>10}"
+    if baseline:
+        header += f" {'base p50':>9} {'base p95':>9}"
+    print(header)
+    for stage, summary in results['stages'].items():
+        line = (f"{stage:<22} {summary['count']:>6} {summary['p50_ms']:>9.3f} {summary['p95_ms']:>9.3f} "
+                f"{summary['p99_ms']:>9.3f} {summary['throughput_per_s']:>10.1f}")
+        previous = (baseline or {}).get('stages', {}).get(stage)
+        if previous:
+            line += f" {previous['p50_ms']:>9.3f} {previous['p95_ms']:>9.3f}"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rounds', type=int, default=5, help='passes over the corpus to measure')
+    parser.add_argument('--warmup', type=int, default=1, help='passes over the corpus before measuring')
+    parser.add_argument('--corpus', default=CORPUS_PATH, help='conversation corpus (JSON)')
+    parser.add_argument('--session-backend', default='memory', choices=['memory', 'sqlite', 'cookie'])
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--save-baseline', help='write the results as the new baseline to this file')
+    parser.add_argument('--baseline', help='compare against this baseline and fail on regressions')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed slowdown as a fraction of the baseline (default 0.25)')
+    parser.add_argument('--min-delta-ms', type=float, default=0.05,
+                        help='ignore slowdowns smaller than this many milliseconds')
+    parser.add_argument('--metrics', nargs='+', default=['p50_ms', 'p95_ms'], help='metrics to compare')
+    args = parser.parse_args()
+
+    # Configure the app before it is imported
+    os.environ['CHATBOT_SESSION_BACKEND'] = args.session_backend
+    if args.session_backend == 'sqlite':
+        os.environ.setdefault('CHATBOT_SESSION_DB', os.path.join(ROOT, 'bench_sessions.sqlite3'))
+    # Benchmarked orders must not reach the log the kitchen display and analytics read
+    os.environ.setdefault('CHATBOT_ORDER_LOG', os.path.join(ROOT, 'bench_orders.sqlite3'))
+
+    results = run_benchmark(args.rounds, args.warmup, args.corpus)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as baseline_file:
+            baseline = json.load(baseline_file)
+    print_table(results, baseline)
+
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, 'w', encoding='utf-8') as output:
+                json.dump(results, output, indent=2)
+
+    if baseline:
+        regressions = find_regressions(results, baseline, args.tolerance, args.min_delta_ms, args.metrics)
+        for stage, metric, previous, current in regressions:
+            print(f"REGRESSION {stage} {metric}: {previous:.3f} ms -> {current:.3f} ms "
+                  f"(+{(current / previous - 1) * 100 if previous else float('inf'):.0f}%)", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions against {args.baseline} (tolerance {args.tolerance:.0%}).")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+"""
+Checks the spaCy-free fast path against the spaCy parsers on a corpus of messages.
+
+Every order and removal message is parsed twice, once with the fast path and once with
+spaCy, and the items, quantities and modifications must come out the same. The report
+shows how many messages the fast path took, every disagreement, why the others fell back
+to spaCy, and the parse latency of each path. The script exits with status 1 when the
+two paths disagree on any message.
+
+By default the corpus is benchmarks/utterances.txt, the multi-clause orders of
+benchmarks/multi_clause_orders.txt ("a hamburger also fries", "a shake, i want fries"), the
+modifiers next to items of benchmarks/modifier_orders.txt ("no onions cheeseburger", "fries
+extra cheese shakes") and the messages of benchmarks/conversations.json; more files of one
+message per line can be given:
+
+    python benchmarks/check_fast_path.py
+    python benchmarks/check_fast_path.py transcripts.txt --rounds 20
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from collections import Counter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_CORPUS = [os.path.join(BENCHMARKS, 'utterances.txt'), os.path.join(BENCHMARKS, 'multi_clause_orders.txt'),
+                  os.path.join(BENCHMARKS, 'modifier_orders.txt'),
+                  os.path.join(BENCHMARKS, 'conversations.json')]
+
+
+# Function to read messages from a text file (one per line) or a conversations JSON file
+def read_messages(path):
+    with open(path, encoding='utf-8') as corpus:
+        if path.endswith('.json'):
+            return [turn for conversation in json.load(corpus) for turn in conversation['turns']
+                    if isinstance(turn, str)]
+        return [line.strip() for line in corpus if line.strip()]
+
+
+# Function to time a parse of every message, in microseconds per message
+def time_parses(chatbot, messages, fast_path, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for message in messages:
+            chatbot.parse_message(chatbot.MessageAnalysis(message), fast_path=fast_path, cached=False)
+    return (time.perf_counter() - start) / (rounds * len(messages)) * 1e6 if messages else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('corpus', nargs='*', default=DEFAULT_CORPUS, help='message files to check')
+    parser.add_argument('--rounds', type=int, default=10, help='timing rounds over the corpus')
+    args = parser.parse_args()
+
+    # Parsing completes no orders, so don't open the order log
+    os.environ.setdefault('CHATBOT_ORDER_LOG', '')
+    # Import here so --help works without loading the spaCy model
+    import main as chatbot
+
+    messages = []
+    for path in args.corpus:
+        messages.extend(read_messages(path))
+
+    fast_messages, spacy_messages, mismatches = [], [], []
+    declined = Counter()
+    for message in messages:
+        reasons = Counter(chatbot.fast_parser.declined)
+        fast = chatbot.parse_message(chatbot.MessageAnalysis(message), fast_path=True, cached=False)
+        if fast['path'] is None:
+            continue
+        spacy = chatbot.parse_message(chatbot.MessageAnalysis(message), fast_path=False, cached=False)
+        if fast['path'] == 'spacy':
+            spacy_messages.append(message)
+            declined.update(chatbot.fast_parser.declined - reasons)
+            continue
+        fast_messages.append(message)
+        if (fast['items'], fast['modifications']) != (spacy['items'], spacy['modifications']):
+            mismatches.append((message, fast, spacy))
+
+    parsed = len(fast_messages) + len(spacy_messages)
+    print(f"{len(messages)} messages, {parsed} orders or removals")
+    print(f"fast path: {len(fast_messages)} ({len(fast_messages) / parsed:.0%})" if parsed else "fast path: 0")
+    for reason, count in declined.most_common():
+        print(f"  fell back to spaCy ({reason}): {count}")
+    for message, fast, spacy in mismatches:
+        print(f"MISMATCH {message!r}")
+        print(f"  fast:  {fast['items']} {fast['modifications']}")
+        print(f"  spacy: {spacy['items']} {spacy['modifications']}")
+
+    print(f"{'messages':<28} {'fast path us':>12} {'spaCy us':>10}")
+    print(f"{'taken by the fast path':<28} {time_parses(chatbot, fast_messages, True, args.rounds):12.1f} "
+          f"{time_parses(chatbot, fast_messages, False, args.rounds):10.1f}")
+    print(f"{'left to spaCy':<28} {time_parses(chatbot, spacy_messages, True, args.rounds):12.1f} "
+          f"{time_parses(chatbot, spacy_messages, False, args.rounds):10.1f}")
+
+    if mismatches:
+        print(f"{len(mismatches)} message(s) parsed differently by the fast path")
+        sys.exit(1)
+    print("The fast path agrees with spaCy on every message it took.")
+
+
+if __name__ == '__main__':
+    main()
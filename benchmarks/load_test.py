@@ -0,0 +1,343 @@
+"""
+Load test: simulated customers holding multi-turn ordering conversations with the chatbot.
+
+Each virtual customer keeps its own cookies and holds one conversation after another, pausing
+for a random think time between turns. Conversations are either the scripted ones from
+benchmarks/conversations.json or randomized ones built from the menu CSV: add items, modify
+them, ask about ingredients, remove something, then complete the order. Requests go to the
+cookie-based chat form (POST /), like a browser would, or with --incremental to POST
+/chat/messages, which answers with only the new messages like the chat page's script.
+
+The customers run in-process against the Flask app (the default) or against a running server
+with --url. Only the standard library is used for HTTP, so the test runs fully offline.
+The report shows throughput, latency percentiles by kind of turn, error rates, and how the
+session grows with each turn. Give several customer counts to step the load up and see where
+the tail latency gives out:
+
+    python benchmarks/load_test.py --customers 8 --duration 30
+    python benchmarks/load_test.py --customers 1 4 16 64 --duration 20 --think-time 0.5
+    python serve.py --workers 4 &   # start it with CHATBOT_TIMING_HEADER=1 for session sizes
+    python benchmarks/load_test.py --url http://127.0.0.1:8000 --customers 50 --think-time 1
+"""
+import argparse
+import csv
+import http.cookiejar
+import json
+import os
+import random
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import defaultdict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench_pipeline import CORPUS_PATH, load_conversations, percentile  # noqa: E402
+
+MENU_CSV_PATH = os.path.join(ROOT, 'In N Out Menu.csv')
+
+# Header the app sends the saved session size in when CHATBOT_TIMING_HEADER=1
+SESSION_SIZE_HEADER = 'X-Session-Bytes'
+
+QUANTITY_WORDS = ['a', 'one', 'two', 'three', '2', '4']
+
+
+class InProcessCustomer:
+    """
+    One customer talking to the app through its own Flask test client (and cookie jar).
+    """
+
+    def __init__(self, app, path='/'):
+        self.client = app.test_client()
+        self.path = path
+
+    def request(self, form=None):
+        response = self.client.post(self.path, data=form) if form else self.client.get('/')
+        size = response.headers.get(SESSION_SIZE_HEADER)
+        return response.status_code, int(size) if size else None
+
+
+class HTTPCustomer:
+    """
+    One customer talking to a running server over HTTP, with its own cookie jar.
+    """
+
+    def __init__(self, url, path='/', timeout=30):
+        self.url = url.rstrip('/') + '/'
+        self.post_url = url.rstrip('/') + path
+        self.timeout = timeout
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+
+    def request(self, form=None):
+        data = urllib.parse.urlencode(form).encode('utf-8') if form else None
+        try:
+            with self.opener.open(self.post_url if data else self.url, data=data, timeout=self.timeout) as response:
+                response.read()
+                status, headers = response.status, response.headers
+        except urllib.error.HTTPError as error:
+            error.read()
+            status, headers = error.code, error.headers
+        size = headers.get(SESSION_SIZE_HEADER)
+        return status, int(size) if size else None
+
+
+# Function to read menu items and their ingredients from the menu CSV
+def load_menu(path=MENU_CSV_PATH):
+    menu = []
+    with open(path, encoding='utf-8', newline='') as menu_file:
+        for row in csv.DictReader(menu_file):
+            ingredients = [ingredient.strip().lower() for ingredient in row['Ingredients'].split(',')]
+            menu.append((row['Menu Item'].lower().replace('-', ' '), ingredients))
+    return menu
+
+
+# Function to write an item with a quantity the way customers do
+def quantity_phrase(rng, item):
+    quantity = rng.choice(QUANTITY_WORDS)
+    if quantity not in ('a', 'one') and not item.endswith('s'):
+        item += 's'
+    return f"{quantity} {item}"
+
+
+# Function to build a randomized conversation as (kind, turn) pairs
+def random_conversation(rng, menu):
+    """
+    Adds one to three items, maybe modifies one, asks about ingredients, maybe asks for the
+    menu or removes an item, and completes the order.
+    """
+    turns = []
+    ordered = []
+    for _ in range(rng.randint(1, 3)):
+        item, ingredients = rng.choice(menu)
+        ordered.append((item, ingredients))
+        turns.append(('add', rng.choice(["{}", "can I get {}", "I'd like {} please"]).format(quantity_phrase(rng, item))))
+    if rng.random() < 0.6:
+        item, ingredients = rng.choice(ordered)
+        ingredient = rng.choice(ingredients)
+        turns.append(('modify', rng.choice([f"a {item} with no {ingredient}", f"a {item} with extra {ingredient}"])))
+    item, ingredients = rng.choice(menu)
+    turns.append(('ask', rng.choice([f"what is in the {item}", f"does the {item} have {rng.choice(ingredients)}",
+                                     f"what has no {rng.choice(ingredients)}"])))
+    if rng.random() < 0.2:
+        turns.append(('menu', "show me the menu"))
+    if rng.random() < 0.4:
+        turns.append(('remove', f"remove one {rng.choice(ordered)[0]}"))
+    turns.append(('complete', {'action': 'complete_order'}))
+    return turns
+
+
+# Function to label the turns of a scripted conversation
+def scripted_conversation(conversation):
+    return [('complete' if isinstance(turn, dict) else 'scripted', turn) for turn in conversation['turns']]
+
+
+class LoadTest:
+    """
+    Runs customers concurrently and collects one record per request:
+    (kind, seconds, status, session bytes, turn number of the customer, error).
+    """
+
+    def __init__(self, make_customer, menu, scripted, scripted_share, think_time, seed):
+        self.make_customer = make_customer
+        self.menu = menu
+        self.scripted = scripted
+        self.scripted_share = scripted_share
+        self.think_time = think_time
+        self.seed = seed
+        self.records = []
+        self.conversations = 0
+        self._lock = threading.Lock()
+
+    def run(self, customers, duration, ramp_up=0.0, max_conversations=None):
+        self.records = []
+        self.conversations = 0
+        deadline = time.monotonic() + duration
+        threads = []
+        for number in range(customers):
+            delay = ramp_up * number / customers if customers else 0
+            thread = threading.Thread(target=self._customer, args=(number, delay, deadline, max_conversations),
+                                      name=f"customer-{number}", daemon=True)
+            threads.append(thread)
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.perf_counter() - start
+
+    def _customer(self, number, delay, deadline, max_conversations):
+        rng = random.Random(f"{self.seed}-{number}")
+        time.sleep(delay)
+        customer = self.make_customer()
+        turn_number = 0
+        self._send(customer, 'open', None, turn_number)
+        held = 0
+        while time.monotonic() < deadline and (max_conversations is None or held < max_conversations):
+            if self.scripted and rng.random() < self.scripted_share:
+                conversation = scripted_conversation(rng.choice(self.scripted))
+            else:
+                conversation = random_conversation(rng, self.menu)
+            for kind, turn in conversation:
+                if time.monotonic() >= deadline:
+                    return
+                if self.think_time:
+                    time.sleep(min(rng.expovariate(1 / self.think_time), self.think_time * 5))
+                turn_number += 1
+                if isinstance(turn, dict):
+                    self._send(customer, kind, {'complete_order': 'Complete Order'}, turn_number)
+                else:
+                    self._send(customer, kind, {'message': turn}, turn_number)
+            held += 1
+            with self._lock:
+                self.conversations += 1
+
+    def _send(self, customer, kind, form, turn_number):
+        start = time.perf_counter()
+        try:
+            status, size = customer.request(form)
+            error = None
+        except Exception as exception:
+            status, size, error = None, None, type(exception).__name__
+        record = (kind, time.perf_counter() - start, status, size, turn_number, error)
+        with self._lock:
+            self.records.append(record)
+
+
+# Function to summarize latencies in milliseconds
+def latency_summary(seconds):
+    values = sorted(seconds)
+    return {
+        'count': len(values),
+        'p50_ms': round(percentile(values, 50) * 1000, 2),
+        'p90_ms': round(percentile(values, 90) * 1000, 2),
+        'p95_ms': round(percentile(values, 95) * 1000, 2),
+        'p99_ms': round(percentile(values, 99) * 1000, 2),
+        'max_ms': round(values[-1] * 1000, 2) if values else 0.0,
+    }
+
+
+# Function to summarize one run of the load test
+def summarize_run(records, elapsed, customers, conversations):
+    by_kind = defaultdict(list)
+    for kind, seconds, status, size, turn_number, error in records:
+        by_kind[kind].append(seconds)
+    failed = [record for record in records if record[5] or record[2] is None or record[2] >= 400]
+    busy = [record for record in records if record[2] == 503]
+    errors = defaultdict(int)
+    for kind, seconds, status, size, turn_number, error in failed:
+        errors[error or str(status)] += 1
+
+    session_bytes = defaultdict(list)
+    for kind, seconds, status, size, turn_number, error in records:
+        if size is not None:
+            session_bytes[turn_number].append(size)
+
+    return {
+        'customers': customers,
+        'seconds': round(elapsed, 2),
+        'requests': len(records),
+        'requests_per_s': round(len(records) / elapsed, 1) if elapsed else 0.0,
+        'conversations': conversations,
+        'conversations_per_s': round(conversations / elapsed, 2) if elapsed else 0.0,
+        'error_rate': round(len(failed) / len(records), 4) if records else 0.0,
+        'errors': dict(errors),
+        'busy_503': len(busy),
+        'latency': latency_summary([record[1] for record in records]),
+        'latency_by_kind': {kind: latency_summary(values) for kind, values in sorted(by_kind.items())},
+        'session_bytes_by_turn': {
+            turn_number: {'p50': percentile(sorted(sizes), 50), 'max': max(sizes), 'count': len(sizes)}
+            for turn_number, sizes in sorted(session_bytes.items())
+        },
+    }
+
+
+# Function to print the report of one run
+def print_run(summary, growth_step):
+    print(f"\n== {summary['customers']} customer(s), {summary['seconds']} s: {summary['requests']} requests "
+          f"({summary['requests_per_s']}/s), {summary['conversations']} conversations "
+          f"({summary['conversations_per_s']}/s)")
+    errors = ', '.join(f"{name}: {count}" for name, count in summary['errors'].items()) or 'none'
+    print(f"errors {summary['error_rate']:.2%} ({errors}); busy (503): {summary['busy_503']}")
+    print(f"{'kind':<10} {'count':>7} {'p50 ms':>8} {'p90 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for kind, latency in [('all', summary['latency'])] + list(summary['latency_by_kind'].items()):
+        print(f"{kind:<10} {latency['count']:>7} {latency['p50_ms']:>8.2f} {latency['p90_ms']:>8.2f} "
+              f"{latency['p95_ms']:>8.2f} {latency['p99_ms']:>8.2f} {latency['max_ms']:>8.2f}")
+    growth = summary['session_bytes_by_turn']
+    if not growth:
+        print("session size: not reported (run the server with CHATBOT_TIMING_HEADER=1)")
+        return
+    print(f"{'turn':<10} {'session p50 B':>14} {'max B':>8} {'samples':>8}")
+    turns = sorted(growth)
+    # Long runs get a wider step so the table stays around 20 rows
+    step = max(growth_step, -(-turns[-1] // 20))
+    for turn_number in turns:
+        if turn_number in (turns[0], turns[-1]) or turn_number % step == 0:
+            sizes = growth[turn_number]
+            print(f"{turn_number:<10} {sizes['p50']:>14} {sizes['max']:>8} {sizes['count']:>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', help='base URL of a running server (default: run the app in-process)')
+    parser.add_argument('--customers', nargs='+', type=int, default=[8],
+                        help='concurrent customers; several values run one step each')
+    parser.add_argument('--duration', type=float, default=30, help='seconds per step')
+    parser.add_argument('--conversations', type=int, help='stop each customer after this many conversations')
+    parser.add_argument('--think-time', type=float, default=0.0, help='mean seconds a customer waits between turns')
+    parser.add_argument('--ramp-up', type=float, default=0.0, help='seconds over which the customers start')
+    parser.add_argument('--scripted-share', type=float, default=0.3,
+                        help='fraction of conversations taken from the scripted corpus')
+    parser.add_argument('--incremental', action='store_true',
+                        help='send turns to /chat/messages, which returns only the new messages')
+    parser.add_argument('--corpus', default=CORPUS_PATH, help='scripted conversations (JSON)')
+    parser.add_argument('--session-backend', default='memory', choices=['memory', 'sqlite', 'cookie'],
+                        help='session backend of the in-process app')
+    parser.add_argument('--growth-step', type=int, default=5, help='show the session size at least every this many turns')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    args = parser.parse_args()
+
+    path = '/chat/messages' if args.incremental else '/'
+    if args.url:
+        def make_customer():
+            return HTTPCustomer(args.url, path)
+    else:
+        # Configure the app before it is imported; the size header lets the report follow session growth
+        os.environ['CHATBOT_SESSION_BACKEND'] = args.session_backend
+        os.environ['CHATBOT_TIMING_HEADER'] = '1'
+        if args.session_backend == 'sqlite':
+            os.environ.setdefault('CHATBOT_SESSION_DB', os.path.join(ROOT, 'bench_sessions.sqlite3'))
+        # Simulated orders must not reach the log the kitchen display and analytics read
+        os.environ.setdefault('CHATBOT_ORDER_LOG', os.path.join(ROOT, 'bench_orders.sqlite3'))
+        import main as chatbot
+
+        def make_customer():
+            return InProcessCustomer(chatbot.app, path)
+
+    test = LoadTest(make_customer, load_menu(), load_conversations(args.corpus), args.scripted_share,
+                    args.think_time, args.seed)
+    results = []
+    for customers in args.customers:
+        elapsed = test.run(customers, args.duration, args.ramp_up, args.conversations)
+        summary = summarize_run(test.records, elapsed, customers, test.conversations)
+        results.append(summary)
+        print_run(summary, args.growth_step)
+
+    if len(results) > 1:
+        print(f"\n{'customers':>9} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>8}")
+        for summary in results:
+            latency = summary['latency']
+            print(f"{summary['customers']:>9} {summary['requests_per_s']:>8} {latency['p50_ms']:>8.2f} "
+                  f"{latency['p95_ms']:>8.2f} {latency['p99_ms']:>8.2f} {summary['error_rate']:>8.2%}")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as output:
+            json.dump({'target': args.url or 'in-process', 'steps': results}, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
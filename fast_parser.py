@@ -0,0 +1,243 @@
+"""
+Rule-based parsing of short orders without spaCy.
+
+Most messages only use menu words, quantity words and the modifier words the order parser
+already knows ("two cheeseburgers and a large drink", "no onions", "remove the fries").
+MenuVocabulary, built with every menu snapshot, knows the lemma of each word in the item
+names, aliases and ingredients (and their plurals) and which of those words end a phrase,
+which is where spaCy sees a noun. FastParser finds the same items, quantities and
+modifications as the noun-chunk parser and parse_modifications for messages made only of
+such words. As soon as it meets an unknown word, or a structure where spaCy's tagging could
+go either way, it declines and the caller parses the message with spaCy as before.
+"""
+import re
+from collections import Counter, namedtuple
+
+# Words, plus each punctuation character as a token of its own
+WORD_PATTERN = re.compile(r"[a-z0-9]+|[^\sa-z0-9]")
+
+# Punctuation that only ever separates phrases
+SEPARATORS = {',', '.', '!', '?'}
+
+# Modifier words spaCy keeps inside the noun chunk that follows them ('no onions',
+# 'extra cheese'), so that chunk never resolves to a menu item
+CHUNK_MODIFIERS = {'no', 'extra'}
+
+# Modifier words whose tagging is predictable; messages with others, such as 'nos', go to spaCy
+KNOWN_MODIFIERS = CHUNK_MODIFIERS | {'with', 'without', 'add'}
+
+# Words that carry no item information and are never tagged as nouns
+FILLER_WORDS = {
+    'i', 'id', 'ill', 'im', 'me', 'would', 'like', 'want', 'wanna', 'can', 'could', 'may', 'get', 'give', 'please',
+    'and', 'also', 'to', 'have', 'take', 'need', 'just', 'remove', 'delete', 'cancel', 'discard', 'dont', 'from',
+}
+
+# Words that are verbs. In a message with no verb before its first item, spaCy makes
+# that item the root and the words before it ('please', 'and', 'with') join its noun chunk.
+VERB_WORDS = {'would', 'like', 'want', 'wanna', 'can', 'could', 'may', 'get', 'give', 'have', 'take', 'need',
+              'remove', 'delete', 'cancel', 'discard', 'dont', 'add'}
+
+# Words that may open a verbless message before its first item: 'two', 'no', 'an extra'
+CHUNK_PREFIXES = (['num'], ['chunk'], ['num', 'chunk'])
+
+# One word of a message: its kind ('num', 'mod', 'menu', 'filler' or 'sep'), text and lemma
+Token = namedtuple('Token', ['kind', 'word', 'lemma'])
+
+
+# Function to list the plural spellings of a word
+def _plurals(word):
+    plurals = {word + 's', word + 'es'}
+    if word.endswith('y'):
+        plurals.add(word[:-1] + 'ies')
+    return plurals
+
+
+class MenuVocabulary:
+    """
+    The words of one menu version: the lemma of each word found in item names, aliases and
+    ingredients, which lemmas end a phrase (the nouns), the ingredient phrases, and the set
+    of all those words.
+    Words that would need different lemmas in different phrases are left out, so messages
+    using them go to spaCy.
+    """
+
+    def __init__(self, index):
+        self.lemmas = {}
+        self.heads = set()
+        self.ingredients = set()
+        ambiguous = set()
+
+        for entry in index['items']:
+            self.ingredients.update(entry['ingredients'])
+        for phrase, lemma in index['lemmas'].items():
+            words, lemma_words = phrase.split(), lemma.split()
+            if not words or len(words) != len(lemma_words):
+                continue
+            self.heads.add(lemma_words[-1])
+            for word, word_lemma in zip(words + lemma_words, lemma_words + lemma_words):
+                if self.lemmas.setdefault(word, word_lemma) != word_lemma:
+                    ambiguous.add(word)
+        # Plurals of the lemmas, unless the menu already uses that spelling for something else
+        for word_lemma in set(self.lemmas.values()):
+            for plural in _plurals(word_lemma):
+                self.lemmas.setdefault(plural, word_lemma)
+        # Every word the menu uses, including the ambiguous ones left out of lemmas
+        self.words = set(self.lemmas)
+        for word in ambiguous:
+            del self.lemmas[word]
+
+    def is_noun(self, lemma):
+        # Brand names with digits ('7up') may be tagged as numbers
+        return lemma in self.heads and not any(char.isdigit() for char in lemma)
+
+
+class FastParser:
+    """
+    Parses a normalized message into (items, modifications) like the spaCy parsers, or
+    returns None when the message needs spaCy. quantities maps quantity words to numbers,
+    and remove_words and add_words are the modifier words of parse_modifications.
+
+    declined counts the reasons messages were handed back to spaCy.
+    """
+
+    def __init__(self, quantities, remove_words, add_words, filler_words=FILLER_WORDS):
+        self.quantities = quantities
+        self.actions = {}
+        for word in remove_words:
+            self.actions[word] = 'remove'
+        for word in add_words:
+            self.actions[word] = 'add'
+        self.filler_words = filler_words
+        self.declined = Counter()
+
+    def tokenize(self, text, vocabulary):
+        """
+        Returns the message as Tokens, or None when it has a word the fast path doesn't know.
+        """
+        tokens = []
+        for word in WORD_PATTERN.findall(text.replace("'", '')):
+            if word in SEPARATORS:
+                tokens.append(Token('sep', word, word))
+            elif word in self.quantities or word.isdigit():
+                tokens.append(Token('num', word, word))
+            elif word in self.actions:
+                if word not in KNOWN_MODIFIERS:
+                    return None
+                tokens.append(Token('mod', word, word))
+            elif word in vocabulary.lemmas:
+                tokens.append(Token('menu', word, vocabulary.lemmas[word]))
+            elif word in self.filler_words:
+                tokens.append(Token('filler', word, word))
+            else:
+                return None
+        return tokens
+
+    def parse(self, text, menu):
+        """
+        Returns (items, modifications) for a normalized message, with items as (item, quantity)
+        pairs and modifications as {item: {'add': [...], 'remove': [...]}}, or None.
+        """
+        vocabulary = menu.vocabulary
+        tokens = self.tokenize(text, vocabulary)
+        if tokens is None:
+            return self._decline('unknown_word')
+        if not self._chunks_start_cleanly(tokens):
+            return self._decline('ambiguous')
+
+        items = []
+        changes = []
+        position = 0
+        while position < len(tokens):
+            token = tokens[position]
+            if token.kind == 'mod':
+                # parse_modifications takes the next word when spaCy tagged it as a noun
+                following = tokens[position + 1] if position + 1 < len(tokens) else None
+                if following is not None and following.kind == 'menu':
+                    if not vocabulary.is_noun(following.lemma):
+                        return self._decline('ambiguous')
+                    changes.append((self.actions[token.word], following.lemma))
+                position += 1
+                continue
+            if token.kind not in ('num', 'menu'):
+                position += 1
+                continue
+
+            # A noun chunk: an optional quantity word, then a run of menu words
+            start = position
+            quantity = 1
+            if token.kind == 'num':
+                # A quantity that doesn't lead into an item may be chunked with something later
+                following = tokens[position + 1] if position + 1 < len(tokens) else None
+                if following is None or (following.kind != 'menu' and following.word not in CHUNK_MODIFIERS):
+                    return self._decline('ambiguous')
+                quantity = self.quantities[token.word] if token.word in self.quantities else int(token.word)
+                position += 1
+            run = []
+            while position < len(tokens) and tokens[position].kind == 'menu':
+                # A word that can't be a noun after one that can starts a new chunk ('milk french fries')
+                if run and vocabulary.is_noun(run[-1]) and not vocabulary.is_noun(tokens[position].lemma):
+                    return self._decline('ambiguous')
+                run.append(tokens[position].lemma)
+                position += 1
+            if not run:
+                continue
+            # A number inside a name ('number one meal') or a run that doesn't end in a noun
+            # could be chunked either way
+            if position < len(tokens) and tokens[position].kind == 'num':
+                return self._decline('ambiguous')
+            if not vocabulary.is_noun(run[-1]):
+                return self._decline('ambiguous')
+            if start > 0 and tokens[start - 1].word in CHUNK_MODIFIERS:
+                # spaCy falls back to the head noun of 'no onions cheeseburger' when it names an item
+                if token.kind == 'num' or (len(run) > 1 and menu.phrase_index.resolve_exact(run[-1:])):
+                    return self._decline('ambiguous')
+                continue
+            item = menu.phrase_index.resolve(run)
+            if item:
+                items.append((item, quantity))
+            elif ' '.join(run) not in vocabulary.ingredients:
+                return self._decline('ambiguous')
+
+        # Like parse_modifications, every modification goes to the last item of the message
+        modifications = {}
+        if items:
+            last_item = items[-1][0]
+            for action, ingredient in changes:
+                modifications.setdefault(last_item, {}).setdefault(action, []).append(ingredient)
+        return items, modifications
+
+    def _chunks_start_cleanly(self, tokens):
+        """
+        Checks the words before every run of menu words. Before the first run of a sentence
+        they must include a verb or be only a quantity and a chunk modifier ('an extra'),
+        which belong to the first noun chunk anyway. Between runs, 'also' or a verb clause
+        not set off by a comma or 'and' ('a hamburger also fries', 'a shake i want fries')
+        makes spaCy attach the chunks in ways the fast path can't predict.
+        """
+        gap = []
+        first = True
+        for token in tokens:
+            if token.word in ('.', '!', '?'):
+                gap = []
+                first = True
+            elif token.kind != 'menu':
+                gap.append(token)
+            else:
+                if first:
+                    shape = ['chunk' if word in CHUNK_MODIFIERS else kind for kind, word, _ in gap]
+                    if gap and shape not in CHUNK_PREFIXES and not any(word in VERB_WORDS for _, word, _ in gap):
+                        return False
+                elif gap:
+                    words = [word for _, word, _ in gap]
+                    if 'also' in words:
+                        return False
+                    has_verb = any(kind == 'filler' and word in VERB_WORDS for kind, word, _ in gap)
+                    if has_verb and words[0] not in (',', 'and'):
+                        return False
+                gap = []
+                first = False
+        return True
+
+    def _decline(self, reason):
+        self.declined[reason] += 1
+        return None
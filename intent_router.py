@@ -0,0 +1,80 @@
+import re
+from collections import Counter, namedtuple
+
+# Result of routing a message: the intent, the phrase that fired and its (start, end) span.
+# rule and span are None when no phrase matched and the default intent was used.
+IntentMatch = namedtuple('IntentMatch', ['intent', 'rule', 'span'])
+
+
+# Function to build a regex alternation shaped like a character trie over the phrases
+def _trie_pattern(phrases):
+    trie = {}
+    for phrase in phrases:
+        node = trie
+        for char in phrase:
+            node = node.setdefault(char, {})
+        # The empty key marks the end of a phrase
+        node[''] = {}
+    return _node_pattern(trie)
+
+
+def _node_pattern(node):
+    alternatives = [re.escape(char) + _node_pattern(child) for char, child in sorted(node.items()) if char]
+    if not alternatives:
+        return ''
+    ends_here = '' in node
+    if len(alternatives) == 1 and not ends_here:
+        return alternatives[0]
+    group = '(?:' + '|'.join(alternatives) + ')'
+    # Greedy '?' tries the longer phrase first, so each position reports its longest phrase
+    return group + '?' if ends_here else group
+
+
+class IntentRouter:
+    """
+    Routes a message to an intent using one regular expression compiled at startup.
+
+    rules is a list of (intent, phrases) pairs in priority order. A phrase fires when it
+    appears anywhere in the message, and when phrases from several intents appear the
+    intent listed first wins. Because the phrases are compiled into a single trie-shaped
+    pattern, routing cost depends on the message length, not on the number of phrases.
+    """
+
+    def __init__(self, rules, default_intent):
+        self.default_intent = default_intent
+        # Number of times each (intent, phrase) rule decided a message
+        self.hits = Counter()
+
+        self._rules = {}
+        for priority, (intent, phrases) in enumerate(rules):
+            for phrase in phrases:
+                self._rules.setdefault(phrase, (priority, intent))
+
+        # The pattern reports only the longest phrase at each position, so precompute which
+        # rule should fire for it when a shorter phrase starting there has a higher priority
+        self._best_rule = {}
+        for phrase in self._rules:
+            prefixes = [phrase[:end] for end in range(1, len(phrase) + 1) if phrase[:end] in self._rules]
+            self._best_rule[phrase] = min(prefixes, key=lambda prefix: self._rules[prefix][0])
+
+        # The lookahead makes matches zero-width, so phrases that overlap are all found
+        self._pattern = re.compile('(?=(' + _trie_pattern(self._rules) + '))') if self._rules else None
+
+    def route(self, text):
+        best = None
+        if self._pattern is not None:
+            for match in self._pattern.finditer(text):
+                rule = self._best_rule[match.group(1)]
+                priority = self._rules[rule][0]
+                if best is None or priority < best[0]:
+                    best = (priority, rule, match.start())
+                    if priority == 0:
+                        break
+
+        if best is None:
+            return IntentMatch(self.default_intent, None, None)
+
+        priority, rule, start = best
+        intent = self._rules[rule][1]
+        self.hits[(intent, rule)] += 1
+        return IntentMatch(intent, rule, (start, start + len(rule)))
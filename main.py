@@ -1,50 +1,258 @@
-rom flask import Flask, request, render_template_string, session, redirect, url_for
-import spacy
-import pandas as pd
+from flask import Flask, Blueprint, request, render_template, session, redirect, url_for, g, has_request_context, jsonify, abort, current_app
+import atexit
+import logging
+import os
 import re
+import threading
+import time
 
-app = Flask(__name__)
-app.secret_key = 'secure_secret_key'
-
-# Load the spaCy model for NLP processing
-nlp = spacy.load('en_core_web_sm')
-
-# Load menu data from the CSV file
-menu_data = pd.read_csv('In N Out Menu.csv')
-
-# Normalize menu items: convert to lowercase and replace hyphens with spaces
-menu_data['Menu Item'] = menu_data['Menu Item'].str.lower().str.replace('-', ' ', regex=False)
-
-# Replace specific items for consistency
-menu_data['Menu Item'] = menu_data['Menu Item'].replace({
-    'cheese burger': 'cheeseburger',
-    'shakes': 'shake',
-    'number 1 meal': 'number one meal',
-    'number 2 meal': 'number two meal',
-    'number 3 meal': 'number three meal',
-})
-
-menu_dict = dict(zip(menu_data['Menu Item'], menu_data['Price']))
-
-# Create a mapping of lemmatized menu items to their original names
-lemmatized_menu_items = {}
-for item in menu_dict.keys():
-    item_doc = nlp(item)
-    lemmatized_item = ' '.join([token.lemma_ for token in item_doc])
-    lemmatized_menu_items[lemmatized_item] = item
-
-# Create a dictionary mapping menu items to their ingredients
-ingredients_dict = {}
-for index, row in menu_data.iterrows():
-    item = row['Menu Item']
-    ingredients = [ingredient.strip().lower() for ingredient in row['Ingredients'].split(',')]
-    # Lemmatize each ingredient for consistency
-    lemmatized_ingredients = []
-    for ingredient in ingredients:
-        doc = nlp(ingredient)
-        lemmatized = ' '.join([token.lemma_ for token in doc])
-        lemmatized_ingredients.append(lemmatized)
-    ingredients_dict[item] = lemmatized_ingredients
+from fast_parser import FastParser
+from intent_router import IntentRouter
+from menu_reload import MenuManager
+from metrics import NULL_STAGE, MetricsRegistry, RequestTimer, process_memory
+from nlp_pipeline import load_pipeline
+from nlp_workers import BatchingNLPPool, NLPOverloadedError
+from order_log import OrderLog, OrderLogReader
+from order_model import Order, OrderCache, format_cents, to_cents
+from parse_cache import ParseCache, SQLiteParseStore
+from profiler import SamplingProfiler
+from response_cache import ResponseCache
+from session_store import ObservedSessionInterface, create_session_interface
+from store_menus import StoreMenus
+
+# Routes and request hooks of the chatbot; create_app() registers them on a Flask app
+chatbot = Blueprint('chatbot', __name__)
+
+# Keep sessions on the server so the cookie only carries an ID.
+# CHATBOT_SESSION_BACKEND is 'sqlite' (default), 'memory' or 'cookie' for Flask's signed cookie session.
+SESSION_BACKEND = os.environ.get('CHATBOT_SESSION_BACKEND', 'sqlite')
+SESSION_DB = os.environ.get('CHATBOT_SESSION_DB', 'sessions.sqlite3')
+
+# Time each stage of every request and serve the numbers from /metrics (CHATBOT_METRICS=0 turns it off)
+METRICS_ENABLED = os.environ.get('CHATBOT_METRICS', '1') == '1'
+# Send each request's stage timings back in a Server-Timing response header, and the size of the
+# saved session in X-Session-Bytes
+TIMING_HEADER = os.environ.get('CHATBOT_TIMING_HEADER', '0') == '1'
+
+metrics = MetricsRegistry()
+metrics.describe('chatbot_request_seconds', 'histogram', 'Time spent handling a request, by endpoint')
+metrics.describe('chatbot_stage_seconds', 'histogram', 'Exclusive time spent in each stage of a request')
+metrics.describe('chatbot_intents_total', 'counter', 'Chat messages handled, by intent')
+metrics.describe('chatbot_intent_rule_hits_total', 'counter', 'Intent router matches, by intent and matched phrase')
+metrics.describe('chatbot_parse_misses_total', 'counter', 'Replies saying no menu item could be found, by reason')
+metrics.describe('chatbot_session_bytes', 'gauge', 'Size of the most recently saved session')
+metrics.describe('chatbot_session_bytes_max', 'gauge', 'Largest session saved by this worker')
+metrics.describe('chatbot_process_memory_bytes', 'gauge',
+                 'Memory of this worker from /proc smaps_rollup: rss, pss, unique (private) and shared')
+metrics.add_collector(lambda: [
+    ('chatbot_process_memory_bytes', {'kind': kind}, value) for kind, value in (process_memory() or {}).items()
+])
+
+# Events that mean the parser couldn't find what the customer was talking about
+PARSE_MISS_EVENTS = ('no_items_found', 'no_items_to_remove', 'item_not_identified', 'ingredient_not_identified')
+
+# Function to record the time and size of a session save
+def record_session_save(seconds, size):
+    timer = g.get('timer')
+    if timer is not None:
+        timer.add('session', seconds)
+    if size is not None:
+        metrics.set('chatbot_session_bytes', size)
+        metrics.set_max('chatbot_session_bytes_max', size)
+
+# Sampling profiler for live traffic. CHATBOT_PROFILE_RATE > 0 profiles that fraction of requests from
+# startup (for CHATBOT_PROFILE_SECONDS, or until exit); the admin endpoints turn it on and off at runtime.
+profiler = SamplingProfiler(
+    interval=float(os.environ.get('CHATBOT_PROFILE_INTERVAL_MS', '5')) / 1000,
+    output_path=os.environ.get('CHATBOT_PROFILE_OUTPUT', 'profile.collapsed'),
+)
+PROFILE_RATE = float(os.environ.get('CHATBOT_PROFILE_RATE', '0'))
+if PROFILE_RATE > 0:
+    profiler.start(PROFILE_RATE, seconds=float(os.environ.get('CHATBOT_PROFILE_SECONDS', '0')) or None)
+    atexit.register(profiler.write)
+
+# Maximum number of chat messages kept in a session; older ones are dropped first
+MAX_HISTORY = int(os.environ.get('CHATBOT_HISTORY_LIMIT', '50'))
+# Whether to keep a count of dropped messages so the chat can say how many are hidden
+COMPACT_HISTORY = os.environ.get('CHATBOT_HISTORY_COMPACT', '1') == '1'
+# Whether the chat page sends messages in the background and appends only the new ones
+# (CHATBOT_INCREMENTAL_UI=0 goes back to a full page reload per message)
+INCREMENTAL_UI = os.environ.get('CHATBOT_INCREMENTAL_UI', '1') == '1'
+
+# Load the spaCy model for NLP processing, keeping only the components the chatbot uses
+# (set CHATBOT_NLP_PROFILE=full to load every component)
+nlp = load_pipeline()
+
+# Run spaCy on a pool of worker processes that parse concurrent messages in small batches
+# (CHATBOT_NLP_WORKERS > 0). With the default of 0 each request calls nlp itself.
+NLP_WORKERS = int(os.environ.get('CHATBOT_NLP_WORKERS', '0'))
+nlp_pool = None
+nlp_pool_lock = threading.Lock()
+
+# Function to get the NLP worker pool, starting it on first use
+def get_nlp_pool():
+    """
+    The pool is started lazily so worker processes, which import this module again when
+    the app runs as a script, never start pools of their own.
+    """
+    global nlp_pool
+    if nlp_pool is None:
+        with nlp_pool_lock:
+            if nlp_pool is None:
+                nlp_pool = BatchingNLPPool(
+                    nlp.vocab,
+                    workers=NLP_WORKERS,
+                    batch_window=float(os.environ.get('CHATBOT_NLP_BATCH_WINDOW_MS', '5')) / 1000,
+                    batch_size=int(os.environ.get('CHATBOT_NLP_BATCH_SIZE', '32')),
+                    max_queue=int(os.environ.get('CHATBOT_NLP_QUEUE_SIZE', '256')),
+                )
+                atexit.register(nlp_pool.close)
+    return nlp_pool
+
+# Load the lemmatized menu index, rebuilding it only when the menu CSV or the model changed.
+# The menu manager can swap in a new menu at runtime without restarting the worker.
+MENU_CSV_PATH = 'In N Out Menu.csv'
+menu_manager = MenuManager(MENU_CSV_PATH, nlp)
+
+# Reload the menu automatically when the CSV changes (polling interval in seconds, 0 disables it)
+MENU_WATCH_INTERVAL = float(os.environ.get('CHATBOT_MENU_WATCH_INTERVAL', '0'))
+
+# Menus of individual stores: the base menu with the overlay CSV in CHATBOT_STORE_MENUS_DIR/<store_id>.csv
+# applied. Chosen per request by the /stores/<store_id>/ route prefix or the X-Store-Id header, loaded on
+# first use and dropped after CHATBOT_STORE_MENU_IDLE_SECONDS without requests.
+STORE_MENUS_DIR = os.environ.get('CHATBOT_STORE_MENUS_DIR', 'stores')
+store_menus = StoreMenus(menu_manager, STORE_MENUS_DIR,
+                         idle_seconds=float(os.environ.get('CHATBOT_STORE_MENU_IDLE_SECONDS', '900')))
+metrics.describe('chatbot_store_menus_loaded', 'gauge', 'Store menus held by this worker')
+metrics.describe('chatbot_store_menu_loads_total', 'counter', 'Store menus built by this worker')
+metrics.describe('chatbot_store_menu_evictions_total', 'counter', 'Store menus dropped after going idle')
+metrics.add_collector(lambda: [
+    ('chatbot_store_menus_loaded', {}, len(store_menus)),
+    ('chatbot_store_menu_loads_total', {}, store_menus.loads),
+    ('chatbot_store_menu_evictions_total', {}, store_menus.evictions),
+])
+
+# Process that started the background tasks; threads don't survive a fork, so each worker starts its own
+worker_tasks_pid = None
+
+# Function to start the background tasks of this process
+def start_worker_tasks():
+    global worker_tasks_pid
+    if worker_tasks_pid == os.getpid():
+        return
+    worker_tasks_pid = os.getpid()
+    if MENU_WATCH_INTERVAL > 0:
+        menu_manager.start_watcher(MENU_WATCH_INTERVAL)
+
+# Live Order objects of recent sessions, reused while their order is unchanged
+order_cache = OrderCache()
+
+# Append every completed order to a durable log that the kitchen display and analytics read
+# (CHATBOT_ORDER_LOG is the SQLite file; an empty value turns the log off)
+ORDER_LOG_PATH = os.environ.get('CHATBOT_ORDER_LOG', 'orders.sqlite3')
+order_log = OrderLog(ORDER_LOG_PATH) if ORDER_LOG_PATH else None
+if order_log is not None:
+    atexit.register(order_log.close)
+    metrics.describe('chatbot_order_log_written_total', 'counter', 'Completed orders committed to the order log')
+    metrics.describe('chatbot_order_log_batches_total', 'counter', 'Transactions that committed completed orders')
+    metrics.describe('chatbot_order_log_queue_depth', 'gauge', 'Completed orders waiting for the order log writer')
+    metrics.describe('chatbot_order_log_errors_total', 'counter', 'Failed writes to the order log')
+    metrics.describe('chatbot_order_log_sync_writes_total', 'counter',
+                     'Completed orders written in the request because the writer queue was full')
+    metrics.add_collector(lambda: [
+        ('chatbot_order_log_written_total', {}, order_log.written),
+        ('chatbot_order_log_batches_total', {}, order_log.batches),
+        ('chatbot_order_log_queue_depth', {}, order_log.queue_depth()),
+        ('chatbot_order_log_errors_total', {}, order_log.errors),
+        ('chatbot_order_log_sync_writes_total', {}, order_log.sync_writes),
+    ])
+
+# Menu listings and ingredient answers by menu version and normalized question (0 turns the cache off)
+response_cache = ResponseCache(max_entries=int(os.environ.get('CHATBOT_RESPONSE_CACHE_SIZE', '1024')))
+
+# Token required by the admin endpoints; they are disabled when it is not set
+ADMIN_TOKEN = os.environ.get('CHATBOT_ADMIN_TOKEN')
+
+# Function to get the menu snapshot for the current request
+def current_menu():
+    """
+    Returns the menu snapshot (menu_dict, lemmatized_menu_items, ingredients_dict and
+    phrase_index) pinned for the current request, so a menu reload in the middle of a
+    request never mixes two menu versions. Requests for a store get the store's menu (see
+    select_store_menu). Outside a request the latest base snapshot is used.
+    """
+    if not has_request_context():
+        return menu_manager.snapshot
+    if 'menu' not in g:
+        g.menu = menu_manager.snapshot
+    return g.menu
+
+# Phrases that decide what a message is asking for, matched anywhere in the normalized message.
+# When phrases from several intents appear, the intent listed first wins.
+# Messages that match none of them are treated as orders.
+intent_rules = [
+    # Cancellation of the entire order
+    ('cancel_order', ['cancel my order', 'remove entire order', 'clear my order', 'discard my order', 'cancel order',
+                      'remove all', 'clear order', 'discard order', 'delete my order', 'remove my order',
+                      'trash my order', 'delete it all', 'remove it all']),
+    # Removal of single items, including 'delete' and 'dont want'
+    ('remove_items', ['remove', 'cancel', 'delete', 'discard', 'dont want']),
+    # Which menu items have, or don't have, some ingredients
+    ('ingredient_search', ['which items', 'what items', 'which ones', 'anything with', 'anything without',
+                           'what has', 'what have', 'which has', 'which have', 'what comes with', 'which come with',
+                           'what contains', 'which contain', 'what doesnt', 'which dont', 'which doesnt',
+                           'which drinks', 'what drinks', 'which burgers', 'what burgers', 'which meals',
+                           'what meals', 'items with',
+                           'items without', 'free of']),
+    # Questions about ingredients
+    ('ingredient_query', ['ingredient', 'ingredients', 'whats in', 'contains', 'have', 'what is in', 'what does',
+                          'contain']),
+    # Menu requests
+    ('show_menu', ['menu', 'show menu', 'what do you have', 'list', 'available items']),
+]
+
+# Compile the intent phrases once at startup
+intent_router = IntentRouter(intent_rules, default_intent='order')
+# Routes messages with an ingredient search phrase ('what drinks') that name no ingredient,
+# which are asking something else ('what drinks do you have')
+search_fallback_router = IntentRouter([rule for rule in intent_rules if rule[0] != 'ingredient_search'],
+                                      default_intent='order')
+metrics.describe('chatbot_nlp_batches_total', 'counter', 'Batches sent to the NLP worker pool')
+metrics.describe('chatbot_nlp_batched_texts_total', 'counter', 'Messages parsed by the NLP worker pool')
+metrics.describe('chatbot_nlp_rejected_total', 'counter', 'Messages turned away because the NLP queue was full')
+metrics.describe('chatbot_nlp_queue_depth', 'gauge', 'Messages waiting for the NLP worker pool')
+metrics.add_collector(lambda: [] if nlp_pool is None else [
+    ('chatbot_nlp_batches_total', {}, nlp_pool.batches),
+    ('chatbot_nlp_batched_texts_total', {}, nlp_pool.texts),
+    ('chatbot_nlp_rejected_total', {}, nlp_pool.rejected),
+    ('chatbot_nlp_queue_depth', {}, nlp_pool.queue_depth()),
+])
+metrics.describe('chatbot_response_cache_hits_total', 'counter', 'Responses served from the response cache, by kind')
+metrics.describe('chatbot_response_cache_misses_total', 'counter', 'Responses built because they were not cached, by kind')
+metrics.describe('chatbot_response_cache_entries', 'gauge', 'Responses held in the response cache')
+metrics.describe('chatbot_response_cache_invalidations_total', 'counter', 'Times a new base menu version emptied the response cache')
+metrics.add_collector(lambda: [
+    ('chatbot_response_cache_entries', {}, len(response_cache)),
+    ('chatbot_response_cache_invalidations_total', {}, response_cache.invalidations),
+] + [
+    ('chatbot_response_cache_hits_total', {'kind': kind}, count) for kind, count in list(response_cache.hits.items())
+] + [
+    ('chatbot_response_cache_misses_total', {'kind': kind}, count) for kind, count in list(response_cache.misses.items())
+])
+metrics.add_collector(lambda: [
+    ('chatbot_intent_rule_hits_total', {'intent': intent, 'rule': rule or ''}, count)
+    for (intent, rule), count in list((intent_router.hits + search_fallback_router.hits).items())
+])
+
+# Function to time a stage of the current request
+def timed_stage(name):
+    """
+    Returns a context manager that adds the time spent inside it to the named stage of the
+    current request. Outside a request, or with metrics off, it does nothing.
+    """
+    if METRICS_ENABLED and has_request_context() and 'timer' in g:
+        return g.timer.stage(name)
+    return NULL_STAGE
 
 # Dictionaries to convert written numbers and digits to words
 word_to_num = {
@@ -53,7 +261,53 @@ word_to_num = {
     "a": 1, "an": 1, "the": 1  # Includes 'a' and 'an' to map to 1
 }
 
-num_to_word = {str(value): key for key, value in word_to_num.items()}
+# Map each digit to the first word for it, so '1' becomes 'one' rather than 'the'
+num_to_word = {}
+for word, value in word_to_num.items():
+    num_to_word.setdefault(str(value), word)
+
+# Modifier words that remove or add the ingredient after them
+REMOVE_MODIFIERS = ['without', 'no', 'nos']
+ADD_MODIFIERS = ['extra', 'add', 'with', 'mais']
+
+# Parse formulaic orders from the menu vocabulary without spaCy, falling back to spaCy for the rest
+# (CHATBOT_FAST_PATH=0 sends every message to spaCy)
+FAST_PATH_ENABLED = os.environ.get('CHATBOT_FAST_PATH', '1') == '1'
+fast_parser = FastParser(word_to_num, REMOVE_MODIFIERS, ADD_MODIFIERS)
+metrics.describe('chatbot_parse_path_total', 'counter', 'Order and removal messages parsed, by path (cache, fast or spacy)')
+metrics.describe('chatbot_parse_path_seconds', 'histogram', 'Time spent parsing order and removal messages, by path')
+metrics.describe('chatbot_fast_path_declined_total', 'counter', 'Messages the fast path handed to spaCy, by reason')
+metrics.add_collector(lambda: [
+    ('chatbot_fast_path_declined_total', {'reason': reason}, count) for reason, count in list(fast_parser.declined.items())
+])
+
+# Correct misspelled item and ingredient names to the closest menu phrase with at least this confidence
+# (1 - edits / length of the longer name); CHATBOT_FUZZY_THRESHOLD=1 turns the correction off
+FUZZY_THRESHOLD = float(os.environ.get('CHATBOT_FUZZY_THRESHOLD', '0.8'))
+metrics.describe('chatbot_fuzzy_corrections_total', 'counter', 'Misspelled item and ingredient names corrected, by kind')
+
+# Remember the parse of each normalized order or removal message for the menu version, so repeated
+# phrasings skip parsing. CHATBOT_PARSE_CACHE_DB adds a SQLite file shared by the workers on the box.
+PARSE_CACHE_DB = os.environ.get('CHATBOT_PARSE_CACHE_DB')
+parse_cache = ParseCache(
+    max_entries=int(os.environ.get('CHATBOT_PARSE_CACHE_SIZE', '4096')),
+    store=SQLiteParseStore(PARSE_CACHE_DB) if PARSE_CACHE_DB else None,
+)
+metrics.describe('chatbot_parse_cache_hits_total', 'counter', 'Parses served from the parse cache, by tier (local or shared)')
+metrics.describe('chatbot_parse_cache_misses_total', 'counter', 'Parses not found in the parse cache')
+metrics.describe('chatbot_parse_cache_hit_ratio', 'gauge', 'Share of parse cache lookups that were hits')
+metrics.describe('chatbot_parse_cache_entries', 'gauge', 'Parses held in the parse cache of this worker')
+metrics.describe('chatbot_parse_cache_memory_bytes', 'gauge', 'Memory used by the keys and parses in the parse cache')
+metrics.describe('chatbot_parse_cache_store_errors_total', 'counter', 'Failed reads and writes of the shared parse store')
+metrics.add_collector(lambda: [
+    ('chatbot_parse_cache_misses_total', {}, parse_cache.misses),
+    ('chatbot_parse_cache_hit_ratio', {}, parse_cache.hit_ratio()),
+    ('chatbot_parse_cache_entries', {}, len(parse_cache)),
+    ('chatbot_parse_cache_memory_bytes', {}, parse_cache.memory_bytes),
+    ('chatbot_parse_cache_store_errors_total', {}, parse_cache.store_errors),
+] + [
+    ('chatbot_parse_cache_hits_total', {'tier': tier}, count) for tier, count in list(parse_cache.hits.items())
+])
 
 # Function to replace numerals with words
 def replace_numerals_with_words(text):
@@ -62,28 +316,85 @@ def replace_numerals_with_words(text):
 
     return re.sub(r'\b\d+\b', replace_match, text)
 
-# Function to get menu items
-def get_menu_items():
+# Function to build the menu items of a menu snapshot
+def build_menu_items(menu):
     menu_items = []
-    for item, price in menu_dict.items():
+    for item, price in menu.menu_dict.items():
         menu_items.append({'name': item.title(), 'price': f"${price:.2f}"})
     return menu_items
 
-# Function to parse orders
-def parse_order(user_input):
+# Function to get menu items; the list is built once per menu version and shared, so don't change it
+def get_menu_items():
+    menu = current_menu()
+    return response_cache.get_or_build(menu.version, 'menu', None, lambda: build_menu_items(menu),
+                                       generation=menu.base_version)
+
+# Function to normalize user input before item parsing
+def normalize_message(user_input):
     user_input_lower = user_input.lower().replace('-', ' ')
     user_input_lower = replace_numerals_with_words(user_input_lower)
-    user_input_lower = user_input_lower.replace('shakes', 'shake')
+    return user_input_lower.replace('shakes', 'shake')
 
-    doc = nlp(user_input_lower)
-    order = []
-    total = 0
+class MessageAnalysis:
+    """
+    Holds the normalized text of one chat message and the single spaCy Doc built from it.
+    The Doc is only created the first time a parser asks for it, and every parser shares it.
+    Batch callers that already ran nlp.pipe over the normalized text can pass the Doc in.
+    """
+
+    def __init__(self, user_input, doc=None):
+        self.user_input = user_input
+        self.text = normalize_message(user_input)
+        # Normalized text without punctuation, used for intent and ingredient matching
+        self.plain_text = re.sub(r'[^\w\s]', '', self.text)
+        self._doc = doc
+        self._noun_chunks = None
+        self._lemmas = None
+
+    @property
+    def doc(self):
+        if self._doc is None:
+            with timed_stage('spacy'):
+                self._doc = get_nlp_pool().parse(self.text) if NLP_WORKERS else nlp(self.text)
+        return self._doc
 
-    for chunk in doc.noun_chunks:
+    @property
+    def noun_chunks(self):
+        if self._noun_chunks is None:
+            self._noun_chunks = list(self.doc.noun_chunks)
+        return self._noun_chunks
+
+    @property
+    def lemmas(self):
+        if self._lemmas is None:
+            self._lemmas = [token.lemma_ for token in self.doc]
+        return self._lemmas
+
+    def lemma_of(self, word):
+        """
+        Returns the lemma spaCy assigned to the last occurrence of word in the message.
+        Falls back to the word itself when the tokenizer split it differently.
+        """
+        for token in reversed(self.doc):
+            if re.sub(r'[^\w\s]', '', token.text) == word:
+                return token.lemma_
+        return word
+
+# Function to extract (item, quantity) pairs from the noun chunks of a message
+def extract_menu_items(analysis):
+    menu = current_menu()
+    items = []
+
+    for chunk in analysis.noun_chunks:
         quantity = 1
         item_name = None
 
         tokens = [token for token in chunk]
+        # Skip stop words in front of the quantity ('please two coffees', 'some frys'), but not
+        # modifiers: 'no fries' doesn't order fries
+        while (tokens and tokens[0].is_stop and tokens[0].lemma_ not in word_to_num and not tokens[0].like_num
+               and tokens[0].text not in fast_parser.actions):
+            tokens = tokens[1:]
         if len(tokens) == 0:
             continue
 
@@ -99,93 +410,133 @@ def parse_order(user_input):
         else:
             item_tokens = tokens
 
-        item_candidate = ' '.join([token.lemma_ for token in item_tokens])
-        item_name = lemmatized_menu_items.get(item_candidate)
-        if not item_name:
-            for lemmatized_item, original_item in lemmatized_menu_items.items():
-                if item_candidate in lemmatized_item:
-                    item_name = original_item
-                    break
+        item_name = menu.phrase_index.resolve([token.lemma_ for token in item_tokens])
+        if not item_name and item_tokens:
+            item_name = correct_item_name(item_tokens, menu)
 
         if item_name:
-            order.append((item_name, quantity))
-            total += float(menu_dict[item_name]) * quantity
+            items.append((item_name, quantity))
 
-    return order, total
+    return items
 
-# Function to parse item removals
-def parse_removal(user_input):
-    user_input_lower = user_input.lower().replace('-', ' ')
-    user_input_lower = replace_numerals_with_words(user_input_lower)
-    user_input_lower = user_input_lower.replace('shakes', 'shake')
+# Function to count a corrected misspelling
+def record_correction(kind):
+    if METRICS_ENABLED:
+        metrics.inc('chatbot_fuzzy_corrections_total', kind=kind)
 
-    doc = nlp(user_input_lower)
-    removal_items = []
+# Function to check whether a word could be a misspelled menu word: one the menu doesn't use
+# and that isn't a stop word, number or modifier
+def may_be_misspelled(token, vocabulary):
+    if token.is_stop or token.is_punct or token.like_num or token.text in fast_parser.actions:
+        return False
+    return token.text not in vocabulary.words and token.lemma_ not in vocabulary.words
 
-    for chunk in doc.noun_chunks:
-        quantity = 1
-        item_name = None
+# Function to make the last word of a phrase singular in the ways English plurals are spelled
+def singular_forms(phrase):
+    words = phrase.split()
+    last = words[-1]
+    forms = []
+    if last.endswith('ies') and len(last) > 4:
+        forms.append(last[:-3] + 'y')
+    if last.endswith('es') and len(last) > 3:
+        forms.append(last[:-2])
+    if last.endswith('s') and not last.endswith('ss') and len(last) > 2:
+        forms.append(last[:-1])
+    return [' '.join(words[:-1] + [form]) for form in forms]
 
-        tokens = [token for token in chunk]
-        if len(tokens) == 0:
-            continue
+# Function to resolve a noun chunk that didn't match a menu phrase to the closest menu item
+def correct_item_name(tokens, menu):
+    """
+    Returns the menu item a noun chunk most likely means, or None. Determiners and other stop
+    words are dropped first, so 'some frys' is looked up as 'fry'; modifiers such as 'no' are
+    kept. A chunk with a word the menu doesn't know ('cheesburger') is corrected by trying the
+    rest of the chunk and then its last word, each also made singular. A chunk of menu words
+    only ('a chocolate shake', 'no onions cheeseburger') falls back to its head noun when that
+    is the whole name of an item and no modifier comes right before it ('extra milk').
+    Words the menu knows are looked up by their menu lemma.
+    """
+    vocabulary = menu.vocabulary
+    tokens = [token for token in tokens
+              if token.text in fast_parser.actions or not (token.is_stop or token.is_punct)]
+    if not tokens:
+        return None
+    lemmas = [vocabulary.lemmas.get(token.text, token.lemma_) for token in tokens]
+    if not any(may_be_misspelled(token, vocabulary) for token in tokens):
+        item = menu.phrase_index.resolve(lemmas)
+        modified = len(tokens) > 1 and tokens[-2].text in fast_parser.actions
+        if item is None and not modified and vocabulary.is_noun(lemmas[-1]):
+            item = menu.phrase_index.resolve_exact(lemmas[-1:])
+        return item
+    phrases = [' '.join(lemmas)]
+    if len(lemmas) > 1:
+        phrases.append(lemmas[-1])
+    for phrase in phrases:
+        for candidate in [phrase] + singular_forms(phrase):
+            match = menu.fuzzy_items.lookup(candidate, FUZZY_THRESHOLD)
+            if match:
+                record_correction('item')
+                return match[0]
+    return None
 
-        if tokens[0].lemma_ in word_to_num:
-            quantity = word_to_num[tokens[0].lemma_]
-            item_tokens = tokens[1:]
-        elif tokens[0].like_num:
-            try:
-                quantity = int(tokens[0].text)
-            except ValueError:
-                quantity = 1
-            item_tokens = tokens[1:]
-        else:
-            item_tokens = tokens
+# Function to correct a misspelled ingredient name to the closest ingredient on the menu
+def correct_ingredient_name(name, menu, among=None):
+    """
+    Returns the ingredient closest to a name the menu doesn't know ('onoin', 'tomatoe'), or
+    the name unchanged. With among, only those ingredients are considered.
+    """
+    if name in menu.ingredient_index or name in menu.vocabulary.words:
+        return name
+    match = menu.fuzzy_ingredients.lookup(name, FUZZY_THRESHOLD, among)
+    if match is None:
+        return name
+    record_correction('ingredient')
+    return match[0]
 
-        item_candidate = ' '.join([token.lemma_ for token in item_tokens])
-        item_name = lemmatized_menu_items.get(item_candidate)
-        if not item_name:
-            for lemmatized_item, original_item in lemmatized_menu_items.items():
-                if item_candidate in lemmatized_item:
-                    item_name = original_item
-                    break
+# Function to parse orders; the total is in cents
+def parse_order(analysis):
+    menu_dict = current_menu().menu_dict
+    order = extract_menu_items(analysis)
+    total = 0
+    for item_name, quantity in order:
+        total += to_cents(menu_dict[item_name]) * quantity
 
-        if item_name:
-            removal_items.append((item_name, quantity))
+    return order, total
 
-    return removal_items
+# Function to parse item removals
+def parse_removal(analysis):
+    return extract_menu_items(analysis)
 
 # Function to parse ingredient modifications
-def parse_modifications(user_input, parsed_order):
+def parse_modifications(analysis, parsed_order):
     """
     Parses user input for ingredient modifications, such as 'without onions' or 'extra cheese'.
     Returns a dictionary mapping item names to their modifications.
     """
+    menu = current_menu()
     modifications = {}
-    doc = nlp(user_input.lower())
 
     # Iterate through sentences
-    for sent in doc.sents:
+    for sent in analysis.doc.sents:
         # Look for modifiers like 'without', 'no', 'extra', 'add', 'with'
         for token in sent:
-            if token.text in ['without', 'no', 'nos']:
+            if token.text in REMOVE_MODIFIERS:
                 # Get the next token as the ingredient to remove
                 try:
                     next_token = token.nbor(1)
                     if next_token.pos_ == 'NOUN':
-                        ingredient = next_token.lemma_
+                        ingredient = correct_ingredient_name(next_token.lemma_, menu)
                         # Assign to the last item in parsed_order
                         if parsed_order:
                             last_item = parsed_order[-1][0]  # item name
                             modifications.setdefault(last_item, {}).setdefault('remove', []).append(ingredient)
                 except IndexError:
                     continue  # No token after modifier, skip
-            elif token.text in ['extra', 'add', 'with', 'mais']:
+            elif token.text in ADD_MODIFIERS:
                 # Get the next token as the ingredient to add
                 try:
                     next_token = token.nbor(1)
                     if next_token.pos_ == 'NOUN':
-                        ingredient = next_token.lemma_
+                        ingredient = correct_ingredient_name(next_token.lemma_, menu)
                         if token.text in ['add', 'with', 'mais']:
                             # Assign to the last item in parsed_order
                             if parsed_order:
@@ -201,80 +552,249 @@ def parse_modifications(user_input, parsed_order):
 
     return modifications
 
+# Function to get the order in the session
+def current_order():
+    """
+    Returns the session's order as an Order, shared by every handler in the request.
+    Changes must be written back with save_order().
+    """
+    if 'order' not in g:
+        state = session.get('order')
+        if state:
+            menu_dict = current_menu().menu_dict
+            price_of = lambda item: to_cents(menu_dict[item]) if item in menu_dict else None
+            g.order = order_cache.load(state, price_of)
+        else:
+            g.order = Order()
+    return g.order
+
+# Function to write the order back to the session
+def save_order(order):
+    session['order'] = order.to_state()
+    order_cache.put(order)
+
+# Function to drop the order from the session
+def discard_order():
+    order = g.pop('order', None)
+    if order is not None:
+        order_cache.discard(order.order_id)
+    session.pop('order', None)
+
+# Function to get the current order as structured data
+def get_order_state():
+    """
+    Returns the current order as a list of line items with prices, plus the order total,
+    all in integer cents.
+    """
+    order = current_order()
+    lines = []
+    for line in order:
+        lines.append({
+            'item': line.item,
+            'quantity': line.quantity,
+            'add': line.added_names(),
+            'remove': line.removed_names(),
+            'unit_cents': line.unit_cents,
+            'line_cents': line.line_cents,
+        })
+    return {'items': lines, 'total_cents': order.total_cents}
+
+# Function to render one order line as an HTML list item
+def render_order_line(item, quantity, add, remove, line_cents):
+    # Display the item with modifications
+    item_display = f"{quantity} x {item.title()}"
+    modifications = []
+    if add:
+        modifications.append("Add: " + ", ".join([ingredient.title() for ingredient in add]))
+    if remove:
+        modifications.append("Remove: " + ", ".join([ingredient.title() for ingredient in remove]))
+    if modifications:
+        item_display += f" ({'; '.join(modifications)})"
+    return f"<li>{item_display} - {format_cents(line_cents)}</li>"
+
+# Function to render an order summary from the HTML of its lines
+def render_order_html(lines_html, total_cents, final=False):
+    if final:
+        parts = ["<h3>Your final order:</h3><ul style='list-style-type: none;'>"]
+    else:
+        parts = ["<h4>Your current order:</h4><ul style='list-style-type: none;'>"]
+    parts.extend(lines_html)
+    if final:
+        parts.append(f"</ul><h3>Total: {format_cents(total_cents)}</h3>")
+    else:
+        parts.append(f"</ul><p><strong>Total: {format_cents(total_cents)}</strong></p>")
+    return ''.join(parts)
+
+# Function to render the live order summary, reusing the HTML of lines that didn't change
+def render_current_order(order):
+    for line in order:
+        if line.html is None:
+            line.html = render_order_line(line.item, line.quantity, line.added_names(), line.removed_names(),
+                                          line.line_cents)
+    return render_order_html([line.html for line in order], order.total_cents)
+
+# Function to render a completed order (as returned by get_order_state) as its final summary
+def render_final_order(order_state):
+    lines_html = [render_order_line(line['item'], line['quantity'], line['add'], line['remove'], line['line_cents'])
+                  for line in order_state['items']]
+    return render_order_html(lines_html, order_state['total_cents'], final=True)
+
 # Function to get the current order summary
 def get_current_order_summary():
-    if 'order' not in session or not session['order']:
+    order = current_order()
+    if not order:
         return "🛒 Your order is currently empty."
+    return order.summary(render_current_order)
 
-    summary = "<h4>Your current order:</h4><ul style='list-style-type: none;'>"
-    total = 0
-    for item, details in session['order'].items():
-        qty = details['quantity']
-        additions = details.get('add', [])
-        removals = details.get('remove', [])
-        item_price = float(menu_dict[item]) * qty
-        total += item_price
-
-        # Display the item with modifications
-        item_display = f"{qty} x {item.title()}"
-        modifications = []
-        if additions:
-            modifications.append("Add: " + ", ".join([add.title() for add in additions]))
-        if removals:
-            modifications.append("Remove: " + ", ".join([remove.title() for remove in removals]))
-        if modifications:
-            item_display += f" ({'; '.join(modifications)})"
-        item_display += f" - ${item_price:.2f}"
-        summary += f"<li>{item_display}</li>"
-    summary += f"</ul><p><strong>Total: ${total:.2f}</strong></p>"
-    return summary
+# Bot reply text for each kind of event; string fields are shown in title case
+EVENT_MESSAGES = {
+    'items_added': "🛒 **Item(s) added to your order.**<br>",
+    'no_items_found': "❓ Sorry, we couldn't find any items from the menu in your order.",
+    'item_not_ordered': "⚠️ You haven't ordered a {item} to modify.<br>",
+    'ingredient_added': "➕ Added {ingredient} to your {item}.<br>",
+    'ingredient_removed': "➖ Removed {ingredient} from your {item}.<br>",
+    'ingredient_not_in_item': "ℹ️ {item} doesn't contain {ingredient}.<br>",
+    'ingredient_not_available': "ℹ️ We don't have {ingredient} to add to your {item}.<br>",
+    'item_removed': "❌ Removed {quantity} x {item} from your order.<br>",
+    'item_removed_all': "⚠️ You have only {quantity} x {item} in your order. Removing all of them.<br>",
+    'item_not_in_order': "⚠️ You don't have any {item} in your order to remove.<br>",
+    'no_items_to_remove': "❓ Sorry, we couldn't find any items from the menu to remove in your request.",
+    'item_not_identified': "❓ I'm sorry, I couldn't identify which menu item you're referring to. Please specify the item.",
+    'search_results': "🔎 {kinds} {criteria}: {items}.",
+    'no_search_results': "🔎 We don't have any {kinds} {criteria}.",
+    'ingredient_not_identified': "❓ I'm sorry, I couldn't tell which ingredient you're asking about.",
+    'ingredients_unavailable': "ℹ️ The ingredients for {item} are currently unavailable.",
+    'ingredient_list': "📝 The {item} contains the following ingredients: {ingredients}.",
+    'contains_ingredient': "✅ Yes, the {item} contains {ingredient}.",
+    'lacks_ingredient': "❌ No, the {item} does not contain {ingredient}.",
+    'order_canceled': "🗑️ Your entire order has been canceled.",
+    'nothing_to_cancel': "⚠️ You don't have any active orders to cancel.",
+    'nothing_ordered': "❓ You haven't ordered anything yet.",
+    'empty_message': "❓ Please enter a message.",
+    'nlp_busy': "⏳ We're very busy right now. Please send your message again in a moment.",
+}
+
+# Function to render the menu listing as bot reply HTML
+def render_menu_html(menu_items):
+    menu_html = "<h3>🍔 In-N-Out Menu:</h3><ul style='list-style-type: none;'>"
+    for item in menu_items:
+        menu_html += f"<li>{item['name']}: {item['price']}</li>"
+    menu_html += "</ul>"
+    return menu_html
+
+# Function to describe what an ingredient search asked for, e.g. 'with Milk and without Cheese'
+def describe_search(wanted, unwanted):
+    parts = []
+    if wanted:
+        parts.append("with " + " and ".join([ingredient.title() for ingredient in wanted]))
+    if unwanted:
+        parts.append("without " + " or ".join([ingredient.title() for ingredient in unwanted]))
+    return " and ".join(parts)
+
+# Function to render one event as bot reply HTML
+def render_event_html(event):
+    if event['type'] == 'menu':
+        menu = current_menu()
+        return response_cache.get_or_build(menu.version, 'menu_html', None,
+                                           lambda: render_menu_html(event['items']), generation=menu.base_version)
+    if event['type'] == 'order_completed':
+        return f"{render_final_order(event['order'])}<p>🎉 Thank you for your order!</p>"
+    if event['type'] in ('search_results', 'no_search_results'):
+        kinds = " or ".join(event['kinds']) or "menu items"
+        if event['type'] == 'search_results':
+            kinds = kinds[:1].upper() + kinds[1:]
+        return EVENT_MESSAGES[event['type']].format(
+            kinds=kinds,
+            criteria=describe_search(event['with'], event['without']),
+            items=', '.join([item.title() for item in event['items']]),
+        )
+
+    fields = {}
+    for key, value in event.items():
+        if isinstance(value, str):
+            fields[key] = value.title()
+        elif isinstance(value, list) and all(isinstance(entry, str) for entry in value):
+            fields[key] = ', '.join([entry.title() for entry in value])
+        else:
+            fields[key] = value
+    return EVENT_MESSAGES[event['type']].format(**fields)
+
+# Function to render a handler result as the bot's HTML reply
+def render_result_html(result):
+    with timed_stage('render'):
+        # The chat announces additions that came with modifications through the modifications
+        quiet = result.get('quiet_additions')
+        response = ''.join([render_event_html(event) for event in result['events']
+                            if not (quiet and event['type'] == 'items_added')])
+        if result.get('show_summary'):
+            response += get_current_order_summary()
+    return response
 
 # Function to handle adding items with modifications
 def handle_addition(parsed_order, has_modifications):
     """
     Handles adding items to the order.
-    If has_modifications is False, returns messages about additions and order summary.
-    If has_modifications is True, skips addition messages.
+    If has_modifications is False, the result reports the additions and shows the order summary.
+    If has_modifications is True, the addition is not announced; handle_modifications reports instead.
     """
-    response = ""
+    result = {'events': [], 'show_summary': False, 'quiet_additions': has_modifications}
     if parsed_order:
+        menu_dict = current_menu().menu_dict
+        order = current_order()
         for item, quantity in parsed_order:
-            if 'order' not in session:
-                session['order'] = {}
-            if item in session['order']:
-                session['order'][item]['quantity'] += quantity
-            else:
-                session['order'][item] = {'quantity': quantity, 'add': [], 'remove': []}
-            session.modified = True  # Inform Flask that the session has been modified
+            order.add_item(item, quantity, to_cents(menu_dict[item]))
+        save_order(order)
 
-        if not has_modifications:
-            response += "🛒 **Item(s) added to your order.**<br>"
-            response += get_current_order_summary()
+        added = [{'item': item, 'quantity': quantity} for item, quantity in parsed_order]
+        result['events'].append({'type': 'items_added', 'items': added})
+        result['show_summary'] = not has_modifications
     else:
-        response += "❓ Sorry, we couldn't find any items from the menu in your order."
-    return response
+        result['events'].append({'type': 'no_items_found'})
+    return result
 
 # Function to handle ingredient queries
-def handle_ingredient_query(user_input_lower):
+def handle_ingredient_query(analysis):
     """
     Handles queries related to ingredients.
+    The answer depends only on the menu and the normalized question, so repeated questions
+    are answered from the response cache without running spaCy.
     """
+    return cached_answer('ingredients', analysis, answer_ingredient_query)
+
+# Function to answer a stateless question through the response cache
+def cached_answer(kind, analysis, answer):
+    # Answers don't mention prices, so stores that only change prices share them
+    menu = current_menu()
+    events = response_cache.get_or_build(menu.items_version, kind, analysis.text,
+                                         lambda: answer(analysis)['events'], generation=menu.base_version)
+    # Callers may add to the events; the cached ones stay as they were built
+    return {'events': [dict(event) for event in events]}
+
+# Function to answer an ingredient query from the menu
+def answer_ingredient_query(analysis):
+    user_input_lower = analysis.plain_text
+    menu = current_menu()
+    ingredients_dict = menu.ingredients_dict
     # Attempt to extract the menu item from the query
     menu_item = None
-    for item in menu_dict.keys():
-        if item in user_input_lower:
-            menu_item = item
-            break
-
-    if not menu_item:
+    item_lemmas = []
+    mentions = menu.phrase_index.find_mentions(analysis.lemmas)
+    if mentions:
+        menu_item = mentions[0].item
+        item_lemmas = analysis.lemmas[mentions[0].start:mentions[0].end]
+    else:
         # If the menu item isn't found, try partial matches
-        for item in menu_dict.keys():
-            if item.split()[0] in user_input_lower:
-                menu_item = item
+        menu_item = menu.phrase_index.find_head_word(analysis.lemmas)
+    if not menu_item:
+        # Then a misspelled item name ('what is in the chesburger')
+        for chunk in analysis.noun_chunks:
+            tokens = [token for token in chunk if token.lemma_ not in word_to_num]
+            menu_item = correct_item_name(tokens, menu) if tokens else None
+            if menu_item:
                 break
 
     if not menu_item:
-        return "❓ I'm sorry, I couldn't identify which menu item you're referring to. Please specify the item."
+        return {'events': [{'type': 'item_not_identified'}]}
 
     # Determine if the user is asking for all ingredients or a specific one
     specific_ingredient = None
@@ -291,311 +811,336 @@ def handle_ingredient_query(user_input_lower):
             if ingredient_tokens:
                 specific_ingredient = ingredient_tokens[-1]
                 specific_ingredient = re.sub(r'[^\w\s]', '', specific_ingredient)
-                doc = nlp(specific_ingredient)
-                specific_ingredient = ' '.join([token.lemma_ for token in doc])
+                specific_ingredient = correct_ingredient_name(analysis.lemma_of(specific_ingredient), menu)
             break
 
-    if specific_ingredient:
-        if specific_ingredient == menu_item:
-            # User is requesting the full list of ingredients
-            ingredients = ingredients_dict.get(menu_item, [])
-            if not ingredients:
-                return f"ℹ️ The ingredients for {menu_item.title()} are currently unavailable."
-            ingredients_formatted = ', '.join([ingredient.title() for ingredient in ingredients])
-            return f"📝 The {menu_item.title()} contains the following ingredients: {ingredients_formatted}."
-        else:
-            # User is asking about a specific ingredient
-            if specific_ingredient in ingredients_dict.get(menu_item, []):
-                return f"✅ Yes, the {menu_item.title()} contains {specific_ingredient.title()}."
-            else:
-                return f"❌ No, the {menu_item.title()} does not contain {specific_ingredient.title()}."
-    else:
-        # User is requesting the full list of ingredients without specifying
-        ingredients = ingredients_dict.get(menu_item, [])
-        if not ingredients:
-            return f"ℹ️ The ingredients for {menu_item.title()} are currently unavailable."
-        ingredients_formatted = ', '.join([ingredient.title() for ingredient in ingredients])
-        return f"📝 The {menu_item.title()} contains the following ingredients: {ingredients_formatted}."
+    ingredients = ingredients_dict.get(menu_item, [])
+    if specific_ingredient and specific_ingredient != menu_item and specific_ingredient not in item_lemmas:
+        # User is asking about a specific ingredient
+        answer = 'contains_ingredient' if specific_ingredient in ingredients else 'lacks_ingredient'
+        return {'events': [{'type': answer, 'item': menu_item, 'ingredient': specific_ingredient}]}
+
+    # User is requesting the full list of ingredients
+    if not ingredients:
+        return {'events': [{'type': 'ingredients_unavailable', 'item': menu_item}]}
+    return {'events': [{'type': 'ingredient_list', 'item': menu_item, 'ingredients': ingredients}]}
+
+# Words that turn the ingredients after them into ones to leave out, and words that end that
+SEARCH_NEGATIONS = {'no', 'not', 'without', 'free', 'doesnt', 'dont', 'isnt', 'arent', 'nothing'}
+SEARCH_RESETS = {'but', 'yet'}
+
+# Function to handle questions about which items have or don't have some ingredients
+def handle_ingredient_search(analysis):
+    """
+    Handles questions such as 'what has no cheese' or 'which drinks have milk'.
+    """
+    return cached_answer('search', analysis, answer_ingredient_search)
+
+# Function to answer an ingredient search from the inverted ingredient index
+def answer_ingredient_search(analysis):
+    """
+    Reads the wanted and unwanted ingredients and any kind of item ('drinks', 'burgers')
+    from the message words, then answers with set operations on the ingredient index.
+    Ingredients after a negation ('no', 'without', "don't") are unwanted until 'but'.
+    """
+    index = current_menu().ingredient_index
+    words = analysis.plain_text.split()
+    wanted, unwanted, kinds = [], [], []
+    scope = None
+    negated = False
+    position = 0
+    for mention in index.find_ingredients(words) + [None]:
+        end = mention.start if mention else len(words)
+        for word in words[position:end]:
+            if word in SEARCH_NEGATIONS:
+                negated = True
+            elif word in SEARCH_RESETS:
+                negated = False
+            elif index.items_named(word):
+                scope = (scope or 0) | index.items_named(word)
+                kinds.append(word)
+        if mention is None:
+            break
+        chosen = unwanted if negated else wanted
+        if mention.item not in chosen:
+            chosen.append(mention.item)
+        position = mention.end
+
+    if not wanted and not unwanted:
+        return {'events': [{'type': 'ingredient_not_identified'}]}
+    items = index.names(index.search(wanted, unwanted, scope))
+    answer = 'search_results' if items else 'no_search_results'
+    return {'events': [{'type': answer, 'with': wanted, 'without': unwanted, 'kinds': kinds, 'items': items}]}
 
 # Function to handle modifications to items
 def handle_modifications(modifications):
-    response = ""
+    menu = current_menu()
+    ingredients_dict = menu.ingredients_dict
+    order = current_order()
+    events = []
+    changed = False
     for item, mods in modifications.items():
-        if item not in session['order']:
-            response += f"⚠️ You haven't ordered a {item.title()} to modify.<br>"
+        if item not in order:
+            events.append({'type': 'item_not_ordered', 'item': item})
             continue
+        changed = True
         # Validate and apply additions
         additions = mods.get('add', [])
         for add in additions:
-            session['order'][item].setdefault('add', []).append(add)
-            response += f"➕ Added {add.title()} to your {item.title()}.<br>"
+            # Only ingredients on the menu are added; the order interns them for the life of the worker
+            if add not in menu.ingredient_index:
+                events.append({'type': 'ingredient_not_available', 'item': item, 'ingredient': add})
+                continue
+            order.add_ingredient(item, add)
+            events.append({'type': 'ingredient_added', 'item': item, 'ingredient': add})
         # Validate and apply removals
         removals = mods.get('remove', [])
         for remove in removals:
-            if remove in ingredients_dict[item]:
-                session['order'][item].setdefault('remove', []).append(remove)
-                response += f"➖ Removed {remove.title()} from your {item.title()}.<br>"
+            # Among this item's own ingredients, a misspelling too ambiguous for the whole menu may be clear
+            remove = correct_ingredient_name(remove, menu, among=set(ingredients_dict.get(item, [])))
+            if remove in ingredients_dict.get(item, []):
+                order.remove_ingredient(item, remove)
+                events.append({'type': 'ingredient_removed', 'item': item, 'ingredient': remove})
             else:
-                response += f"ℹ️ {item.title()} doesn't contain {remove.title()}.<br>"
-        session.modified = True
-    response += get_current_order_summary()
-    return response
+                events.append({'type': 'ingredient_not_in_item', 'item': item, 'ingredient': remove})
+    if changed:
+        save_order(order)
+    return {'events': events, 'show_summary': True}
 
 # Function to handle removal of entire items
 def handle_removal(removal_items):
-    response = ""
-    if removal_items:
-        for item, quantity in removal_items:
-            if item in session['order']:
-                if session['order'][item]['quantity'] > quantity:
-                    session['order'][item]['quantity'] -= quantity
-                    response += f"❌ Removed {quantity} x {item.title()} from your order.<br>"
-                elif session['order'][item]['quantity'] == quantity:
-                    session['order'].pop(item)
-                    response += f"❌ Removed {quantity} x {item.title()} from your order.<br>"
-                else:
-                    response += f"⚠️ You have only {session['order'][item]['quantity']} x {item.title()} in your order. Removing all of them.<br>"
-                    session['order'].pop(item)
-                session.modified = True  # Inform Flask that the session has been modified
+    if not removal_items:
+        return {'events': [{'type': 'no_items_to_remove'}]}
+
+    order = current_order()
+    events = []
+    changed = False
+    for item, quantity in removal_items:
+        line = order.get(item)
+        if line is not None:
+            if line.quantity >= quantity:
+                events.append({'type': 'item_removed', 'item': item, 'quantity': quantity})
             else:
-                response += f"⚠️ You don't have any {item.title()} in your order to remove.<br>"
-        response += get_current_order_summary()
-    else:
-        response += "❓ Sorry, we couldn't find any items from the menu to remove in your request."
-    return response
+                events.append({'type': 'item_removed_all', 'item': item, 'quantity': line.quantity})
+            order.remove_item(item, quantity)
+            changed = True
+        else:
+            events.append({'type': 'item_not_in_order', 'item': item})
+    if changed:
+        save_order(order)
+    return {'events': events, 'show_summary': True}
 
 # Function to handle menu display requests
 def handle_menu_request():
-    menu_items = get_menu_items()
-    menu_html = "<h3>🍔 In-N-Out Menu:</h3><ul style='list-style-type: none;'>"
-    for item in menu_items:
-        menu_html += f"<li>{item['name']}: {item['price']}</li>"
-    menu_html += "</ul>"
-    return menu_html
+    return {'events': [{'type': 'menu', 'items': get_menu_items()}]}
 
 # **New Function to Handle Cancellation of Entire Order**
 def handle_cancel_order():
     """
     Handles the cancellation of the entire order.
-    Clears the order from the session and informs the user.
+    Clears the order from the session and reports whether there was anything to cancel.
     """
-    if 'order' in session and session['order']:
-        session.pop('order', None)
-        return "🗑️ Your entire order has been canceled."
+    if current_order():
+        discard_order()
+        return {'events': [{'type': 'order_canceled'}]}
     else:
-        return "⚠️ You don't have any active orders to cancel."
+        return {'events': [{'type': 'nothing_to_cancel'}]}
 
-# Function to initialize messages in the session
-def initialize_messages():
-    if 'messages' not in session:
-        session['messages'] = []
-        # Add a welcome message from the bot
-        session['messages'].append({'sender': 'bot', 'text': "👋 Welcome to In-N-Out Ordering Chatbot! How can I assist you today?"})
+# Function to build the order log record of a completed order
+def completed_order_record(order):
+    return {
+        'order_id': order.order_id,
+        'store_id': g.get('store_id'),
+        'menu_version': current_menu().version,
+        'created': order.created,
+        'completed': time.time(),
+        'total_cents': order.total_cents,
+        'lines': [{
+            'item': line.item,
+            'quantity': line.quantity,
+            'unit_cents': line.unit_cents,
+            'line_cents': line.line_cents,
+            'add': line.added_names(),
+            'remove': line.removed_names(),
+        } for line in order],
+    }
 
-# Flask route for the chatbot
-@app.route('/', methods=['GET', 'POST'])
-def chat():
-    initialize_messages()
-    response = ""
-    if request.method == 'POST':
-        if 'complete_order' in request.form:
-            if 'order' in session and session['order']:
-                # Generate order summary
-                order_summary = "<h3>Your final order:</h3><ul style='list-style-type: none;'>"
-                total_price = 0
-                for item, details in session['order'].items():
-                    qty = details['quantity']
-                    additions = details.get('add', [])
-                    removals = details.get('remove', [])
-                    item_price = float(menu_dict[item]) * qty
-                    total_price += item_price
-
-                    # Display the item with modifications
-                    item_display = f"{qty} x {item.title()}"
-                    modifications = []
-                    if additions:
-                        modifications.append("Add: " + ", ".join([add.title() for add in additions]))
-                    if removals:
-                        modifications.append("Remove: " + ", ".join([remove.title() for remove in removals]))
-                    if modifications:
-                        item_display += f" ({'; '.join(modifications)})"
-                    item_display += f" - ${item_price:.2f}"
-                    order_summary += f"<li>{item_display}</li>"
-                order_summary += f"</ul><h3>Total: ${total_price:.2f}</h3>"
-
-                # Add the order summary as a bot message
-                response += f"{order_summary}<p>🎉 Thank you for your order!</p>"
-                session['messages'].append({'sender': 'bot', 'text': response})
-                # Clear the session to start a new order
-                session.pop('order', None)
-            else:
-                response += "❓ You haven't ordered anything yet."
-                session['messages'].append({'sender': 'bot', 'text': response})
-        elif 'message' in request.form and request.form['message'].strip() != '':
-            user_input = request.form['message']
-            user_input_lower = user_input.lower()
-            # Normalize user input by removing punctuation
-            user_input_lower = re.sub(r'[^\w\s]', '', user_input_lower)
-            # Add the user's message to the chat history
-            session['messages'].append({'sender': 'user', 'text': user_input})
-
-            # Define patterns to identify menu requests
-            menu_patterns = ['menu', 'show menu', 'what do you have', 'list', 'available items']
-
-            # Define removal intents including 'delete' and 'dont want'
-            removal_intents = ['remove', 'cancel', 'delete', 'discard', 'dont want']
-
-            # Define cancellation intents for entire order
-            cancellation_intents = ['cancel my order', 'remove entire order', 'clear my order', 'discard my order', 'cancel order', 'remove all', 'clear order', 'discard order', 'delete my order', 'remove my order', 'trash my order', 'delete it all', 'remove it all']
-
-            # **New Condition to Handle Cancellation of Entire Order**
-            if any(cancel_phrase in user_input_lower for cancel_phrase in cancellation_intents):
-                # Handle cancellation of the entire order
-                bot_response = handle_cancel_order()
-            elif any(intent in user_input_lower for intent in removal_intents):
-                # Handle item removal
-                removal_items = parse_removal(user_input)
-                bot_response = handle_removal(removal_items)
-            elif any(word in user_input_lower for word in ['ingredient', 'ingredients', 'whats in', 'contains', 'have', 'what is in', 'what does', 'contain', 'contains']):
-                # Handle ingredient queries
-                ingredient_response = handle_ingredient_query(user_input_lower)
-                bot_response = ingredient_response
-            elif any(pattern in user_input_lower for pattern in menu_patterns):
-                # Handle menu display requests
-                menu_response = handle_menu_request()
-                bot_response = menu_response
-            else:
-                # Handle orders and modifications
-                # Parse the order
-                parsed_order, parsed_total = parse_order(user_input)
+# Function to complete the current order
+def handle_complete_order():
+    if current_order():
+        order_state = get_order_state()
+        # Queue the order for the order log; the write happens in the background
+        if order_log is not None:
+            with timed_stage('order_log'):
+                order_log.append(completed_order_record(current_order()))
+        # Clear the session to start a new order
+        discard_order()
+        return {'intent': 'complete_order', 'events': [{'type': 'order_completed', 'order': order_state}]}
+    return {'intent': 'complete_order', 'events': [{'type': 'nothing_ordered'}]}
 
-                # Parse modifications based on user input
-                modifications = parse_modifications(user_input, parsed_order)
+# Function to parse one chat message without touching the session
+def parse_message(analysis, fast_path=None, cached=True, use_spacy=True):
+    """
+    Works out the intent of an analyzed message and parses the items and modifications
+    it mentions. This is the parsing used by the web routes and by batch processing.
 
-                # Determine if there are modifications
-                has_modifications = bool(modifications)
+    Orders and removals made only of menu words are parsed by the fast path without spaCy
+    unless fast_path is False (it defaults to CHATBOT_FAST_PATH). A message parsed before
+    with the same menu version is taken from the parse cache, unless cached is False.
+    parsed['path'] says where the parse came from: 'cache', 'fast', 'spacy', or None for
+    intents that need no item parsing. With use_spacy False, a message that needs spaCy
+    returns None instead, so batch callers can send only those through nlp.pipe.
+    """
+    with timed_stage('intent'):
+        route = intent_router.route(analysis.plain_text)
+        if route.intent == 'ingredient_search' and not current_menu().ingredient_index.find_ingredients(
+                analysis.plain_text.split()):
+            route = search_fallback_router.route(analysis.plain_text)
+    parsed = {'intent': route.intent, 'rule': route.rule, 'items': [], 'modifications': {}, 'path': None}
+    if route.intent not in ('remove_items', 'order'):
+        return parsed
 
-                # Handle additions
-                addition_response = handle_addition(parsed_order, has_modifications)
+    start = time.perf_counter()
+    menu = current_menu()
+    hit = None
+    if cached:
+        with timed_stage('parse_cache'):
+            hit = parse_cache.get(menu.items_version, analysis.text, menu.base_version)
+    fast = None
+    if hit is None and (FAST_PATH_ENABLED if fast_path is None else fast_path):
+        with timed_stage('fast_path'):
+            fast = fast_parser.parse(analysis.text, menu)
+    if hit is None and fast is None and not use_spacy:
+        return None
+    if hit is not None:
+        parsed['path'] = 'cache'
+        parsed['items'] = [(item, quantity) for item, quantity in hit['items']]
+        parsed['modifications'] = hit['modifications']
+    elif fast is not None:
+        parsed['path'] = 'fast'
+        parsed['items'] = fast[0]
+        if route.intent == 'order':
+            parsed['modifications'] = fast[1]
+    elif route.intent == 'remove_items':
+        parsed['path'] = 'spacy'
+        parsed['items'] = parse_removal(analysis)
+    else:
+        parsed['path'] = 'spacy'
+        # Parse the order
+        parsed['items'], parsed_total = parse_order(analysis)
+        # Parse modifications based on user input
+        parsed['modifications'] = parse_modifications(analysis, parsed['items'])
+    if cached and hit is None:
+        with timed_stage('parse_cache'):
+            parse_cache.put(menu.items_version, analysis.text,
+                            {'items': parsed['items'], 'modifications': parsed['modifications']}, menu.base_version)
+    if METRICS_ENABLED:
+        metrics.inc('chatbot_parse_path_total', path=parsed['path'])
+        metrics.observe('chatbot_parse_path_seconds', time.perf_counter() - start, path=parsed['path'])
+    return parsed
 
-                if has_modifications:
-                    # Handle modifications
-                    modification_response = handle_modifications(modifications)
-                    # Combine responses without the initial addition message
-                    bot_response = modification_response
-                else:
-                    bot_response = addition_response
+# Function to apply a parsed message to the order in the session
+def apply_parsed_message(analysis, parsed):
+    """
+    Runs the handler for the parsed intent against the session and returns its result:
+    the events describing what changed, and whether to show the order summary.
+    """
+    intent = parsed['intent']
 
-            # Add the bot's response to the chat history
-            session['messages'].append({'sender': 'bot', 'text': bot_response})
-        else:
-            # Add a prompt message if the user didn't type anything
-            session['messages'].append({'sender': 'bot', 'text': "❓ Please enter a message."})
+    # **New Condition to Handle Cancellation of Entire Order**
+    if intent == 'cancel_order':
+        # Handle cancellation of the entire order
+        result = handle_cancel_order()
+    elif intent == 'remove_items':
+        # Handle item removal
+        result = handle_removal(parsed['items'])
+    elif intent == 'ingredient_search':
+        # Handle questions about which items have an ingredient
+        result = handle_ingredient_search(analysis)
+    elif intent == 'ingredient_query':
+        # Handle ingredient queries
+        result = handle_ingredient_query(analysis)
+    elif intent == 'show_menu':
+        # Handle menu display requests
+        result = handle_menu_request()
+    else:
+        # Handle orders and modifications
+        # Determine if there are modifications
+        has_modifications = bool(parsed['modifications'])
+
+        # Handle additions
+        result = handle_addition(parsed['items'], has_modifications)
+
+        if has_modifications:
+            # Handle modifications; the addition itself is reported quietly
+            modification_result = handle_modifications(parsed['modifications'])
+            result['events'].extend(modification_result['events'])
+            result['show_summary'] = True
+
+    result['intent'] = intent
+    result['rule'] = parsed['rule']
+    result['items'] = [{'item': item, 'quantity': quantity} for item, quantity in parsed['items']]
+    result['modifications'] = parsed['modifications']
+    return result
+
+# Function to process one chat message
+def process_message(user_input):
+    """
+    Works out what the message asks for, applies it to the order in the session and
+    returns a structured result: the intent, the parsed items and modifications, and
+    the events describing what changed. The HTML chat and the JSON API both render it.
+    """
+    with timed_stage('parse'):
+        # Normalize the message once; the spaCy Doc is shared by every parser below
+        analysis = MessageAnalysis(user_input)
+        parsed = parse_message(analysis)
+    with timed_stage('handlers'):
+        result = apply_parsed_message(analysis, parsed)
+    record_result_metrics(result)
+    return result
 
-    menu_items = get_menu_items()
-    chat_html = '''
+# Function to count the intent and any parse misses of a handled message
+def record_result_metrics(result):
+    if not METRICS_ENABLED:
+        return
+    metrics.inc('chatbot_intents_total', intent=result['intent'])
+    for event in result['events']:
+        if event['type'] in PARSE_MISS_EVENTS:
+            metrics.inc('chatbot_parse_misses_total', reason=event['type'])
+
+# HTML template for the chat page. The styles and the incremental update script are static
+# files, so browsers cache them instead of downloading them with every page.
+CHAT_TEMPLATE = '''
     <!DOCTYPE html>
     <html>
     <head>
         <title>In-N-Out Chatbot</title>
-        <style>
-            body { font-family: Arial, sans-serif; background-color: #f2f2f2; }
-            .container { max-width: 800px; margin: auto; padding: 20px; }
-            .chat-box {
-                border: 1px solid #ccc;
-                border-radius: 10px;
-                padding: 10px;
-                height: 500px;
-                overflow-y: scroll;
-                background-color: #fff;
-                box-shadow: 0 4px 8px rgba(0,0,0,0.1);
-            }
-            .message {
-                margin: 10px 0;
-                padding: 10px 15px;
-                border-radius: 20px;
-                max-width: 70%;
-                word-wrap: break-word;
-                position: relative;
-                clear: both;
-            }
-            .user-message {
-                background-color: #dcf8c6;
-                float: right;
-                text-align: right;
-            }
-            .bot-message {
-                background-color: #ececec;
-                float: left;
-                text-align: left;
-            }
-            .input-area {
-                margin-top: 20px;
-                display: flex;
-                justify-content: center;
-                align-items: center;
-            }
-            input[type="text"] {
-                width: 70%;
-                padding: 10px;
-                border: 1px solid #ccc;
-                border-radius: 20px;
-                outline: none;
-                transition: border 0.3s;
-            }
-            input[type="text"]:focus {
-                border: 1px solid #66afe9;
-            }
-            input[type="submit"], input[type="button"] {
-                padding: 10px 20px;
-                margin-left: 10px;
-                border: none;
-                border-radius: 20px;
-                background-color: #28a745;
-                color: white;
-                cursor: pointer;
-                transition: background-color 0.3s;
-            }
-            input[type="submit"]:hover, input[type="button"]:hover {
-                background-color: #218838;
-            }
-            .menu {
-                margin-top: 20px;
-                text-align: left;
-            }
-            .menu ul {
-                list-style-type: none;
-                padding: 0;
-            }
-            .menu li {
-                padding: 5px 0;
-            }
-        </style>
+        <link rel="stylesheet" href="{{ url_for('static', filename='chat.css') }}">
     </head>
     <body>
         <div class="container" style="text-align: center;">
             <img src="{{ url_for('static', filename='InNOut_2021_logo.svg.png') }}" alt="In-N-Out Logo" width="200">
             <h1>In-N-Out Ordering Chatbot</h1>
-            <div class="chat-box" id="chat-box">
-                {% for message in messages %}
-                    {% if message.sender == 'user' %}
-                        <div class="message user-message">
-                            {{ message.text }}
-                        </div>
-                    {% elif message.sender == 'bot' %}
-                        <div class="message bot-message">
-                            {{ message.text|safe }}
-                        </div>
-                    {% endif %}
-                {% endfor %}
+            <div class="chat-box" id="chat-box" data-max-messages="{{ max_messages }}">
+                {% if hidden_messages %}
+                    <div class="message bot-message">
+                        🕘 {{ hidden_messages }} earlier message(s) are no longer shown.
+                    </div>
+                {% endif %}
+                {{ messages_html|safe }}
             </div>
             <div class="input-area">
-                <form method="post" style="width: 100%; display: flex; justify-content: center;">
+                <form method="post" id="chat-form" data-url="{{ url_for('.post_message') }}"
+                      style="width: 100%; display: flex; justify-content: center;">
                     <input type="text" name="message" placeholder="Type your message here..." autocomplete="off">
                     <input type="submit" value="Send">
                     <input type="submit" name="complete_order" value="Complete Order">
                 </form>
             </div>
+            <div class="order" id="order-summary" data-url="{{ url_for('.order_summary') }}"
+                 data-version="{{ order_version }}">
+                {{ order_summary|safe }}
+            </div>
             <div class="menu">
                 <h2>Menu:</h2>
                 <ul>
@@ -612,10 +1157,352 @@ def chat():
                 chatBox.scrollTop = chatBox.scrollHeight;
             };
         </script>
+        {% if incremental %}
+            <script src="{{ url_for('static', filename='chat.js') }}"></script>
+        {% endif %}
     </body>
     </html>
     '''
-    return render_template_string(chat_html, messages=session['messages'], menu=menu_items)
+
+# HTML template for chat messages, used for the whole history on the page and for the new
+# messages of each turn in incremental mode
+MESSAGES_TEMPLATE = '''
+    {%- for message in messages %}
+        {%- if message.sender == 'user' %}
+            <div class="message user-message">
+                {{ message.text }}
+            </div>
+        {%- elif message.sender == 'bot' %}
+            <div class="message bot-message">
+                {{ message.text|safe }}
+            </div>
+        {%- endif %}
+    {%- endfor %}
+    '''
+
+# Templates compiled by create_app() when the app is built
+CHAT_TEMPLATES = {'page': CHAT_TEMPLATE, 'messages': MESSAGES_TEMPLATE}
+
+# Function to compile the chat templates for an app
+def compile_chat_templates(app):
+    return {name: app.jinja_env.from_string(source) for name, source in CHAT_TEMPLATES.items()}
+
+# Function to render chat messages as HTML
+def render_messages_html(messages):
+    return render_template(current_app.extensions['chat_templates']['messages'], messages=messages)
+
+# Function to get a version string of an order that changes whenever its summary does
+def order_version(order):
+    return f"{order.order_id}-{order.revision}" if order else 'empty'
+
+# Function to render the chat page for the current session
+def render_chat_page():
+    with timed_stage('render'):
+        return render_template(current_app.extensions['chat_templates']['page'],
+                               messages_html=render_messages_html(session['messages']),
+                               hidden_messages=session.get('hidden_messages', 0), max_messages=MAX_HISTORY,
+                               order_summary=get_current_order_summary(), order_version=order_version(current_order()),
+                               menu=get_menu_items(), incremental=INCREMENTAL_UI)
+
+# Function to initialize messages in the session
+def initialize_messages():
+    if 'messages' not in session:
+        session['messages'] = []
+        # Add a welcome message from the bot
+        add_message('bot', "👋 Welcome to In-N-Out Ordering Chatbot! How can I assist you today?")
+
+# Function to add a message to the chat history
+def add_message(sender, text):
+    """
+    Appends a message to the session's chat history, which works as a ring buffer
+    of at most MAX_HISTORY messages so the session stays the same size however long
+    the conversation gets. Returns the message.
+    """
+    messages = session['messages']
+    message = {'sender': sender, 'text': text}
+    messages.append(message)
+    overflow = len(messages) - MAX_HISTORY
+    if overflow > 0:
+        del messages[:overflow]
+        if COMPACT_HISTORY:
+            session['hidden_messages'] = session.get('hidden_messages', 0) + overflow
+    session.modified = True
+    return message
+
+# Function to handle a post of the chat form: a message, or the complete order button
+def handle_chat_form(form):
+    """
+    Adds the customer's message and the bot's reply to the chat history.
+    Returns the messages added and the HTTP status to answer with.
+    """
+    if 'complete_order' in form:
+        with timed_stage('handlers'):
+            result = handle_complete_order()
+        record_result_metrics(result)
+        # Add the order summary as a bot message
+        return [add_message('bot', render_result_html(result))], 200
+    if 'message' in form and form['message'].strip() != '':
+        user_input = form['message']
+        # Add the user's message to the chat history
+        added = [add_message('user', user_input)]
+        try:
+            result = process_message(user_input)
+        except NLPOverloadedError:
+            # The parsing queue is full; ask the customer to resend rather than queue forever
+            added.append(add_message('bot', render_event_html({'type': 'nlp_busy'})))
+            return added, 503
+        # Add the bot's response to the chat history
+        added.append(add_message('bot', render_result_html(result)))
+        return added, 200
+    # Add a prompt message if the user didn't type anything
+    return [add_message('bot', render_event_html({'type': 'empty_message'}))], 200
+
+# Flask route for the chatbot
+@chatbot.route('/', methods=['GET', 'POST'])
+def chat():
+    initialize_messages()
+    if request.method == 'POST':
+        _, status = handle_chat_form(request.form)
+        if status == 503:
+            return render_chat_page(), 503, {'Retry-After': '1'}
+
+    return render_chat_page()
+
+# Incremental chat: takes the same form as the chat page and returns only the new messages
+@chatbot.route('/chat/messages', methods=['POST'])
+def post_message():
+    """
+    Answers with the HTML of the messages this post added, so a turn costs the same however
+    long the conversation is. X-Order-Version tells the page whether to fetch the order
+    summary again.
+    """
+    initialize_messages()
+    added, status = handle_chat_form(request.form)
+    with timed_stage('render'):
+        html = render_messages_html(added)
+    headers = {'X-Order-Version': order_version(current_order()), 'Cache-Control': 'no-store'}
+    if status == 503:
+        headers['Retry-After'] = '1'
+    return html, status, headers
+
+# The order summary on its own, revalidated by the page with the order version as ETag
+@chatbot.route('/chat/order')
+def order_summary():
+    version = order_version(current_order())
+    if request.if_none_match.contains(version):
+        response = current_app.response_class(status=304)
+    else:
+        with timed_stage('render'):
+            response = current_app.response_class(get_current_order_summary(), mimetype='text/html')
+    response.set_etag(version)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+# JSON chat API for kiosks and POS clients
+@chatbot.route('/api/chat', methods=['POST'])
+def api_chat():
+    """
+    Takes {"message": "..."} or {"action": "complete_order"} and returns the intent,
+    the parsed items and modifications, what changed, and the order with its total
+    after the change. Responses don't include the chat history or any HTML.
+    """
+    payload = request.get_json(silent=True)
+    # A body that is JSON but not an object ([1, 2], "hi") counts as no message
+    if not isinstance(payload, dict):
+        payload = {}
+    message = payload.get('message', '')
+    # null, numbers and other non-strings are client errors, not messages to parse
+    if not isinstance(message, str):
+        return jsonify({'error': '"message" must be a string.'}), 400
+    message = message.strip()
+    if payload.get('action') == 'complete_order':
+        with timed_stage('handlers'):
+            result = handle_complete_order()
+        record_result_metrics(result)
+    elif message:
+        try:
+            result = process_message(message)
+        except NLPOverloadedError:
+            return jsonify({'error': 'The chatbot is busy; retry shortly.'}), 503, {'Retry-After': '1'}
+    else:
+        return jsonify({'error': 'Send a non-empty "message" or "action": "complete_order".'}), 400
+
+    order_state = get_order_state()
+    return jsonify({
+        'intent': result['intent'],
+        'items': result.get('items', []),
+        'modifications': result.get('modifications', {}),
+        'changes': result['events'],
+        'order': order_state['items'],
+        'total_cents': order_state['total_cents'],
+    })
+
+# Take the store ID out of the /stores/<store_id>/ route prefix
+@chatbot.url_value_preprocessor
+def pop_store_id(endpoint, values):
+    if values and 'store_id' in values:
+        g.store_id = values.pop('store_id')
+
+# Keep links on a store's pages under its route prefix
+@chatbot.url_defaults
+def add_store_id(endpoint, values):
+    if 'store_id' in g and current_app.url_map.is_endpoint_expecting(endpoint, 'store_id'):
+        values.setdefault('store_id', g.store_id)
+
+# Pin the menu of the store the request is for, chosen by route prefix or the X-Store-Id header
+@chatbot.before_request
+def select_store_menu():
+    store_id = g.get('store_id') or request.headers.get('X-Store-Id')
+    if not store_id:
+        return
+    menu = store_menus.get(store_id)
+    if menu is None:
+        abort(404, description=f"Unknown store {store_id}")
+    g.store_id = store_id
+    g.menu = menu
+
+# Start timing each request, and sample its stacks when it was picked for profiling
+@chatbot.before_app_request
+def start_request_timer():
+    if worker_tasks_pid != os.getpid():
+        start_worker_tasks()
+    if METRICS_ENABLED:
+        g.timer = RequestTimer()
+    if profiler.rate and profiler.should_profile():
+        profiler.begin()
+        g.profiled = True
+
+# Send the stage timings back to the client when asked to
+@chatbot.after_app_request
+def add_timing_header(response):
+    if TIMING_HEADER and 'timer' in g:
+        response.headers['Server-Timing'] = g.timer.server_timing()
+    return response
+
+# Record the request's timings once the response, session save included, is done
+@chatbot.teardown_app_request
+def record_request_metrics(error=None):
+    if g.pop('profiled', False):
+        profiler.end()
+    timer = g.pop('timer', None)
+    if timer is None:
+        return
+    endpoint = (request.endpoint or 'unmatched').rpartition('.')[2]
+    metrics.observe('chatbot_request_seconds', timer.elapsed(), endpoint=endpoint)
+    for stage, seconds in timer.stages.items():
+        metrics.observe('chatbot_stage_seconds', seconds, stage=stage)
+    if current_app.logger.isEnabledFor(logging.DEBUG):
+        current_app.logger.debug("%s %s timings: %s", request.method, request.path, timer.server_timing())
+
+# Metrics in the Prometheus text format, for a scraper on the same host
+@chatbot.route('/metrics')
+def metrics_endpoint():
+    if not METRICS_ENABLED:
+        abort(404)
+    local = request.remote_addr in ('127.0.0.1', '::1')
+    if not local and (not ADMIN_TOKEN or request.headers.get('X-Admin-Token') != ADMIN_TOKEN):
+        abort(403)
+    return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+# Function to reject requests without the admin token
+def require_admin():
+    if not ADMIN_TOKEN or request.headers.get('X-Admin-Token') != ADMIN_TOKEN:
+        abort(403)
+
+# Admin endpoint to reload the menu CSV without restarting the worker
+@chatbot.route('/admin/reload-menu', methods=['POST'])
+def reload_menu():
+    require_admin()
+    force = request.args.get('force') == '1'
+    if request.args.get('background') == '1':
+        menu_manager.reload_in_background(force)
+        return jsonify({'reloading': True, 'version': menu_manager.snapshot.version}), 202
+    # The rebuild runs beside the live menu; other requests keep being served from it meanwhile
+    try:
+        stats = menu_manager.reload(force)
+    except Exception as error:
+        current_app.logger.exception("Menu reload failed")
+        return jsonify({'reloaded': False, 'error': str(error), 'version': menu_manager.snapshot.version}), 500
+    # Store menus are built again on their next request, reading their overlays again
+    store_menus.clear()
+    return jsonify(stats)
+
+# Function to get the reader of the order log, opened on first use
+def order_log_reader():
+    if 'order_log_reader' not in current_app.extensions:
+        current_app.extensions['order_log_reader'] = OrderLogReader(ORDER_LOG_PATH)
+    return current_app.extensions['order_log_reader']
+
+# Admin endpoint for consumers of completed orders: the orders after seq ?after=, oldest first
+@chatbot.route('/admin/orders', methods=['GET'])
+def completed_orders():
+    require_admin()
+    if order_log is None:
+        abort(404)
+    try:
+        after = int(request.args.get('after', '0'))
+        limit = max(1, min(int(request.args.get('limit', '100')), 1000))
+    except ValueError:
+        return jsonify({'error': '"after" and "limit" must be integers.'}), 400
+    orders = order_log_reader().read(after, limit)
+    return jsonify({'orders': orders, 'last_seq': orders[-1]['seq'] if orders else after})
+
+# Admin endpoint to start profiling a fraction of requests, optionally for a number of seconds
+@chatbot.route('/admin/profile/start', methods=['POST'])
+def start_profiling():
+    require_admin()
+    try:
+        rate = float(request.args.get('rate', '1'))
+        seconds = float(request.args.get('seconds', '0')) or None
+        status = profiler.start(rate, seconds, reset=request.args.get('keep') != '1')
+    except ValueError as error:
+        return jsonify({'error': str(error)}), 400
+    return jsonify(status)
+
+# Admin endpoint to stop profiling; the profile is written to CHATBOT_PROFILE_OUTPUT
+@chatbot.route('/admin/profile/stop', methods=['POST'])
+def stop_profiling():
+    require_admin()
+    status = profiler.stop()
+    status['summary'] = profiler.summary()
+    return jsonify(status)
+
+# Admin endpoint to download the profile so far as collapsed stacks, or its summary as JSON
+@chatbot.route('/admin/profile', methods=['GET'])
+def download_profile():
+    require_admin()
+    if request.args.get('format') == 'summary':
+        summary = profiler.summary()
+        summary['status'] = profiler.status()
+        return jsonify(summary)
+    return profiler.collapsed(), 200, {'Content-Type': 'text/plain; charset=utf-8'}
+
+# Function to create the Flask application
+def create_app():
+    """
+    Builds a Flask app serving the chatbot. The spaCy model, the menu and the other shared
+    structures are loaded once when this module is imported, so a server that imports it in
+    a master process and forks its workers afterwards shares them between the workers
+    (see serve.py).
+    """
+    app = Flask(__name__)
+    app.secret_key = 'secure_secret_key'
+
+    session_interface = create_session_interface(SESSION_BACKEND, db_path=SESSION_DB)
+    if session_interface is not None:
+        app.session_interface = session_interface
+    if METRICS_ENABLED:
+        app.session_interface = ObservedSessionInterface(app.session_interface, record_session_save,
+                                                         size_header='X-Session-Bytes' if TIMING_HEADER else None)
+
+    app.register_blueprint(chatbot)
+    # The same routes for one store, e.g. /stores/<store_id>/chat/messages
+    app.register_blueprint(chatbot, url_prefix='/stores/<store_id>', name='store')
+    # Compile the chat templates once instead of on every request
+    app.extensions['chat_templates'] = compile_chat_templates(app)
+    return app
+
+app = create_app()
 
 if __name__ == '__main__':
     app.run(debug=True)
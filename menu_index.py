@@ -0,0 +1,293 @@
+"""
+Builds, stores and loads the lemmatized menu index.
+
+Lemmatizing every menu item and ingredient is the slowest part of starting a worker, so
+the result is written to a compact JSON artifact keyed by a hash of the menu CSV, the
+aliases and the spaCy model. Workers load the artifact and only rebuild it when it is stale.
+
+Prebuild the artifact as a deploy step with:
+
+    python menu_index.py --csv "In N Out Menu.csv" --output menu_index.json
+"""
+import argparse
+import copy
+import hashlib
+import json
+import os
+import sys
+
+import spacy
+
+from fast_parser import MenuVocabulary
+from menu_matcher import FuzzyPhraseIndex, IngredientIndex, MenuPhraseIndex
+
+# Bump when the artifact layout changes so old artifacts are rebuilt
+INDEX_FORMAT_VERSION = 2
+
+DEFAULT_ARTIFACT_PATH = os.environ.get('CHATBOT_MENU_INDEX', 'menu_index.json')
+
+# Replace specific items for consistency
+ITEM_NAME_FIXES = {
+    'cheese burger': 'cheeseburger',
+    'shakes': 'shake',
+    'number 1 meal': 'number one meal',
+    'number 2 meal': 'number two meal',
+    'number 3 meal': 'number three meal',
+}
+
+# Other ways guests name menu items
+MENU_ALIASES = {
+    'cheese burger': 'cheeseburger',
+    'hot chocolate': 'hot cocoa',
+    # A plain 'burger' used to find the cheeseburger by substring before the phrase index
+    'burger': 'cheeseburger',
+}
+
+# Kinds of items that their names don't say, for questions like "which drinks have milk";
+# the kind in an item's name ('large drink', 'cheeseburger') already counts
+MENU_KINDS = {
+    'drink': ['shake', 'milk', 'hot cocoa', 'coffee'],
+}
+
+
+# Function to describe the spaCy pipeline, since its lemmas end up in the index
+def model_signature(nlp):
+    return f"{nlp.meta.get('lang')}_{nlp.meta.get('name')}-{nlp.meta.get('version')}" \
+           f"/spacy-{spacy.__version__}/{','.join(nlp.pipe_names)}"
+
+
+# Function to compute the key an artifact must carry to be valid for this menu and model
+def index_key(csv_path, nlp, aliases):
+    digest = hashlib.sha256()
+    with open(csv_path, 'rb') as csv_file:
+        digest.update(csv_file.read())
+    digest.update(json.dumps(aliases or {}, sort_keys=True).encode('utf-8'))
+    digest.update(model_signature(nlp).encode('utf-8'))
+    digest.update(str(INDEX_FORMAT_VERSION).encode('utf-8'))
+    return digest.hexdigest()
+
+
+# Function to normalize a menu item name: lowercase, hyphens to spaces, consistent spellings
+def normalize_item_name(name):
+    name = name.lower().replace('-', ' ')
+    return ITEM_NAME_FIXES.get(name, name)
+
+
+# Function to lemmatize many phrases in one batch
+def lemmatize_phrases(nlp, phrases):
+    return [' '.join([token.lemma_ for token in doc]) for doc in nlp.pipe(phrases)]
+
+
+# Function to fingerprint one CSV row, so a rebuild can tell which rows changed
+def row_hash(name, price, ingredients):
+    return hashlib.sha1(json.dumps([name, price, ingredients]).encode('utf-8')).hexdigest()[:16]
+
+
+# Function to build the menu index from the CSV
+def build_menu_index(csv_path, nlp, aliases=MENU_ALIASES, previous=None):
+    """
+    Builds the menu index. When a previous index built with the same model is given,
+    lemmas of phrases it already knows are reused and only new phrases go through spaCy.
+    Build statistics are stored under 'build'.
+    """
+    # pandas is only needed when the index has to be rebuilt, so workers with a fresh artifact skip importing it
+    import pandas as pd
+
+    menu_data = pd.read_csv(csv_path)
+    names = [normalize_item_name(name) for name in menu_data['Menu Item']]
+    prices = [float(price) for price in menu_data['Price']]
+    ingredient_lists = [
+        [ingredient.strip().lower() for ingredient in str(ingredients).split(',')]
+        for ingredients in menu_data['Ingredients']
+    ]
+    alias_names = list((aliases or {}).keys())
+
+    known_lemmas = {}
+    previous_rows = set()
+    if previous and previous.get('model') == model_signature(nlp):
+        known_lemmas = previous.get('lemmas', {})
+        previous_rows = {entry['row'] for entry in previous['items']}
+
+    # Lemmatize every distinct phrase the previous index doesn't know, all in one nlp.pipe batch
+    phrases = set(names) | set(alias_names)
+    for ingredients in ingredient_lists:
+        phrases.update(ingredients)
+    new_phrases = sorted(phrase for phrase in phrases if phrase not in known_lemmas)
+    lemmas = {phrase: known_lemmas[phrase] for phrase in phrases if phrase in known_lemmas}
+    lemmas.update(zip(new_phrases, lemmatize_phrases(nlp, new_phrases)))
+
+    items = []
+    changed_rows = 0
+    for name, price, ingredients in zip(names, prices, ingredient_lists):
+        row = row_hash(name, price, ingredients)
+        if row not in previous_rows:
+            changed_rows += 1
+        items.append({
+            'name': name,
+            'price': price,
+            'lemma': lemmas[name],
+            'ingredients': [lemmas[ingredient] for ingredient in ingredients],
+            'row': row,
+        })
+
+    return {
+        'key': index_key(csv_path, nlp, aliases),
+        'format': INDEX_FORMAT_VERSION,
+        'model': model_signature(nlp),
+        'items': items,
+        'aliases': {lemmas[alias]: aliases[alias] for alias in alias_names},
+        'lemmas': lemmas,
+        'build': {
+            'rows': len(items),
+            'changed_rows': changed_rows,
+            'phrases_lemmatized': len(new_phrases),
+            'phrases_reused': len(phrases) - len(new_phrases),
+        },
+    }
+
+
+# Function to intern the strings of an index, so every structure built from it shares one copy of each name
+def intern_index(index):
+    """
+    Replaces the item names, lemmas and ingredients of the index in place by interned
+    strings. Indexes loaded from JSON hold a separate copy of a word for every place it
+    appears; after interning, the snapshots of every store point at the same strings.
+    """
+    index['lemmas'] = {sys.intern(phrase): sys.intern(lemma) for phrase, lemma in index['lemmas'].items()}
+    index['aliases'] = {sys.intern(alias): sys.intern(item) for alias, item in index['aliases'].items()}
+    for entry in index['items']:
+        entry['name'] = sys.intern(entry['name'])
+        entry['lemma'] = sys.intern(entry['lemma'])
+        entry['ingredients'] = [sys.intern(ingredient) for ingredient in entry['ingredients']]
+    return index
+
+
+# Function to write the index artifact without leaving a half-written file behind
+def save_menu_index(index, artifact_path):
+    temp_path = f"{artifact_path}.{os.getpid()}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as artifact:
+        json.dump(index, artifact, separators=(',', ':'))
+    os.replace(temp_path, artifact_path)
+
+
+# Function to load the index artifact, rebuilding it when it is missing or stale
+def load_menu_index(csv_path, nlp, aliases=MENU_ALIASES, artifact_path=DEFAULT_ARTIFACT_PATH):
+    key = index_key(csv_path, nlp, aliases)
+    previous = None
+    try:
+        with open(artifact_path, encoding='utf-8') as artifact:
+            previous = json.load(artifact)
+        if previous.get('key') == key:
+            return previous
+        if previous.get('format') != INDEX_FORMAT_VERSION:
+            previous = None
+    except (OSError, ValueError):
+        pass
+
+    # A stale artifact still has lemmas for every row that didn't change
+    index = build_menu_index(csv_path, nlp, aliases, previous)
+    try:
+        save_menu_index(index, artifact_path)
+    except OSError:
+        # A read-only deploy can still serve from the freshly built index
+        pass
+    return index
+
+
+class MenuSnapshot:
+    """
+    Lookup structures for one version of the menu, built from a menu index.
+
+    version identifies everything in the snapshot, prices included. items_version only
+    changes with the items, ingredients and aliases, so parses and ingredient answers can be
+    shared by snapshots that differ in prices alone. base_version is the version of the base
+    menu a store menu was built on (for the base menu it is its own version).
+    """
+
+    def __init__(self, index):
+        intern_index(index)
+        # The index this snapshot was built from, which store menus are built on
+        self.index = index
+        self.version = index['key']
+        self.items_version = index['key']
+        self.base_version = index.get('base', index['key'])
+        # Snapshot whose lookup structures this one shares, see with_prices()
+        self.parent = None
+        self.menu_dict = {}
+        self.lemmatized_menu_items = {}
+        self.ingredients_dict = {}
+        self.phrase_index = MenuPhraseIndex()
+        self.ingredient_index = IngredientIndex()
+        # Misspelled item and ingredient names are matched against these
+        self.fuzzy_items = FuzzyPhraseIndex()
+        self.fuzzy_ingredients = FuzzyPhraseIndex()
+        # Words of this menu for parsing messages without spaCy
+        self.vocabulary = MenuVocabulary(index)
+
+        for entry in index['items']:
+            self.menu_dict[entry['name']] = entry['price']
+            self.lemmatized_menu_items[entry['lemma']] = entry['name']
+            self.ingredients_dict[entry['name']] = entry['ingredients']
+
+        # A meal lists the items in it, so index the ingredients of those items under the meal too
+        for entry in index['items']:
+            ingredients = list(entry['ingredients'])
+            for ingredient in entry['ingredients']:
+                component = self.lemmatized_menu_items.get(ingredient)
+                if component and component != entry['name']:
+                    ingredients.extend(self.ingredients_dict[component])
+            self.ingredient_index.add_item(entry['name'], ingredients)
+        for kind, items in MENU_KINDS.items():
+            for item in items:
+                self.ingredient_index.add_kind(kind, item)
+
+        # Let ingredients also be found as the CSV spells them ('onions' for the lemma 'onion')
+        for phrase, lemma in index['lemmas'].items():
+            if lemma in self.ingredient_index:
+                self.ingredient_index.add_spelling(phrase, lemma)
+        self.ingredient_index.add_word_spellings()
+        for phrase, ingredient in self.ingredient_index.spellings():
+            self.fuzzy_ingredients.add(phrase, ingredient)
+
+        # Menu phrases go in before aliases so an alias never shadows a real item
+        for lemmatized_item, item in self.lemmatized_menu_items.items():
+            self.phrase_index.add(lemmatized_item, item)
+        for alias, item in index['aliases'].items():
+            if item in self.menu_dict:
+                self.phrase_index.add(alias, item, alias=True)
+        for phrase, item in self.phrase_index.phrases():
+            self.fuzzy_items.add(phrase, item)
+
+    def with_prices(self, version, prices):
+        """
+        Returns a snapshot that shares every lookup structure of this one and only has its own
+        menu_dict, with the prices in prices replacing those of this snapshot.
+        """
+        snapshot = copy.copy(self)
+        snapshot.version = version
+        snapshot.parent = self
+        snapshot.menu_dict = {name: prices.get(name, price) for name, price in self.menu_dict.items()}
+        return snapshot
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build the lemmatized menu index artifact.')
+    parser.add_argument('--csv', default='In N Out Menu.csv', help='menu CSV to index')
+    parser.add_argument('--output', default=DEFAULT_ARTIFACT_PATH, help='where to write the artifact')
+    parser.add_argument('--force', action='store_true', help='rebuild even if the artifact is up to date')
+    args = parser.parse_args()
+
+    # Use the same pipeline profile as the app so the key matches what workers compute
+    from nlp_pipeline import load_pipeline
+    nlp = load_pipeline()
+
+    if args.force:
+        index = build_menu_index(args.csv, nlp)
+        save_menu_index(index, args.output)
+    else:
+        index = load_menu_index(args.csv, nlp, artifact_path=args.output)
+    print(f"Menu index for {len(index['items'])} items written to {args.output} (key {index['key'][:12]})")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,370 @@
+import math
+from collections import Counter, namedtuple
+
+# A menu phrase found in a message: token positions [start, end) and the menu item it names
+MenuMention = namedtuple('MenuMention', ['start', 'end', 'item'])
+
+
+class MenuPhraseIndex:
+    """
+    Prebuilt index over lemmatized menu phrases and aliases.
+
+    Phrases are stored as token tuples in a trie for scanning whole messages, plus
+    dictionaries for resolving a single candidate phrase without looping over the menu.
+    When two phrases map to different items, the one added first wins, so menu items
+    should be added before aliases. Aliases only match in full, never as partial phrases.
+    """
+
+    def __init__(self):
+        self._root = {}
+        self._exact = {}
+        self._spans = {}
+        self._heads = {}
+
+    def add(self, phrase, item, alias=False):
+        tokens = tuple(phrase.split())
+        if not tokens:
+            return
+
+        self._exact.setdefault(tokens, item)
+        if not alias:
+            self._heads.setdefault(tokens[0], item)
+            # Every contiguous run of tokens inside the phrase, so 'fry' resolves to 'french fries'
+            for start in range(len(tokens)):
+                for end in range(start + 1, len(tokens) + 1):
+                    self._spans.setdefault(tokens[start:end], item)
+
+        node = self._root
+        for token in tokens:
+            node = node.setdefault(token, {})
+        # None marks the end of a phrase; tokens are always strings
+        node.setdefault(None, item)
+
+    def resolve(self, tokens):
+        """
+        Resolves one candidate phrase (a sequence of lemmas) to a menu item.
+        An exact phrase wins over a phrase that only contains the candidate.
+        """
+        tokens = tuple(tokens)
+        if not tokens:
+            return None
+        return self._exact.get(tokens) or self._spans.get(tokens)
+
+    def resolve_exact(self, tokens):
+        """
+        Resolves a candidate phrase only when it is a whole menu phrase or alias, never a part
+        of a longer one ('shake' but not 'meal').
+        """
+        return self._exact.get(tuple(tokens))
+
+    def find_mentions(self, tokens):
+        """
+        Finds every menu phrase in a token sequence in a single left-to-right pass.
+        At each position the longest phrase wins, and mentions never overlap.
+        """
+        mentions = []
+        position = 0
+        while position < len(tokens):
+            node = self._root
+            match = None
+            cursor = position
+            while cursor < len(tokens) and tokens[cursor] in node:
+                node = node[tokens[cursor]]
+                cursor += 1
+                if None in node:
+                    match = MenuMention(position, cursor, node[None])
+            if match:
+                mentions.append(match)
+                position = match.end
+            else:
+                position += 1
+        return mentions
+
+    def phrases(self):
+        """
+        Yields (phrase, item) for every whole phrase and every ending of one ('fry' of 'french
+        fry'), with the item resolve() gives it. Endings are what guests shorten names to;
+        words from the middle ('three' of 'number three meal') are left out.
+        """
+        for tokens in self._exact:
+            for start in range(len(tokens)):
+                item = self.resolve(tokens[start:])
+                if item:
+                    yield ' '.join(tokens[start:]), item
+
+    def find_head_word(self, tokens):
+        """
+        Returns the first item whose phrase starts with one of the tokens, e.g. 'hot' for 'hot cocoa'.
+        """
+        for token in tokens:
+            item = self._heads.get(token)
+            if item:
+                return item
+        return None
+
+
+# Function to list the spellings a word is looked up by: as written, plural and singular
+def _word_forms(word):
+    forms = {word, word + 's', word + 'es'}
+    if word.endswith('y'):
+        forms.add(word[:-1] + 'ies')
+    if word.endswith('ies'):
+        forms.add(word[:-3] + 'y')
+    if word.endswith('s'):
+        forms.add(word[:-1])
+    return forms
+
+
+class IngredientIndex:
+    """
+    Inverted index from ingredients to the menu items that contain them.
+
+    Items get IDs in menu order, and the items with an ingredient are kept as one integer
+    bitset, so "with milk and without cheese" is one AND and one AND NOT per ingredient
+    however many items the menu has. Ingredient phrases are recognized by their CSV
+    spelling, their lemma and simple plurals, so a query never needs spaCy.
+    """
+
+    def __init__(self):
+        # Item names by ID
+        self.items = []
+        # Bitset with every item
+        self.all_items = 0
+        self._with = {}
+        self._words = {}
+        self._phrases = MenuPhraseIndex()
+
+    def add_item(self, item, ingredients):
+        bit = 1 << len(self.items)
+        self.items.append(item)
+        self.all_items |= bit
+        for ingredient in ingredients:
+            if ingredient not in self._with:
+                self.add_spelling(ingredient, ingredient)
+            self._with[ingredient] = self._with.get(ingredient, 0) | bit
+        # The last word of the name says what kind of item it is ('drink', 'shake'), and long
+        # enough endings of it cover compounds, so 'burger' finds 'cheeseburger'
+        head = item.split()[-1]
+        for end in range(max(len(head) - 5, 0) + 1):
+            for form in _word_forms(head[end:]):
+                self._words[form] = self._words.get(form, 0) | bit
+
+    def add_kind(self, kind, item):
+        """
+        Counts an item as a kind its name doesn't say, such as the shake as a 'drink'.
+        Items not on the menu are skipped.
+        """
+        if item not in self.items:
+            return
+        bit = 1 << self.items.index(item)
+        for form in _word_forms(kind):
+            self._words[form] = self._words.get(form, 0) | bit
+
+    def add_spelling(self, phrase, ingredient):
+        """
+        Adds another way of writing an ingredient, such as the CSV spelling of its lemma.
+        """
+        words = phrase.split()
+        if not words:
+            return
+        for form in _word_forms(words[-1]):
+            self._phrases.add(' '.join(words[:-1] + [form]), ingredient)
+
+    def add_word_spellings(self):
+        """
+        Lets each word of a multi-word ingredient find it on its own, so 'fries' finds
+        'french fry' and 'beef' finds 'beef patty'. Call it once every item is added. Words
+        that are ingredients themselves ('coke' of 'diet coke'), that several ingredients
+        share, or that are a kind of several items ('drink' of 'medium drink') are skipped.
+        """
+        owners = {}
+        for ingredient in self._with:
+            words = ingredient.split()
+            if len(words) > 1:
+                for word in set(words):
+                    owners.setdefault(word, set()).add(ingredient)
+        for word, ingredients in owners.items():
+            if len(ingredients) > 1 or word in self._with or bin(self.items_named(word)).count('1') > 1:
+                continue
+            self.add_spelling(word, ingredients.pop())
+
+    def __contains__(self, ingredient):
+        return ingredient in self._with
+
+    def spellings(self):
+        """
+        Yields (spelling, ingredient) for every spelling added and every ending of one.
+        """
+        return self._phrases.phrases()
+
+    def find_ingredients(self, tokens):
+        """
+        Finds the ingredients named in a sequence of words, as MenuMentions whose item is
+        the ingredient.
+        """
+        return self._phrases.find_mentions(tokens)
+
+    def items_named(self, word):
+        """
+        Returns the bitset of items whose kind is word ('drinks', 'burger'), or 0.
+        """
+        return self._words.get(word, 0)
+
+    def search(self, with_ingredients=(), without_ingredients=(), scope=None):
+        """
+        Returns the bitset of items in scope (all items when None) that contain every
+        ingredient in with_ingredients and none of without_ingredients.
+        """
+        bits = self.all_items if scope is None else scope
+        for ingredient in with_ingredients:
+            bits &= self._with.get(ingredient, 0)
+        for ingredient in without_ingredients:
+            bits &= ~self._with.get(ingredient, 0)
+        return bits
+
+    def names(self, bits):
+        """
+        Returns the names of the items in a bitset, in menu order.
+        """
+        names = []
+        while bits:
+            low = bits & -bits
+            names.append(self.items[low.bit_length() - 1])
+            bits ^= low
+        return names
+
+
+# Function to list the character trigrams of a phrase, padded so its first and last letters count too
+def _trigrams(phrase):
+    padded = f" {phrase} "
+    return {padded[start:start + 3] for start in range(len(padded) - 2)}
+
+
+# Function to compute the edit distance between two strings, or None when it is over limit
+def bounded_edit_distance(first, second, limit):
+    """
+    Optimal string alignment distance: inserting, deleting or replacing a character, or
+    swapping two neighbouring ones, costs 1. Only the band of width 2 * limit + 1 around
+    the diagonal is computed, and the computation stops once every path is over limit.
+    """
+    if abs(len(first) - len(second)) > limit:
+        return None
+    over = limit + 1
+    before = None
+    previous = [column if column <= limit else over for column in range(len(second) + 1)]
+    for row in range(1, len(first) + 1):
+        current = [over] * (len(second) + 1)
+        if row <= limit:
+            current[0] = row
+        low, high = max(1, row - limit), min(len(second), row + limit)
+        character = first[row - 1]
+        best = over
+        for column in range(low, high + 1):
+            distance = previous[column - 1] + (character != second[column - 1])
+            if previous[column] + 1 < distance:
+                distance = previous[column] + 1
+            if current[column - 1] + 1 < distance:
+                distance = current[column - 1] + 1
+            if (row > 1 and column > 1 and character == second[column - 2]
+                    and first[row - 2] == second[column - 1] and before[column - 2] + 1 < distance):
+                distance = before[column - 2] + 1
+            if distance > over:
+                distance = over
+            current[column] = distance
+            if distance < best:
+                best = distance
+        if best > limit and current[low - 1] > limit:
+            return None
+        before, previous = previous, current
+    return previous[-1] if previous[-1] <= limit else None
+
+
+class FuzzyPhraseIndex:
+    """
+    Finds the phrase closest to a misspelled one ('cheesburger', 'large drnk') through an
+    inverted index from character trigrams to phrases.
+
+    Phrases are filed under each of their trigrams by length. A lookup counts the trigrams
+    shared with the text only for phrases whose length is within reach of the threshold,
+    checks the max_candidates phrases sharing the most with bounded_edit_distance, and
+    ignores texts shorter than min_length or longer than max_length, so its cost stays
+    small as the menu grows. The confidence of a match is 1 - distance / length of the
+    longer string, and a phrase of the index itself always matches with confidence 1.
+    """
+
+    def __init__(self, max_candidates=6, min_length=5, max_length=32):
+        self.max_candidates = max_candidates
+        self.min_length = min_length
+        self.max_length = max_length
+        self._phrases = []
+        self._values = []
+        self._ids = {}
+        # Number of distinct trigrams of each phrase
+        self._sizes = []
+        self._trigrams = {}
+
+    def __len__(self):
+        return len(self._phrases)
+
+    def add(self, phrase, value):
+        if not phrase or phrase in self._ids:
+            return
+        phrase_id = len(self._phrases)
+        self._ids[phrase] = phrase_id
+        self._phrases.append(phrase)
+        self._values.append(value)
+        trigrams = _trigrams(phrase)
+        self._sizes.append(len(trigrams))
+        for trigram in trigrams:
+            self._trigrams.setdefault(trigram, {}).setdefault(len(phrase), []).append(phrase_id)
+
+    def lookup(self, text, threshold, among=None):
+        """
+        Returns (value, confidence) for the closest phrase to text with a confidence of at
+        least threshold, or None; a threshold of 1 or more turns matching off. Only phrases
+        whose value is in among are considered when it is given. When phrases of different
+        values are equally close, the text is too ambiguous to correct and None is returned.
+        """
+        if threshold >= 1:
+            return None
+        phrase_id = self._ids.get(text)
+        if phrase_id is not None and (among is None or self._values[phrase_id] in among):
+            return self._values[phrase_id], 1.0
+        if not self.min_length <= len(text) <= self.max_length:
+            return None
+        # Phrases shorter or longer than this need more edits than the threshold allows
+        shortest = math.ceil(len(text) * threshold - 1e-9)
+        longest = int(len(text) / threshold + 1e-9)
+        trigrams = _trigrams(text)
+        shared = Counter()
+        for trigram in trigrams:
+            by_length = self._trigrams.get(trigram)
+            if by_length:
+                for length in range(shortest, longest + 1):
+                    phrase_ids = by_length.get(length)
+                    if phrase_ids:
+                        shared.update(phrase_ids)
+        if among is not None:
+            shared = Counter({phrase_id: count for phrase_id, count in shared.items() if self._values[phrase_id] in among})
+
+        best, best_confidence, tied = None, threshold, False
+        for phrase_id, count in shared.most_common(self.max_candidates):
+            phrase = self._phrases[phrase_id]
+            longest = max(len(text), len(phrase))
+            # The epsilon keeps a rounding error from shrinking the limit below a whole edit
+            limit = int(longest * (1 - best_confidence) + 1e-9)
+            # Each edit changes at most four trigrams (a swap touches four), so too few shared
+            # ones rule the phrase out
+            if count < max(len(trigrams), self._sizes[phrase_id]) - 4 * limit:
+                continue
+            distance = bounded_edit_distance(text, phrase, limit)
+            if distance is None:
+                continue
+            confidence = 1 - distance / longest
+            if best is None or confidence > best_confidence:
+                best, best_confidence, tied = self._values[phrase_id], confidence, False
+            elif confidence == best_confidence and self._values[phrase_id] != best:
+                tied = True
+        if best is None or tied:
+            return None
+        return best, best_confidence
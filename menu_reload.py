@@ -0,0 +1,113 @@
+import logging
+import os
+import threading
+import time
+
+from menu_index import (DEFAULT_ARTIFACT_PATH, MENU_ALIASES, MenuSnapshot, build_menu_index, index_key,
+                        load_menu_index, save_menu_index)
+
+logger = logging.getLogger(__name__)
+
+
+class MenuManager:
+    """
+    Owns the live menu snapshot and replaces it when the menu CSV changes.
+
+    A reload builds a complete new MenuSnapshot next to the live one, re-lemmatizing only
+    the phrases that changed, and then swaps a single reference. Readers that grabbed the
+    old snapshot keep using it until they finish, so every request sees one consistent menu.
+    """
+
+    def __init__(self, csv_path, nlp, aliases=MENU_ALIASES, artifact_path=DEFAULT_ARTIFACT_PATH):
+        self.csv_path = csv_path
+        self.nlp = nlp
+        self.aliases = aliases
+        self.artifact_path = artifact_path
+        # Statistics of the most recent reload, or None before the first one
+        self.last_reload = None
+
+        self._reload_lock = threading.Lock()
+        self._watcher = None
+        self._index = load_menu_index(csv_path, nlp, aliases, artifact_path)
+        self.snapshot = MenuSnapshot(self._index)
+
+    def reload(self, force=False):
+        """
+        Rebuilds the menu if the CSV changed (or always, with force) and swaps it in.
+        Returns a dictionary describing what happened and how long it took.
+        """
+        with self._reload_lock:
+            start = time.perf_counter()
+            key = index_key(self.csv_path, self.nlp, self.aliases)
+            if key == self.snapshot.version and not force:
+                return {'reloaded': False, 'version': key}
+
+            index = build_menu_index(self.csv_path, self.nlp, self.aliases, previous=self._index)
+            snapshot = MenuSnapshot(index)
+            build_ms = (time.perf_counter() - start) * 1000
+
+            # Swapping one reference is atomic, so requests see either the old menu or the new one
+            previous_version = self.snapshot.version
+            self._index = index
+            self.snapshot = snapshot
+
+            try:
+                save_menu_index(index, self.artifact_path)
+            except OSError:
+                logger.warning("Could not write menu index artifact to %s", self.artifact_path)
+
+            stats = dict(index['build'])
+            stats.update({
+                'reloaded': True,
+                'version': snapshot.version,
+                'previous_version': previous_version,
+                'reload_ms': round(build_ms, 2),
+            })
+            self.last_reload = stats
+            logger.info(
+                "Menu reloaded in %.1f ms: %d of %d rows changed, %d phrases lemmatized, %d reused",
+                build_ms, stats['changed_rows'], stats['rows'], stats['phrases_lemmatized'], stats['phrases_reused'],
+            )
+            return stats
+
+    def reload_in_background(self, force=False):
+        thread = threading.Thread(target=self._safe_reload, args=(force,), name='menu-reload', daemon=True)
+        thread.start()
+        return thread
+
+    def _safe_reload(self, force=False):
+        try:
+            self.reload(force)
+        except Exception:
+            # A bad CSV must not take the live menu down; keep serving the current snapshot
+            logger.exception("Menu reload failed; keeping menu version %s", self.snapshot.version)
+
+    def start_watcher(self, interval):
+        """
+        Polls the menu CSV every interval seconds and reloads it when it changes.
+        """
+        # A watcher inherited through fork is not running in this process, so start a new one
+        if self._watcher is not None and self._watcher.is_alive():
+            return self._watcher
+
+        last_seen = self._file_state()
+
+        def watch():
+            nonlocal last_seen
+            while True:
+                time.sleep(interval)
+                state = self._file_state()
+                if state != last_seen:
+                    last_seen = state
+                    self._safe_reload()
+
+        self._watcher = threading.Thread(target=watch, name='menu-watcher', daemon=True)
+        self._watcher.start()
+        return self._watcher
+
+    def _file_state(self):
+        try:
+            stat = os.stat(self.csv_path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
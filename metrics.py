@@ -0,0 +1,210 @@
+"""
+Request instrumentation for the chatbot: per-request stage timers and a small metrics registry
+that renders counters, gauges and histograms in the Prometheus text format.
+
+Stage timers keep exclusive time, so when the spaCy stage runs inside the parsing stage the
+spaCy time is counted once, under spaCy, and the stages of a request add up to its total.
+"""
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+# Latency buckets in seconds, from sub-millisecond intent matching up to slow spaCy requests
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+# Shared no-op context manager returned when timing is off
+NULL_STAGE = nullcontext()
+
+
+# Function to read how much of a process's memory is shared with other processes
+def process_memory(pid='self'):
+    """
+    Returns rss, pss, unique and shared memory in bytes from /proc/<pid>/smaps_rollup, or None
+    where it isn't available (not Linux, or the process is gone). unique is the memory only
+    this process maps (private pages); shared pages are also mapped by other processes, such
+    as the model pages a forked worker still shares with its master.
+    """
+    try:
+        with open(f"/proc/{pid}/smaps_rollup", encoding='ascii') as smaps:
+            fields = {}
+            for line in smaps:
+                parts = line.split()
+                if len(parts) == 3 and parts[2] == 'kB':
+                    fields[parts[0].rstrip(':')] = int(parts[1]) * 1024
+    except (OSError, ValueError):
+        return None
+    return {
+        'rss': fields.get('Rss', 0),
+        'pss': fields.get('Pss', 0),
+        'unique': fields.get('Private_Clean', 0) + fields.get('Private_Dirty', 0),
+        'shared': fields.get('Shared_Clean', 0) + fields.get('Shared_Dirty', 0),
+    }
+
+
+class RequestTimer:
+    """
+    Collects how long each stage of one request took, in seconds of exclusive time.
+    A stage entered several times in one request accumulates.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages = {}
+        self._stack = []
+
+    @contextmanager
+    def stage(self, name):
+        # Each open stage is [start, time spent in nested stages]
+        frame = [time.perf_counter(), 0.0]
+        self._stack.append(frame)
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - frame[0]
+            self._stack.pop()
+            self.add(name, elapsed - frame[1])
+            if self._stack:
+                self._stack[-1][1] += elapsed
+
+    def add(self, name, seconds):
+        """
+        Records time for a stage that was measured elsewhere, such as the session save.
+        """
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+    def server_timing(self):
+        """
+        Returns the stage timings as a Server-Timing header value (durations in milliseconds).
+        """
+        entries = [f"{name};dur={seconds * 1000:.2f}" for name, seconds in self.stages.items()]
+        entries.append(f"total;dur={self.elapsed() * 1000:.2f}")
+        return ', '.join(entries)
+
+
+class Histogram:
+    """
+    Fixed-bucket histogram with a running sum and count.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+
+# Function to format a label set for the text format
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    escaped = []
+    for key, value in pairs:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        escaped.append(f'{key}="{value}"')
+    return '{' + ','.join(escaped) + '}'
+
+
+# Function to format a number for the text format
+def _format_value(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class MetricsRegistry:
+    """
+    Thread-safe store of counters, gauges and histograms, keyed by metric name and labels.
+
+    Metrics are declared once with describe(); collectors are callables run at render time
+    that return (name, labels, value) samples for metrics kept elsewhere, such as the
+    intent router's hit counter.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._meta = {}
+        self._values = {}
+        self._collectors = []
+
+    def describe(self, name, kind, help_text, buckets=DEFAULT_BUCKETS):
+        if kind not in ('counter', 'gauge', 'histogram'):
+            raise ValueError(f"Unknown metric type '{kind}'")
+        self._meta[name] = (kind, help_text, buckets)
+        self._values.setdefault(name, {})
+
+    def add_collector(self, collector):
+        self._collectors.append(collector)
+
+    def inc(self, name, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._values[name]
+            series[key] = series.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[name][key] = value
+
+    def set_max(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._values[name]
+            if value > series.get(key, value - 1):
+                series[key] = value
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._values[name]
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = Histogram(self._meta[name][2])
+            histogram.observe(value)
+
+    def value(self, name, **labels):
+        """
+        Returns the current value of a counter or gauge, or the histogram, for one label set.
+        """
+        return self._values.get(name, {}).get(tuple(sorted(labels.items())))
+
+    def render(self):
+        """
+        Returns every metric in the Prometheus text exposition format.
+        """
+        collected = {}
+        for collector in self._collectors:
+            for name, labels, value in collector():
+                collected.setdefault(name, {})[tuple(sorted(labels.items()))] = value
+
+        lines = []
+        with self._lock:
+            for name, (kind, help_text, buckets) in self._meta.items():
+                series = dict(self._values.get(name, {}))
+                series.update(collected.get(name, {}))
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in sorted(series.items()):
+                    if kind != 'histogram':
+                        lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(value.buckets, value.counts):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{_format_labels(labels, [('le', bound)])} {cumulative}")
+                    lines.append(f"{name}_bucket{_format_labels(labels, [('le', '+Inf')])} {value.count}")
+                    lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(value.sum)}")
+                    lines.append(f"{name}_count{_format_labels(labels)} {value.count}")
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,62 @@
+import os
+
+import spacy
+
+# spaCy model used by the chatbot; can be a package name or a path to a model directory
+DEFAULT_MODEL = os.environ.get('CHATBOT_SPACY_MODEL', 'en_core_web_sm')
+
+# Pipeline profiles: which components to leave out when loading the model.
+# Excluded components are never loaded; disabled ones are loaded but skipped when processing text.
+PIPELINE_PROFILES = {
+    # Every component the model ships with
+    'full': {'exclude': [], 'disable': []},
+    # Only what the chatbot reads: lemmas, POS tags, noun chunks and sentences.
+    # The parser provides noun chunks and sentence boundaries, so NER and the senter can go.
+    'lean': {'exclude': ['ner', 'senter'], 'disable': []},
+}
+
+DEFAULT_PROFILE = os.environ.get('CHATBOT_NLP_PROFILE', 'lean')
+
+# Sentence used to check that a loaded pipeline still provides everything the parsers use
+PROBE_TEXT = "I would like two cheeseburgers with no onions. Remove the large drink."
+
+
+# Function to load the spaCy pipeline for a profile
+def load_pipeline(profile=DEFAULT_PROFILE, model=DEFAULT_MODEL):
+    if profile not in PIPELINE_PROFILES:
+        raise ValueError(f"Unknown NLP profile '{profile}'. Choose one of: {', '.join(PIPELINE_PROFILES)}")
+
+    settings = PIPELINE_PROFILES[profile]
+    nlp = spacy.load(model, exclude=settings['exclude'], disable=settings['disable'])
+    verify_pipeline(nlp)
+    return nlp
+
+
+# Function to check that a pipeline still provides noun chunks, lemmas, POS tags and sentences
+def verify_pipeline(nlp):
+    """
+    Runs the probe sentence through the pipeline and raises a RuntimeError naming
+    every attribute the chatbot relies on that the pipeline no longer provides.
+    """
+    doc = nlp(PROBE_TEXT)
+    problems = []
+
+    if not doc.has_annotation('POS'):
+        problems.append('pos_ (no tagger or attribute_ruler)')
+    if not doc.has_annotation('LEMMA'):
+        problems.append('lemma_ (no lemmatizer)')
+    try:
+        if not list(doc.noun_chunks):
+            problems.append('noun_chunks (no chunks found in the probe sentence)')
+    except ValueError:
+        problems.append('noun_chunks (no dependency parse)')
+    try:
+        if len(list(doc.sents)) < 2:
+            problems.append('sents (probe sentence was not split)')
+    except ValueError:
+        problems.append('sents (no sentence boundaries)')
+
+    if problems:
+        raise RuntimeError(
+            f"spaCy pipeline {nlp.pipe_names} is missing features the chatbot needs: {'; '.join(problems)}"
+        )
@@ -0,0 +1,198 @@
+"""
+Micro-batching spaCy inference shared by all request threads.
+
+Request threads submit their normalized message to a bounded queue and wait. A dispatcher
+thread collects queued messages for up to batch_window seconds (or until batch_size of them
+are waiting), and hands the batch to a pool of worker processes that each hold their own
+copy of the pipeline and run nlp.pipe over it. Parses come back as one DocBin per batch and
+are turned into Docs on the web process's vocab, so the rest of the code can't tell them
+apart from Docs made by calling nlp directly.
+
+At most one batch per worker is in flight; while all workers are busy, new messages wait in
+the queue and go out together in the next batch. When the queue is full, submit raises
+NLPOverloadedError right away instead of letting requests pile up.
+"""
+import logging
+import multiprocessing
+import queue
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+from spacy.tokens import DocBin
+
+from nlp_pipeline import DEFAULT_MODEL, DEFAULT_PROFILE, load_pipeline
+
+logger = logging.getLogger(__name__)
+
+# Token attributes the chatbot reads: lemmas, POS tags, the parse (noun chunks) and sentences
+DOC_ATTRS = ['ORTH', 'NORM', 'LEMMA', 'POS', 'TAG', 'HEAD', 'DEP', 'SENT_START']
+
+# Pipeline of the current worker process
+_worker_nlp = None
+
+
+class NLPOverloadedError(RuntimeError):
+    """
+    Raised when the inference queue is full, a parse didn't come back in time, or the worker
+    pool failed (a worker died and the pool is restarting, or it is shutting down).
+    """
+
+
+# Function to load the pipeline once in each worker process
+def _init_worker(profile, model):
+    global _worker_nlp
+    _worker_nlp = load_pipeline(profile, model)
+
+
+# Function to parse one batch of texts in a worker process
+def _parse_batch(texts):
+    doc_bin = DocBin(attrs=DOC_ATTRS)
+    for doc in _worker_nlp.pipe(texts, batch_size=len(texts)):
+        doc_bin.add(doc)
+    return doc_bin.to_bytes()
+
+
+class BatchingNLPPool:
+    """
+    Parses texts in batches on a pool of worker processes.
+
+    vocab is the Vocab of the web process's pipeline; parsed Docs are attached to it.
+    """
+
+    def __init__(self, vocab, workers=2, batch_window=0.005, batch_size=32, max_queue=256, timeout=5.0,
+                 profile=DEFAULT_PROFILE, model=DEFAULT_MODEL, start_method='spawn'):
+        self.vocab = vocab
+        self.workers = workers
+        self.batch_window = batch_window
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.profile = profile
+        self.model = model
+        self.start_method = start_method
+
+        # Counters read by the metrics endpoint
+        self.batches = 0
+        self.texts = 0
+        self.rejected = 0
+
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._slots = threading.Semaphore(workers)
+        self._vocab_lock = threading.Lock()
+        self._executor = self._start_executor()
+        self._closed = False
+        self._dispatcher = threading.Thread(target=self._dispatch, name='nlp-dispatcher', daemon=True)
+        self._dispatcher.start()
+
+    def _start_executor(self):
+        return ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context(self.start_method),
+            initializer=_init_worker,
+            initargs=(self.profile, self.model),
+        )
+
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def submit(self, text):
+        """
+        Queues a text and returns a Future for its Doc.
+        Raises NLPOverloadedError when the queue is full.
+        """
+        if self._closed:
+            raise RuntimeError("NLP worker pool is closed")
+        future = Future()
+        try:
+            self._queue.put_nowait((text, future))
+        except queue.Full:
+            self.rejected += 1
+            raise NLPOverloadedError("NLP queue is full") from None
+        return future
+
+    def parse(self, text):
+        """
+        Returns the Doc for text, waiting at most timeout seconds for it. Every failure of the
+        pool is raised as NLPOverloadedError, so callers answer with a retryable 503.
+        """
+        try:
+            return self.submit(text).result(timeout=self.timeout)
+        except FutureTimeoutError:
+            raise NLPOverloadedError(f"No parse within {self.timeout} seconds") from None
+        except NLPOverloadedError:
+            raise
+        except RuntimeError as error:
+            # BrokenProcessPool while a crashed worker is replaced, or a pool that was closed
+            raise NLPOverloadedError(f"NLP worker pool failed: {error}") from error
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._dispatcher.join(timeout=self.timeout)
+        self._executor.shutdown(wait=False)
+        # Anything still queued will never be parsed
+        while True:
+            try:
+                entry = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if entry is not None:
+                entry[1].set_exception(RuntimeError("NLP worker pool is closed"))
+
+    def _dispatch(self):
+        while True:
+            # Wait for a free worker first: while every worker is busy, messages keep queueing
+            # and leave together as the next batch
+            self._slots.acquire()
+            entry = self._queue.get()
+            if entry is None:
+                return
+            batch = [entry]
+            deadline = time.monotonic() + self.batch_window
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                try:
+                    entry = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if entry is None:
+                    self._closed = True
+                    break
+                batch.append(entry)
+
+            self.batches += 1
+            self.texts += len(batch)
+            try:
+                job = self._executor.submit(_parse_batch, [text for text, _ in batch])
+            except (BrokenProcessPool, RuntimeError) as error:
+                self._slots.release()
+                self._fail(batch, error)
+                continue
+            job.add_done_callback(lambda job, batch=batch: self._deliver(batch, job))
+            if self._closed:
+                return
+
+    def _deliver(self, batch, job):
+        self._slots.release()
+        try:
+            data = job.result()
+            # Docs share the web process's vocab; add their strings one batch at a time
+            with self._vocab_lock:
+                docs = list(DocBin(attrs=DOC_ATTRS).from_bytes(data).get_docs(self.vocab))
+        except Exception as error:
+            self._fail(batch, error)
+            return
+        for (_, future), doc in zip(batch, docs):
+            future.set_result(doc)
+
+    def _fail(self, batch, error):
+        if isinstance(error, BrokenProcessPool) and not self._closed:
+            # A worker died; start a fresh pool so later batches still get parsed
+            logger.error("NLP worker pool broke; restarting it")
+            self._executor = self._start_executor()
+        for _, future in batch:
+            if not future.done():
+                future.set_exception(error)
@@ -0,0 +1,251 @@
+"""
+Durable, append-only log of completed orders for the kitchen display, analytics and other
+consumers.
+
+Every completed order is written as one JSON record (items, modifications, cent totals and
+timestamps) to a SQLite database in WAL mode that all workers on the box append to. The
+request that completes an order only puts the record on a queue; a background thread per
+worker takes whatever has queued up and commits it as one transaction, so a busy worker pays
+for one fsync per batch instead of one per order, and checkout never waits on the disk.
+
+Records are numbered by seq in the order they were committed. Consumers read them with
+OrderLogReader, remembering the last seq they handled, or follow the log from the shell:
+
+    python order_log.py --follow --after 0
+"""
+import argparse
+import json
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+from queue import Empty, Full, Queue
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PATH = os.environ.get('CHATBOT_ORDER_LOG', 'orders.sqlite3')
+
+
+# Function to open the order log database, creating its table on first use
+def connect(path):
+    connection = sqlite3.connect(path, timeout=30)
+    connection.execute('PRAGMA journal_mode=WAL')
+    # A committed order must survive a power cut, not only a crash of the process
+    connection.execute('PRAGMA synchronous=FULL')
+    with connection:
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS orders (seq INTEGER PRIMARY KEY AUTOINCREMENT, order_id TEXT NOT NULL, '
+            'store_id TEXT, completed REAL NOT NULL, total_cents INTEGER NOT NULL, record TEXT NOT NULL)'
+        )
+        connection.execute('CREATE INDEX IF NOT EXISTS orders_completed ON orders (completed)')
+    return connection
+
+
+class OrderLog:
+    """
+    Appends completed orders to the log through a background writer.
+
+    append() serializes the record and queues it without touching the database. The writer
+    thread, started on the first append in each process, commits up to batch_size queued
+    records per transaction and retries a failed batch every retry_seconds. When max_queue
+    records are already waiting, append() writes the record itself rather than drop it.
+
+    written, batches, errors and sync_writes count records committed, transactions, failed
+    writes and records written by append() because the queue was full.
+    """
+
+    def __init__(self, path, batch_size=500, max_queue=10000, retry_seconds=1.0):
+        self.path = path
+        self.batch_size = batch_size
+        self.max_queue = max_queue
+        self.retry_seconds = retry_seconds
+        self.written = 0
+        self.batches = 0
+        self.errors = 0
+        self.sync_writes = 0
+
+        self._local = threading.local()
+        self._queue = None
+        self._writer = None
+        self._pid = None
+        self._closing = False
+        self._lock = threading.Lock()
+        connect(path).close()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        # A connection must not be used in a process forked after it was opened
+        if connection is None or self._local.pid != os.getpid():
+            connection = connect(self.path)
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def _start(self):
+        # Threads don't survive a fork, so every worker starts its own writer
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._queue = Queue(self.max_queue)
+                    self._closing = False
+                    self._writer = threading.Thread(target=self._run, args=(self._queue,),
+                                                    name='order-log-writer', daemon=True)
+                    self._writer.start()
+                    self._pid = os.getpid()
+        return self._queue
+
+    def queue_depth(self):
+        return self._queue.qsize() if self._pid == os.getpid() else 0
+
+    def append(self, record):
+        """
+        Queues a completed order. record needs 'order_id', 'completed' and 'total_cents';
+        'store_id' is optional. Returns without waiting for the write.
+        """
+        row = (record['order_id'], record.get('store_id'), record['completed'], record['total_cents'],
+               json.dumps(record, separators=(',', ':')))
+        try:
+            self._start().put_nowait(row)
+        except Full:
+            # The writer is far behind; writing here is slower but loses nothing
+            self.sync_writes += 1
+            try:
+                self._write([row])
+            except sqlite3.Error:
+                self.errors += 1
+                logger.exception("Could not log completed order: %s", row[4])
+
+    def _write(self, rows):
+        with self._connection() as connection:
+            connection.executemany(
+                'INSERT INTO orders (order_id, store_id, completed, total_cents, record) VALUES (?, ?, ?, ?, ?)', rows
+            )
+        self.written += len(rows)
+        self.batches += 1
+
+    def _run(self, queue):
+        stop = False
+        while not stop:
+            rows = [queue.get()]
+            # Take everything that queued up while the last batch was being committed
+            while len(rows) < self.batch_size:
+                try:
+                    rows.append(queue.get_nowait())
+                except Empty:
+                    break
+            taken = len(rows)
+            # close() queues None after the last order
+            if None in rows:
+                stop = True
+                rows = [row for row in rows if row is not None]
+            if rows:
+                self._commit(rows)
+            for _ in range(taken):
+                queue.task_done()
+
+    def _commit(self, rows):
+        while True:
+            try:
+                self._write(rows)
+                return
+            except sqlite3.Error:
+                self.errors += 1
+                if self._closing:
+                    logger.exception("Could not log %d completed orders: %s",
+                                     len(rows), '\n'.join([row[4] for row in rows]))
+                    return
+                logger.exception("Could not log %d completed orders; retrying", len(rows))
+                time.sleep(self.retry_seconds)
+
+    def flush(self):
+        """
+        Waits until every order queued in this process has been written.
+        """
+        if self._pid == os.getpid():
+            self._queue.join()
+
+    def close(self, timeout=10):
+        """
+        Writes what is still queued and stops the writer of this process.
+        """
+        if self._pid != os.getpid() or not self._writer.is_alive():
+            return
+        self._closing = True
+        self._queue.put(None)
+        self._writer.join(timeout)
+
+
+class OrderLogReader:
+    """
+    Reads completed orders in the order they were committed. Each record comes back as the
+    dictionary that was appended, plus its 'seq'; seq only grows, so a consumer resumes by
+    asking for the records after the last seq it handled.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        connect(path).close()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = connect(self.path)
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def read(self, after=0, limit=1000):
+        rows = self._connection().execute(
+            'SELECT seq, record FROM orders WHERE seq > ? ORDER BY seq LIMIT ?', (after, limit)
+        ).fetchall()
+        records = []
+        for seq, payload in rows:
+            record = json.loads(payload)
+            record['seq'] = seq
+            records.append(record)
+        return records
+
+    def last_seq(self):
+        return self._connection().execute('SELECT coalesce(max(seq), 0) FROM orders').fetchone()[0]
+
+    def follow(self, after=0, poll_interval=0.5, limit=1000):
+        """
+        Yields every record after seq after, then waits for new ones, polling every
+        poll_interval seconds while there is nothing to read.
+        """
+        while True:
+            records = self.read(after, limit)
+            for record in records:
+                after = record['seq']
+                yield record
+            if len(records) < limit:
+                time.sleep(poll_interval)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Print completed orders from the order log as JSON lines.')
+    parser.add_argument('--db', default=DEFAULT_PATH, help='order log database')
+    parser.add_argument('--after', type=int, default=None,
+                        help='print orders after this seq (default: only new orders when following, else all)')
+    parser.add_argument('--follow', action='store_true', help='keep printing orders as they are completed')
+    parser.add_argument('--poll-interval', type=float, default=0.5, help='seconds between checks for new orders')
+    args = parser.parse_args()
+
+    reader = OrderLogReader(args.db)
+    after = args.after
+    if after is None:
+        after = reader.last_seq() if args.follow else 0
+    try:
+        records = reader.follow(after, args.poll_interval) if args.follow else reader.read(after, limit=-1)
+        for record in records:
+            sys.stdout.write(json.dumps(record, separators=(',', ':')) + '\n')
+            sys.stdout.flush()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
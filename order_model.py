@@ -0,0 +1,238 @@
+"""
+The customer's order as a data structure.
+
+Line items use __slots__ and keep prices in integer cents, and the order total is adjusted as
+lines change instead of being recomputed from the menu on every turn. Ingredient
+modifications are kept as IDs from a process-wide intern table. The rendered summary is
+cached on the order and dropped whenever the order changes.
+
+In the session an order is stored as plain JSON with ingredient names, since ingredient IDs
+only mean something inside one process. Every change bumps the order's revision, which lets
+OrderCache hand back the live Order object for a session whose order hasn't changed.
+"""
+import secrets
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+
+# Function to convert a menu price in dollars to integer cents
+def to_cents(price):
+    return int(round(float(price) * 100))
+
+
+# Function to format integer cents as a dollar amount
+def format_cents(cents):
+    sign = '-' if cents < 0 else ''
+    cents = abs(cents)
+    return f"{sign}${cents // 100}.{cents % 100:02d}"
+
+
+class IngredientTable:
+    """
+    Interns ingredient names as small integer IDs shared by every order in the process.
+    The table never shrinks, so only names from the menu may be interned, never raw text
+    from a message.
+    """
+
+    def __init__(self):
+        self._ids = {}
+        self._names = []
+        self._lock = threading.Lock()
+
+    def intern(self, name):
+        ingredient_id = self._ids.get(name)
+        if ingredient_id is None:
+            with self._lock:
+                ingredient_id = self._ids.get(name)
+                if ingredient_id is None:
+                    ingredient_id = len(self._names)
+                    self._names.append(sys.intern(name))
+                    self._ids[self._names[-1]] = ingredient_id
+        return ingredient_id
+
+    def name(self, ingredient_id):
+        return self._names[ingredient_id]
+
+    def __len__(self):
+        return len(self._names)
+
+
+INGREDIENTS = IngredientTable()
+
+
+class OrderLine:
+    """
+    One menu item in an order: quantity, unit price in cents, and the IDs of ingredients
+    added and removed. html holds the rendered line until the line changes.
+    """
+    __slots__ = ('item', 'quantity', 'unit_cents', 'add', 'remove', 'html')
+
+    def __init__(self, item, quantity, unit_cents, add=None, remove=None):
+        self.item = item
+        self.quantity = quantity
+        self.unit_cents = unit_cents
+        self.add = add if add is not None else []
+        self.remove = remove if remove is not None else []
+        self.html = None
+
+    @property
+    def line_cents(self):
+        return self.unit_cents * self.quantity
+
+    def added_names(self):
+        return [INGREDIENTS.name(ingredient_id) for ingredient_id in self.add]
+
+    def removed_names(self):
+        return [INGREDIENTS.name(ingredient_id) for ingredient_id in self.remove]
+
+
+class Order:
+    """
+    Line items by menu item name, in the order they were first added, with a running total.
+
+    The unit price of a line is fixed when the item is first added, so a menu reload never
+    changes the price of something already ordered. created is when the order was started,
+    as a Unix timestamp.
+    """
+    __slots__ = ('order_id', 'revision', 'created', 'lines', 'total_cents', '_summary')
+
+    def __init__(self, order_id=None, revision=0, created=None):
+        self.order_id = order_id or secrets.token_hex(8)
+        self.revision = revision
+        self.created = created or time.time()
+        self.lines = {}
+        self.total_cents = 0
+        self._summary = None
+
+    def __bool__(self):
+        return bool(self.lines)
+
+    def __len__(self):
+        return len(self.lines)
+
+    def __contains__(self, item):
+        return item in self.lines
+
+    def __iter__(self):
+        return iter(self.lines.values())
+
+    def get(self, item):
+        return self.lines.get(item)
+
+    def _changed(self, line):
+        self.revision += 1
+        self._summary = None
+        line.html = None
+
+    def add_item(self, item, quantity, unit_cents):
+        line = self.lines.get(item)
+        if line is None:
+            line = self.lines[item] = OrderLine(item, 0, unit_cents)
+        line.quantity += quantity
+        self.total_cents += line.unit_cents * quantity
+        self._changed(line)
+        return line
+
+    def remove_item(self, item, quantity):
+        """
+        Removes up to quantity of an item and returns how many were removed.
+        The line is dropped once none are left.
+        """
+        line = self.lines[item]
+        removed = min(quantity, line.quantity)
+        line.quantity -= removed
+        self.total_cents -= line.unit_cents * removed
+        if line.quantity == 0:
+            del self.lines[item]
+        self._changed(line)
+        return removed
+
+    def add_ingredient(self, item, ingredient):
+        line = self.lines[item]
+        line.add.append(INGREDIENTS.intern(ingredient))
+        self._changed(line)
+
+    def remove_ingredient(self, item, ingredient):
+        line = self.lines[item]
+        line.remove.append(INGREDIENTS.intern(ingredient))
+        self._changed(line)
+
+    def summary(self, render):
+        """
+        Returns render(order), reusing the last result until the order changes.
+        """
+        if self._summary is None:
+            self._summary = render(self)
+        return self._summary
+
+    def to_state(self):
+        return {
+            'id': self.order_id,
+            'rev': self.revision,
+            'created': self.created,
+            'total_cents': self.total_cents,
+            'lines': [[line.item, line.quantity, line.unit_cents, line.added_names(), line.removed_names()]
+                      for line in self.lines.values()],
+        }
+
+    @classmethod
+    def from_state(cls, state, price_of=None):
+        """
+        Rebuilds an order saved with to_state(). Sessions saved before orders had their own
+        format ({item: {'quantity', 'add', 'remove'}}) are converted, pricing their items
+        with price_of(item), which returns cents or None for items no longer on the menu.
+        """
+        if 'lines' not in state:
+            order = cls()
+            for item, details in state.items():
+                unit_cents = price_of(item) if price_of else None
+                if unit_cents is None:
+                    continue
+                line = order.add_item(item, details.get('quantity', 1), unit_cents)
+                line.add = [INGREDIENTS.intern(name) for name in details.get('add', [])]
+                line.remove = [INGREDIENTS.intern(name) for name in details.get('remove', [])]
+            return order
+
+        order = cls(state['id'], state['rev'], state.get('created'))
+        for item, quantity, unit_cents, add, remove in state['lines']:
+            order.lines[item] = OrderLine(item, quantity, unit_cents,
+                                          [INGREDIENTS.intern(name) for name in add],
+                                          [INGREDIENTS.intern(name) for name in remove])
+        order.total_cents = state['total_cents']
+        return order
+
+
+class OrderCache:
+    """
+    Keeps the most recently used Order objects by order ID, so an order that hasn't changed
+    since the last turn (same revision) is reused, cached summary included, rather than
+    rebuilt from the session.
+    """
+
+    def __init__(self, max_orders=1024):
+        self.max_orders = max_orders
+        self._orders = OrderedDict()
+        self._lock = threading.Lock()
+
+    def load(self, state, price_of=None):
+        with self._lock:
+            order = self._orders.get(state.get('id'))
+            if order is not None and order.revision == state.get('rev'):
+                self._orders.move_to_end(order.order_id)
+                return order
+        order = Order.from_state(state, price_of)
+        self.put(order)
+        return order
+
+    def put(self, order):
+        with self._lock:
+            self._orders[order.order_id] = order
+            self._orders.move_to_end(order.order_id)
+            while len(self._orders) > self.max_orders:
+                self._orders.popitem(last=False)
+
+    def discard(self, order_id):
+        with self._lock:
+            self._orders.pop(order_id, None)
@@ -0,0 +1,205 @@
+"""
+Cache of parse results shared by every request, keyed by the normalized message.
+
+Drive-thru orders repeat the same few phrasings all day ("a double double", "two
+cheeseburgers", "no onions"). ParseCache remembers the items, quantities and modifications
+parsed from each normalized message under the menu version they were parsed with, so a
+repeated message skips the fast path and spaCy entirely. Store menus with the same items
+parse alike, so they share results. Results are kept as compact JSON
+in an in-process LRU. An optional SQLiteParseStore backs it with a database file on the
+local disk that every worker on the box reads and fills, so a phrasing parsed by one worker
+is a hit for all the others.
+"""
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+from collections import Counter, OrderedDict
+
+
+class SQLiteParseStore:
+    """
+    Keeps parse results in a SQLite database shared by the worker processes of one box.
+
+    Like the session database it runs in WAL mode with one connection per thread. The store
+    records when it first saw each menu generation. The first time a process saves under a
+    generation, rows of generations first seen before it are deleted; during a rolling reload,
+    workers still on the old menu never delete the rows of the new one. Every purge_every
+    saves the oldest rows beyond max_rows are dropped. A database of an older layout is
+    emptied, since everything in it can be parsed again.
+    """
+
+    SCHEMA_VERSION = 3
+
+    def __init__(self, path, max_rows=100000, purge_every=1000):
+        self.path = path
+        self.max_rows = max_rows
+        self.purge_every = purge_every
+        self._local = threading.local()
+        self._saves = 0
+        self._generation = None
+        with self._connection() as connection:
+            if connection.execute('PRAGMA user_version').fetchone()[0] != self.SCHEMA_VERSION:
+                connection.execute('DROP TABLE IF EXISTS parses')
+                connection.execute('DROP TABLE IF EXISTS generations')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS parses (version TEXT NOT NULL, text TEXT NOT NULL, '
+                'parsed TEXT NOT NULL, generation TEXT NOT NULL, created REAL NOT NULL, '
+                'PRIMARY KEY (version, text))'
+            )
+            connection.execute('CREATE INDEX IF NOT EXISTS parses_created ON parses (created)')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS generations (generation TEXT PRIMARY KEY, first_seen REAL NOT NULL)'
+            )
+            connection.execute(f'PRAGMA user_version = {self.SCHEMA_VERSION}')
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        # A connection must not be used in a process forked after it was opened
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=1)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def load(self, version, text):
+        row = self._connection().execute(
+            'SELECT parsed FROM parses WHERE version = ? AND text = ?', (version, text)
+        ).fetchone()
+        return row[0] if row else None
+
+    def save(self, version, text, payload, generation=None):
+        generation = version if generation is None else generation
+        with self._connection() as connection:
+            if generation != self._generation:
+                # Only older generations go; a worker still on an older menu keeps its rows
+                # to itself instead of deleting the new ones
+                connection.execute('INSERT OR IGNORE INTO generations (generation, first_seen) VALUES (?, ?)',
+                                   (generation, time.time()))
+                connection.execute(
+                    'DELETE FROM parses WHERE generation IN (SELECT generation FROM generations WHERE first_seen < '
+                    '(SELECT first_seen FROM generations WHERE generation = ?))', (generation,)
+                )
+                self._generation = generation
+            connection.execute(
+                'INSERT OR REPLACE INTO parses (version, text, parsed, generation, created) VALUES (?, ?, ?, ?, ?)',
+                (version, text, payload, generation, time.time()),
+            )
+        self._saves += 1
+        if self._saves % self.purge_every == 0:
+            self.purge()
+
+    def purge(self):
+        with self._connection() as connection:
+            connection.execute(
+                'DELETE FROM parses WHERE rowid IN (SELECT rowid FROM parses ORDER BY created DESC LIMIT -1 OFFSET ?)',
+                (self.max_rows,),
+            )
+
+    def __len__(self):
+        return self._connection().execute('SELECT count(*) FROM parses').fetchone()[0]
+
+
+class ParseCache:
+    """
+    LRU cache of parse results by (menu version, normalized text). A result is the dict of
+    'items' and 'modifications' built by parse_message; it is stored as JSON, so every hit
+    returns a fresh copy the caller may change. generation is the base menu version the
+    store menus were built on (by default the menu version itself); the first lookup made
+    with a new generation drops everything parsed under the old one.
+
+    hits are counted per tier: 'local' for this process and 'shared' for the store.
+    memory_bytes is the size of the keys and results held in this process. Errors of the
+    store are counted in store_errors and treated as misses. A max_entries of 0 turns the
+    cache off.
+    """
+
+    def __init__(self, max_entries=4096, store=None, max_text_length=256):
+        self.max_entries = max_entries
+        self.store = store
+        self.max_text_length = max_text_length
+        self.hits = Counter()
+        self.misses = 0
+        self.store_errors = 0
+        self.memory_bytes = 0
+
+        self._generation = None
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def hit_ratio(self):
+        hits = sum(self.hits.values())
+        lookups = hits + self.misses
+        return hits / lookups if lookups else 0.0
+
+    def _cacheable(self, text):
+        return self.max_entries > 0 and len(text) <= self.max_text_length
+
+    def get(self, version, text, generation=None):
+        """
+        Returns the cached parse of text under menu version, or None on a miss.
+        """
+        if not self._cacheable(text):
+            return None
+        generation = version if generation is None else generation
+        with self._lock:
+            if generation != self._generation:
+                self._entries.clear()
+                self.memory_bytes = 0
+                self._generation = generation
+            payload = self._entries.get((version, text))
+            if payload is not None:
+                self._entries.move_to_end((version, text))
+                self.hits['local'] += 1
+        if payload is None and self.store is not None:
+            try:
+                payload = self.store.load(version, text)
+            except sqlite3.Error:
+                self.store_errors += 1
+            if payload is not None:
+                with self._lock:
+                    self.hits['shared'] += 1
+                    self._insert(generation, version, text, payload)
+        if payload is None:
+            with self._lock:
+                self.misses += 1
+            return None
+        return json.loads(payload)
+
+    def put(self, version, text, parsed, generation=None):
+        """
+        Caches the parse of text under menu version, in this process and in the store.
+        """
+        if not self._cacheable(text):
+            return
+        generation = version if generation is None else generation
+        payload = json.dumps(parsed, separators=(',', ':'))
+        with self._lock:
+            self._insert(generation, version, text, payload)
+        if self.store is not None:
+            try:
+                self.store.save(version, text, payload, generation)
+            except sqlite3.Error:
+                self.store_errors += 1
+
+    def _insert(self, generation, version, text, payload):
+        # Don't keep results parsed with a menu that was replaced meanwhile
+        if generation != self._generation or (version, text) in self._entries:
+            return
+        self._entries[(version, text)] = payload
+        self.memory_bytes += sys.getsizeof(text) + sys.getsizeof(payload)
+        while len(self._entries) > self.max_entries:
+            (_, old_text), old_payload = self._entries.popitem(last=False)
+            self.memory_bytes -= sys.getsizeof(old_text) + sys.getsizeof(old_payload)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.memory_bytes = 0
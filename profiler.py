@@ -0,0 +1,219 @@
+"""
+Sampling profiler for live chat traffic.
+
+While profiling is on, a chosen fraction of requests register the thread serving them, and a
+background thread samples the Python stacks of those threads every few milliseconds. Samples
+from all profiled requests are aggregated into collapsed stacks, one line per distinct stack
+with its sample count, which flamegraph.pl, speedscope or inferno turn into a flame graph.
+
+Each frame is labelled with the component it belongs to, so time inside spaCy, pandas, Jinja
+and Flask shows up separately from the chatbot's own code:
+
+    flask:app.Flask.wsgi_app;app:main.chat;app:main.process_message;spacy:language.Language.__call__ 42
+"""
+import json
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+
+# Component names for frames of third-party packages, by top-level package
+FRAME_COMPONENTS = {
+    'spacy': 'spacy', 'thinc': 'spacy', 'cymem': 'spacy', 'preshed': 'spacy', 'srsly': 'spacy',
+    'en_core_web_sm': 'spacy', 'en_core_web_md': 'spacy', 'en_core_web_lg': 'spacy',
+    'pandas': 'pandas',
+    'jinja2': 'jinja', 'markupsafe': 'jinja',
+    'flask': 'flask', 'werkzeug': 'flask',
+}
+
+APP_ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+# Function to work out which component a source file belongs to
+def frame_component(filename):
+    """
+    Returns (component, module) for a source file: 'app' for the chatbot's own modules, the
+    component from FRAME_COMPONENTS for known packages, and 'python' for everything else.
+    """
+    if filename.startswith('<'):
+        # Frozen modules and code compiled from strings
+        return 'python', filename.strip('<>').replace(' ', '_')
+    module = os.path.splitext(os.path.basename(filename))[0]
+    parts = filename.replace('\\', '/').split('/')
+    if 'site-packages' in parts or 'dist-packages' in parts:
+        marker = 'site-packages' if 'site-packages' in parts else 'dist-packages'
+        index = parts.index(marker)
+        if index + 1 < len(parts):
+            package = parts[index + 1].split('.')[0]
+            return FRAME_COMPONENTS.get(package, package), module
+    if os.path.dirname(os.path.abspath(filename)) == APP_ROOT:
+        return 'app', module
+    return 'python', module
+
+
+class SamplingProfiler:
+    """
+    Samples the stacks of profiled requests and aggregates them across requests.
+
+    start() turns profiling on for a fraction of requests (rate) and optionally only for a
+    number of seconds; stop() turns it off. Request handlers call should_profile() first,
+    which is a single attribute check while profiling is off, and bracket profiled requests
+    with begin() and end().
+    """
+
+    def __init__(self, interval=0.005, output_path=None):
+        self.interval = interval
+        self.output_path = output_path
+        self.rate = 0.0
+        self.deadline = None
+        self.stacks = Counter()
+        self.samples = 0
+        self.profiled_requests = 0
+        self.started_at = None
+
+        self._lock = threading.Lock()
+        self._threads = set()
+        self._sampler = None
+        self._labels = {}
+
+    def start(self, rate=1.0, seconds=None, reset=True):
+        if not 0 < rate <= 1:
+            raise ValueError("Profiling rate must be between 0 (exclusive) and 1")
+        with self._lock:
+            if reset:
+                self.stacks.clear()
+                self.samples = 0
+                self.profiled_requests = 0
+            self.started_at = time.time()
+            self.deadline = time.monotonic() + seconds if seconds else None
+            self.rate = rate
+        return self.status()
+
+    def stop(self):
+        """
+        Turns profiling off, writes the output file if one is configured and returns the status.
+        """
+        with self._lock:
+            self.rate = 0.0
+            self.deadline = None
+        self.write()
+        return self.status()
+
+    def should_profile(self):
+        if not self.rate:
+            return False
+        if self.deadline is not None and time.monotonic() >= self.deadline:
+            # The profiling window is over
+            self.stop()
+            return False
+        # The module-level generator is reseeded in forked workers, so they don't all pick the same requests
+        return self.rate >= 1 or random.random() < self.rate
+
+    def begin(self):
+        ident = threading.get_ident()
+        with self._lock:
+            self._threads.add(ident)
+            self.profiled_requests += 1
+            if self._sampler is None or not self._sampler.is_alive():
+                self._sampler = threading.Thread(target=self._run, name='profiler-sampler', daemon=True)
+                self._sampler.start()
+
+    def end(self):
+        with self._lock:
+            self._threads.discard(threading.get_ident())
+
+    def _run(self):
+        # Runs while any profiled request is in flight; begin() starts it again when needed
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                if not self._threads:
+                    self._sampler = None
+                    return
+                threads = list(self._threads)
+            frames = sys._current_frames()
+            collected = [self._collapse(frames[ident]) for ident in threads if ident in frames]
+            with self._lock:
+                for stack in collected:
+                    self.stacks[stack] += 1
+                    self.samples += 1
+
+    def _label(self, code):
+        label = self._labels.get(code)
+        if label is None:
+            component, module = frame_component(code.co_filename)
+            name = getattr(code, 'co_qualname', code.co_name)
+            label = f"{component}:{module}.{name}".replace(';', ':').replace(' ', '_')
+            self._labels[code] = label
+        return label
+
+    def _collapse(self, frame):
+        labels = []
+        while frame is not None:
+            labels.append(self._label(frame.f_code))
+            frame = frame.f_back
+        labels.reverse()
+        return ';'.join(labels)
+
+    def collapsed(self):
+        """
+        Returns the aggregated samples as collapsed stacks, heaviest first.
+        """
+        with self._lock:
+            stacks = self.stacks.most_common()
+        return ''.join(f"{stack} {count}\n" for stack, count in stacks)
+
+    def summary(self, top=15):
+        """
+        Returns sample counts by component, both where the sampled code was running (self)
+        and anywhere on the stack (inclusive), and the functions with the most self samples.
+        """
+        self_counts = Counter()
+        inclusive_counts = Counter()
+        functions = Counter()
+        with self._lock:
+            stacks = list(self.stacks.items())
+        for stack, count in stacks:
+            frames = stack.split(';')
+            self_counts[frames[-1].split(':', 1)[0]] += count
+            functions[frames[-1]] += count
+            for component in {frame.split(':', 1)[0] for frame in frames}:
+                inclusive_counts[component] += count
+        return {
+            'samples': self.samples,
+            'profiled_requests': self.profiled_requests,
+            'self_by_component': dict(self_counts.most_common()),
+            'inclusive_by_component': dict(inclusive_counts.most_common()),
+            'top_functions': functions.most_common(top),
+        }
+
+    def status(self):
+        remaining = None
+        if self.deadline is not None:
+            remaining = round(max(0.0, self.deadline - time.monotonic()), 1)
+        return {
+            'profiling': bool(self.rate),
+            'rate': self.rate,
+            'started_at': self.started_at,
+            'seconds_left': remaining,
+            'interval_ms': self.interval * 1000,
+            'samples': self.samples,
+            'profiled_requests': self.profiled_requests,
+            'output': self.output_path,
+        }
+
+    def write(self, path=None):
+        """
+        Writes the collapsed stacks to path (or the configured output path), with the
+        summary next to it as JSON. Does nothing when there is no path or no samples.
+        """
+        path = path or self.output_path
+        if not path or not self.samples:
+            return None
+        with open(path, 'w', encoding='utf-8') as output:
+            output.write(self.collapsed())
+        with open(path + '.summary.json', 'w', encoding='utf-8') as output:
+            json.dump(self.summary(), output, indent=2)
+        return path
@@ -0,0 +1,75 @@
+"""
+Cache for replies that depend only on the menu and the customer's message.
+
+The menu listing and the answers to ingredient questions are the same for everybody who asks
+the same thing about the same menu, so they are built once per menu version and then served
+from a bounded LRU cache. Entries are keyed by the menu version they were built from. Store
+menus built on the same base menu are one generation and share the cache; the first lookup
+made with a new generation drops everything built from the old one.
+"""
+import threading
+from collections import Counter, OrderedDict
+
+
+class ResponseCache:
+    """
+    LRU cache of built responses by (kind, key), where kind names the sort of response
+    ('menu', 'ingredients', ...) and key is what it was built from, such as the normalized
+    question. hits and misses are counted per kind.
+
+    A max_entries of 0 turns caching off; every lookup then builds its response.
+    """
+
+    def __init__(self, max_entries=1024, max_key_length=256):
+        self.max_entries = max_entries
+        self.max_key_length = max_key_length
+        self.hits = Counter()
+        self.misses = Counter()
+        # Number of times a new menu generation emptied the cache
+        self.invalidations = 0
+
+        self._generation = None
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get_or_build(self, version, kind, key, build, generation=None):
+        """
+        Returns the cached response for (kind, key) under menu version, calling build() and
+        caching its result on a miss. build runs outside the lock, so two threads missing on
+        the same key at once may both build it. generation is the base menu version that
+        version was built on, and defaults to version itself.
+        """
+        if generation is None:
+            generation = version
+        if self.max_entries <= 0 or (isinstance(key, str) and len(key) > self.max_key_length):
+            return build()
+
+        entry_key = (version, kind, key)
+        with self._lock:
+            if generation != self._generation:
+                if self._entries:
+                    self.invalidations += 1
+                    self._entries.clear()
+                self._generation = generation
+            response = self._entries.get(entry_key)
+            if response is not None:
+                self._entries.move_to_end(entry_key)
+                self.hits[kind] += 1
+                return response
+            self.misses[kind] += 1
+
+        response = build()
+        with self._lock:
+            # Don't keep responses built from a menu that was replaced while they were built
+            if generation == self._generation:
+                self._entries[entry_key] = response
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return response
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
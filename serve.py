@@ -0,0 +1,197 @@
+"""
+Production entry point: loads the spaCy model and the menu once in a master process, then
+forks worker processes that all accept connections on the same listening socket.
+
+Everything big is loaded and warmed up before the fork and then moved out of the garbage
+collector's reach with gc.freeze(), so the workers keep sharing those pages copy-on-write
+instead of each holding its own copy of the model. Each worker serves requests with a
+threaded WSGI server; the master only restarts workers that die.
+
+    python serve.py --workers 4 --bind 0.0.0.0:8000
+    kill -USR1 <master pid>      # log unique vs shared memory of every worker
+
+Use the sqlite session backend (the default) so every worker sees the same sessions.
+"""
+import argparse
+import gc
+import logging
+import os
+import signal
+import socket
+import sys
+import time
+
+from metrics import process_memory
+
+logger = logging.getLogger('serve')
+
+# Messages run through the app before forking, so lazily built structures exist in the master
+WARM_UP_MESSAGES = [
+    "show me the menu",
+    "I would like two cheeseburgers with no onions and a large drink",
+    "what is in the hot cocoa",
+    "remove one cheeseburger",
+]
+
+
+# Function to split host:port
+def parse_bind(bind):
+    host, _, port = bind.rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+
+# Function to exercise the parsing code once before forking
+def warm_up(chatbot):
+    for message in WARM_UP_MESSAGES:
+        chatbot.parse_message(chatbot.MessageAnalysis(message))
+
+
+# Function to format a number of bytes in MiB
+def mib(value):
+    return f"{value / 1048576:8.1f}"
+
+
+# Function to build the memory report of the master and its workers
+def memory_report(master_pid, worker_pids):
+    """
+    Returns report lines with RSS, PSS, unique and shared memory per process. unique is what
+    each worker costs on its own; shared is mostly the model and menu pages inherited from
+    the master.
+    """
+    lines = [f"{'process':<16} {'rss MiB':>8} {'pss MiB':>8} {'unique MiB':>10} {'shared MiB':>10}"]
+    total_unique = 0
+    for label, pid in [('master', master_pid)] + [(f"worker {pid}", pid) for pid in worker_pids]:
+        memory = process_memory(pid)
+        if memory is None:
+            lines.append(f"{label:<16} (memory not available)")
+            continue
+        if pid != master_pid:
+            total_unique += memory['unique']
+        lines.append(f"{label:<16} {mib(memory['rss'])} {mib(memory['pss'])} "
+                     f"{mib(memory['unique']):>10} {mib(memory['shared']):>10}")
+    lines.append(f"workers' unique memory in total: {mib(total_unique).strip()} MiB")
+    return lines
+
+
+# Function to run one worker process until it is told to stop
+def run_worker(app, listener, threads):
+    from werkzeug.serving import make_server
+
+    # Objects created from now on are this worker's own; the frozen ones stay shared
+    gc.enable()
+    # Ctrl-C reaches the whole process group; the master stops the workers itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGUSR1, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    # Keep the profile of each worker in its own file
+    chatbot = sys.modules['main']
+    if chatbot.profiler.output_path:
+        chatbot.profiler.output_path = f"{chatbot.profiler.output_path}.{os.getpid()}"
+
+    host, port = listener.getsockname()[:2]
+    server = make_server(host, port, app, threaded=threads > 1, fd=listener.fileno())
+    server.serve_forever()
+
+
+# Function to fork one worker and return its pid in the master
+def spawn_worker(app, listener, threads):
+    pid = os.fork()
+    if pid == 0:
+        code = 0
+        try:
+            run_worker(app, listener, threads)
+        except SystemExit as exit_request:
+            code = exit_request.code or 0
+        except Exception:
+            logger.exception("Worker %d crashed", os.getpid())
+            code = 1
+        finally:
+            # Clean up what the app would at exit, but never return into the master's code
+            chatbot = sys.modules['main']
+            chatbot.profiler.write()
+            if chatbot.nlp_pool is not None:
+                chatbot.nlp_pool.close()
+            if chatbot.order_log is not None:
+                chatbot.order_log.close()
+            os._exit(code)
+    return pid
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--bind', default=os.environ.get('CHATBOT_BIND', '127.0.0.1:8000'), help='host:port to listen on')
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('CHATBOT_WORKERS', '2')),
+                        help='worker processes to fork')
+    parser.add_argument('--threads', type=int, default=8, help='serve requests in threads in each worker (1 = one at a time)')
+    parser.add_argument('--memory-report-interval', type=float, default=0,
+                        help='log the memory report every this many seconds (0 = only on SIGUSR1)')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(process)d] %(message)s')
+
+    # No collections while loading: objects end up densely packed and untouched until the freeze
+    gc.disable()
+    start = time.perf_counter()
+    import main as chatbot
+    app = chatbot.create_app()
+    warm_up(chatbot)
+    logger.info("Loaded model and menu %s in %.1f s", chatbot.menu_manager.snapshot.version[:12],
+                time.perf_counter() - start)
+
+    host, port = parse_bind(args.bind)
+    listener = socket.create_server((host, port), reuse_port=False, backlog=1024)
+    listener.set_inheritable(True)
+
+    # Move everything loaded so far to the permanent generation: the workers' collectors then
+    # never write to those objects' headers, which would copy their pages
+    gc.collect()
+    gc.freeze()
+
+    master_pid = os.getpid()
+    workers = set()
+    stopping = False
+
+    def report(signum=None, frame=None):
+        for line in memory_report(master_pid, sorted(workers)):
+            logger.info(line)
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(workers):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGUSR1, report)
+
+    for _ in range(args.workers):
+        workers.add(spawn_worker(app, listener, args.threads))
+    logger.info("Serving on http://%s:%d with %d workers (master %d)", host, port, len(workers), master_pid)
+
+    next_report = time.monotonic() + args.memory_report_interval if args.memory_report_interval else None
+    while workers:
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            break
+        if pid == 0:
+            time.sleep(0.5)
+            if next_report is not None and time.monotonic() >= next_report:
+                report()
+                next_report = time.monotonic() + args.memory_report_interval
+            continue
+        workers.discard(pid)
+        if not stopping:
+            logger.warning("Worker %d exited (wait status %d); starting a new one", pid, status)
+            workers.add(spawn_worker(app, listener, args.threads))
+    listener.close()
+    logger.info("All workers stopped")
+
+
+if __name__ == '__main__':
+    main()
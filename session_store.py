@@ -0,0 +1,231 @@
+"""
+Server-side session storage for the chatbot.
+
+The session cookie only carries a random session ID; the session data itself lives in a
+pluggable backend. SQLiteSessionBackend keeps sessions in a local database file shared by
+all workers on the box, and MemorySessionBackend keeps them in the process for tests and
+single-process development.
+"""
+import json
+import os
+import secrets
+import sqlite3
+import threading
+import time
+
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+
+
+# Function to serialize session data compactly
+def dump_session(data):
+    return json.dumps(data, separators=(',', ':'))
+
+
+class MemorySessionBackend:
+    """
+    Keeps serialized sessions in a dictionary inside the current process.
+    """
+
+    def __init__(self, max_age=86400):
+        self.max_age = max_age
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def load(self, sid):
+        with self._lock:
+            record = self._sessions.get(sid)
+        if record is None or time.time() - record[0] > self.max_age:
+            return None
+        return json.loads(record[1])
+
+    def save(self, sid, data):
+        payload = dump_session(data)
+        with self._lock:
+            self._sessions[sid] = (time.time(), payload)
+        return len(payload)
+
+    def delete(self, sid):
+        with self._lock:
+            self._sessions.pop(sid, None)
+
+    def size(self, sid):
+        with self._lock:
+            record = self._sessions.get(sid)
+        return len(record[1]) if record else 0
+
+
+class SQLiteSessionBackend:
+    """
+    Keeps serialized sessions in a SQLite database, one row per session.
+
+    Each thread gets its own connection, and the database runs in WAL mode so several
+    worker processes can read and write it at the same time. Sessions that have not been
+    saved for max_age seconds are purged every purge_every saves.
+    """
+
+    def __init__(self, path, max_age=86400, purge_every=500):
+        self.path = path
+        self.max_age = max_age
+        self.purge_every = purge_every
+        self._local = threading.local()
+        self._saves = 0
+        with self._connection() as connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS sessions (sid TEXT PRIMARY KEY, data TEXT NOT NULL, updated REAL NOT NULL)'
+            )
+            connection.execute('CREATE INDEX IF NOT EXISTS sessions_updated ON sessions (updated)')
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        # A connection must not be used in a process forked after it was opened
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=10)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def load(self, sid):
+        row = self._connection().execute(
+            'SELECT data FROM sessions WHERE sid = ? AND updated > ?', (sid, time.time() - self.max_age)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save(self, sid, data):
+        payload = dump_session(data)
+        with self._connection() as connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO sessions (sid, data, updated) VALUES (?, ?, ?)',
+                (sid, payload, time.time()),
+            )
+        self._saves += 1
+        if self._saves % self.purge_every == 0:
+            self.purge()
+        return len(payload)
+
+    def delete(self, sid):
+        with self._connection() as connection:
+            connection.execute('DELETE FROM sessions WHERE sid = ?', (sid,))
+
+    def purge(self):
+        with self._connection() as connection:
+            connection.execute('DELETE FROM sessions WHERE updated <= ?', (time.time() - self.max_age,))
+
+    def size(self, sid):
+        row = self._connection().execute('SELECT length(data) FROM sessions WHERE sid = ?', (sid,)).fetchone()
+        return row[0] if row else 0
+
+
+class ServerSideSession(CallbackDict, SessionMixin):
+    """
+    Session dictionary that remembers its ID and whether it was changed.
+    """
+
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(session):
+            session.modified = True
+
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+        # Size in bytes of the data last written to the backend, set when the session is saved
+        self.stored_size = None
+
+
+class ServerSideSessionInterface(SessionInterface):
+    """
+    Flask session interface that stores sessions in a backend and only puts the ID in the cookie.
+    Sessions are written back only when they were modified.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            data = self.backend.load(sid)
+            if data is not None:
+                return ServerSideSession(data, sid=sid)
+        return ServerSideSession(sid=secrets.token_urlsafe(32), new=True)
+
+    def save_session(self, app, session, response):
+        cookie_name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if not session:
+            if session.modified and not session.new:
+                self.backend.delete(session.sid)
+                response.delete_cookie(cookie_name, domain=domain, path=path)
+            return
+
+        if session.modified:
+            session.stored_size = self.backend.save(session.sid, dict(session))
+
+        if session.new or session.modified or self.should_set_cookie(app, session):
+            response.set_cookie(
+                cookie_name,
+                session.sid,
+                expires=self.get_expiration_time(app, session),
+                httponly=self.get_cookie_httponly(app),
+                domain=domain,
+                path=path,
+                secure=self.get_cookie_secure(app),
+                samesite=self.get_cookie_samesite(app),
+            )
+
+
+class ObservedSessionInterface(SessionInterface):
+    """
+    Wraps another session interface and reports how long each save took and, when the
+    session was written, how many bytes were stored. observer(seconds, size) is called
+    after every save; size is None when nothing was written. With size_header set, the
+    size is also sent back in that response header, so load tests can follow it per turn.
+    """
+
+    def __init__(self, inner, observer, size_header=None):
+        self.inner = inner
+        self.observer = observer
+        self.size_header = size_header
+
+    def open_session(self, app, request):
+        return self.inner.open_session(app, request)
+
+    def make_null_session(self, app):
+        return self.inner.make_null_session(app)
+
+    def is_null_session(self, obj):
+        return self.inner.is_null_session(obj)
+
+    def save_session(self, app, session, response):
+        start = time.perf_counter()
+        self.inner.save_session(app, session, response)
+        seconds = time.perf_counter() - start
+        size = getattr(session, 'stored_size', None)
+        if size is None and not isinstance(session, ServerSideSession):
+            # Cookie sessions: the stored data is the cookie value, when one was sent
+            prefix = self.get_cookie_name(app) + '='
+            for header in response.headers.getlist('Set-Cookie'):
+                if header.startswith(prefix):
+                    size = len(header.split(';', 1)[0]) - len(prefix)
+        if self.size_header and size is not None:
+            response.headers[self.size_header] = str(size)
+        self.observer(seconds, size)
+
+
+# Function to create the session interface configured by name
+def create_session_interface(backend_name, db_path='sessions.sqlite3', max_age=86400):
+    """
+    Returns a session interface for 'sqlite' or 'memory', or None for Flask's default cookie session.
+    """
+    if backend_name == 'cookie':
+        return None
+    if backend_name == 'memory':
+        return ServerSideSessionInterface(MemorySessionBackend(max_age))
+    if backend_name == 'sqlite':
+        return ServerSideSessionInterface(SQLiteSessionBackend(db_path, max_age))
+    raise ValueError(f"Unknown session backend '{backend_name}'. Choose one of: sqlite, memory, cookie")
@@ -0,0 +1,83 @@
+// Incremental chat: messages are sent in the background and the server answers with only
+// the new user and bot messages, which are appended to the chat box. The order summary is
+// fetched again only when the X-Order-Version of a reply says the order changed.
+// Without fetch the form keeps doing full-page posts.
+(function () {
+    var form = document.getElementById('chat-form');
+    var chatBox = document.getElementById('chat-box');
+    var orderPanel = document.getElementById('order-summary');
+    if (!form || !window.fetch || !window.FormData) {
+        return;
+    }
+    var input = form.elements.message;
+    var maxMessages = parseInt(chatBox.getAttribute('data-max-messages'), 10) || 0;
+    var orderVersion = orderPanel.getAttribute('data-version');
+    var submitter = null;
+    var sending = false;
+
+    function scrollToBottom() {
+        chatBox.scrollTop = chatBox.scrollHeight;
+    }
+
+    function appendMessages(html) {
+        chatBox.insertAdjacentHTML('beforeend', html);
+        // Keep no more messages on the page than the session keeps
+        var messages = chatBox.getElementsByClassName('message');
+        while (maxMessages && messages.length > maxMessages) {
+            chatBox.removeChild(messages[0]);
+        }
+        scrollToBottom();
+    }
+
+    function refreshOrder(version) {
+        if (!version || version === orderVersion) {
+            return;
+        }
+        orderVersion = version;
+        // no-cache revalidates with the ETag, so an unchanged summary comes back as a 304
+        fetch(orderPanel.getAttribute('data-url'), {credentials: 'same-origin', cache: 'no-cache'})
+            .then(function (response) {
+                return response.ok ? response.text() : null;
+            })
+            .then(function (html) {
+                if (html !== null) {
+                    orderPanel.innerHTML = html;
+                }
+            }, function () {});
+    }
+
+    // Remember which button sent the form, since FormData leaves it out
+    form.addEventListener('click', function (event) {
+        if (event.target.type === 'submit') {
+            submitter = event.target;
+        }
+    });
+
+    form.addEventListener('submit', function (event) {
+        event.preventDefault();
+        if (sending) {
+            return;
+        }
+        var data = new FormData(form);
+        if (submitter && submitter.name) {
+            data.append(submitter.name, submitter.value);
+        }
+        submitter = null;
+        sending = true;
+        fetch(form.getAttribute('data-url'), {method: 'POST', body: data, credentials: 'same-origin'})
+            .then(function (response) {
+                refreshOrder(response.headers.get('X-Order-Version'));
+                return response.text();
+            })
+            .then(function (html) {
+                appendMessages(html);
+                input.value = '';
+            }, function () {
+                // Network error: keep the typed message so it can be sent again
+            })
+            .then(function () {
+                sending = false;
+                input.focus();
+            });
+    });
+})();
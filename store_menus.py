@@ -0,0 +1,242 @@
+"""
+Menus of individual stores, built on the base menu from small per-store overlays.
+
+Most locations sell the base menu with their own prices, and some add or drop a few regional
+items. Each store has an overlay CSV in the store menus directory (stores/<store_id>.csv)
+with the columns of the menu CSV, listing only what differs from the base menu:
+
+    Menu Item,Price,Ingredients
+    Cheese Burger,3.95,
+    Grilled Cheese,3.10,"Cheese, Lettuce, Tomato, Spread"
+    Hot Cocoa,-,
+
+A row naming a base item replaces its price and, when the Ingredients cell isn't blank, its
+ingredients. A Price of '-' takes the item off the store's menu. Any other row adds a
+regional item and needs both a price and ingredients.
+
+Overlays are split into what changes the items (added, dropped or changed items) and what
+only changes prices. Stores whose items match share one snapshot of the lookup structures,
+built once for that set of items, and each store only adds its own price dictionary on top
+of it. A store that changes nothing uses the base snapshot itself. Item names and ingredients
+are interned, so every snapshot points at the same strings. Store menus are loaded on first
+use and dropped once nobody has asked for them for idle_seconds.
+"""
+import csv
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+import weakref
+
+from menu_index import MenuSnapshot, lemmatize_phrases, normalize_item_name, row_hash
+
+logger = logging.getLogger(__name__)
+
+# Store IDs double as file names, so only allow plain names
+STORE_ID_PATTERN = re.compile(r'[A-Za-z0-9_-]{1,64}')
+
+# Price that takes an item off a store's menu
+REMOVED_PRICE = '-'
+
+
+# Function to read a store's menu overlay CSV
+def read_menu_overlay(csv_path):
+    """
+    Returns the overlay as (prices, removed, items): the price of every row that has one,
+    the names of items taken off the menu, and the ingredients of every row that lists them.
+    """
+    prices = {}
+    removed = set()
+    items = {}
+    with open(csv_path, newline='', encoding='utf-8') as csv_file:
+        for line, row in enumerate(csv.DictReader(csv_file), start=2):
+            name = normalize_item_name((row.get('Menu Item') or '').strip())
+            price = (row.get('Price') or '').strip()
+            ingredients = (row.get('Ingredients') or '').strip()
+            if not name:
+                continue
+            if price == REMOVED_PRICE:
+                removed.add(name)
+                continue
+            if price:
+                try:
+                    prices[name] = float(price)
+                except ValueError:
+                    raise ValueError(f"{csv_path}, line {line}: invalid price {price!r} for {name!r}")
+            if ingredients:
+                items[name] = [ingredient.strip().lower() for ingredient in ingredients.split(',')]
+    return prices, removed, items
+
+
+# Function to build the index of the base menu with a store's item changes applied
+def build_overlay_index(base_index, key, removed, items, prices, nlp):
+    """
+    Reuses the lemmas of the base index, so only the phrases of regional items go through
+    spaCy, and keeps the entries of unchanged items as they are. Added items take their
+    price from prices; every store lays its own prices over the result anyway.
+    """
+    known_lemmas = base_index['lemmas']
+    phrases = set(items)
+    for ingredients in items.values():
+        phrases.update(ingredients)
+    new_phrases = sorted(phrase for phrase in phrases if phrase not in known_lemmas)
+    lemmas = dict(known_lemmas)
+    lemmas.update(zip(new_phrases, lemmatize_phrases(nlp, new_phrases)))
+
+    entries = []
+    base_names = set()
+    for entry in base_index['items']:
+        name = entry['name']
+        base_names.add(name)
+        if name in removed:
+            continue
+        if name in items:
+            entry = dict(entry, ingredients=[lemmas[ingredient] for ingredient in items[name]],
+                         row=row_hash(name, entry['price'], items[name]))
+        entries.append(entry)
+    for name, ingredients in sorted(items.items()):
+        if name in base_names:
+            continue
+        if name not in prices:
+            raise ValueError(f"Regional item {name!r} has no price")
+        entries.append({
+            'name': name,
+            'price': prices[name],
+            'lemma': lemmas[name],
+            'ingredients': [lemmas[ingredient] for ingredient in ingredients],
+            'row': row_hash(name, prices[name], ingredients),
+        })
+
+    return {
+        'key': key,
+        'base': base_index['key'],
+        'format': base_index['format'],
+        'model': base_index['model'],
+        'items': entries,
+        'aliases': base_index['aliases'],
+        'lemmas': lemmas,
+        'build': {
+            'rows': len(entries),
+            'changed_rows': len(items) + len(removed),
+            'phrases_lemmatized': len(new_phrases),
+            'phrases_reused': len(phrases) - len(new_phrases),
+        },
+    }
+
+
+# Function to derive the version of a menu from the version it is built on and what changed
+def derived_version(version, changes):
+    digest = hashlib.sha256(version.encode('utf-8'))
+    digest.update(json.dumps(changes, sort_keys=True).encode('utf-8'))
+    return digest.hexdigest()
+
+
+class StoreMenus:
+    """
+    Loads, shares and evicts the menu snapshots of individual stores.
+
+    get() returns the snapshot of a store, building it on first use from the live base menu of
+    menu_manager and the store's overlay in overlay_dir. Snapshots are rebuilt when the base
+    menu changes; clear() drops them all so that edited overlays are read again. Stores not
+    asked for within idle_seconds are dropped, and snapshots no store uses any more are freed.
+
+    loads and evictions count store menus built and dropped by this process.
+    """
+
+    def __init__(self, menu_manager, overlay_dir, idle_seconds=900):
+        self.menu_manager = menu_manager
+        self.overlay_dir = overlay_dir
+        self.idle_seconds = idle_seconds
+        self.loads = 0
+        self.evictions = 0
+
+        # store_id -> snapshot, and store_id -> time.monotonic() of its last use
+        self._stores = {}
+        self._last_used = {}
+        # Snapshots by version, so stores with the same menu share one
+        self._shared = weakref.WeakValueDictionary()
+        self._last_sweep = time.monotonic()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._stores)
+
+    def overlay_path(self, store_id):
+        return os.path.join(self.overlay_dir, f"{store_id}.csv")
+
+    def get(self, store_id):
+        """
+        Returns the menu snapshot of store_id, or None when there is no such store.
+        """
+        now = time.monotonic()
+        if now - self._last_sweep >= min(self.idle_seconds, 60):
+            self.evict_idle(now)
+        snapshot = self._stores.get(store_id)
+        if snapshot is None or snapshot.base_version != self.menu_manager.snapshot.version:
+            snapshot = self._load(store_id)
+            if snapshot is None:
+                return None
+        self._last_used[store_id] = now
+        return snapshot
+
+    def _load(self, store_id):
+        if not STORE_ID_PATTERN.fullmatch(store_id):
+            return None
+        with self._lock:
+            base = self.menu_manager.snapshot
+            snapshot = self._stores.get(store_id)
+            if snapshot is not None and snapshot.base_version == base.version:
+                return snapshot
+            try:
+                prices, removed, items = read_menu_overlay(self.overlay_path(store_id))
+            except FileNotFoundError:
+                return None
+            start = time.perf_counter()
+            snapshot = self._build(base, prices, removed, items)
+            self._stores[store_id] = snapshot
+            self._last_used[store_id] = time.monotonic()
+            self.loads += 1
+        logger.info("Loaded the menu of store %s (version %s) in %.1f ms",
+                    store_id, snapshot.version[:12], (time.perf_counter() - start) * 1000)
+        return snapshot
+
+    def _build(self, base, prices, removed, items):
+        # Share the lookup structures with every store that has the same items
+        menu = base
+        if removed or items:
+            key = derived_version(base.version, {'removed': sorted(removed), 'items': items})
+            menu = self._shared.get(key)
+            if menu is None:
+                index = build_overlay_index(base.index, key, removed, items, prices, self.menu_manager.nlp)
+                menu = self._shared[key] = MenuSnapshot(index)
+
+        changed = {name: price for name, price in prices.items()
+                   if name in menu.menu_dict and menu.menu_dict[name] != price}
+        if not changed:
+            return menu
+        version = derived_version(menu.version, {'prices': changed})
+        snapshot = self._shared.get(version)
+        if snapshot is None:
+            snapshot = self._shared[version] = menu.with_prices(version, changed)
+        return snapshot
+
+    def evict_idle(self, now=None):
+        """
+        Drops the menus of stores not asked for within idle_seconds.
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self._last_sweep = now
+            for store_id, last_used in list(self._last_used.items()):
+                if now - last_used >= self.idle_seconds:
+                    del self._last_used[store_id]
+                    if self._stores.pop(store_id, None) is not None:
+                        self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._stores.clear()
+            self._last_used.clear()